@@ -3,17 +3,36 @@ Main module of the server file
 """
 
 # 3rd party modules
-from flask import render_template
+from connexion.resolver import Resolver
+from flask import Response, render_template
 
 # local modules
 import config
+import metrics
+import search
+import snapshot
+import spec
+import validation
 
 
 # Get the application instance
 connex_app = config.connex_app
 
-# Read the swagger.yml file to configure the endpoints
-connex_app.add_api("swagger.yml")
+# The underlying Flask app, found by the flask command (flask db upgrade)
+app = connex_app.app
+
+# Read the compiled swagger.yml to configure the endpoints, the handlers
+# are timed for the metrics and the bodies checked by compiled validators
+spec.add_api(connex_app, resolver=Resolver(metrics.resolve),
+             validator_map={"body": validation.RequestBodyValidator})
+
+# Make sure the full-text search index exists and is filled
+search.init_index()
+
+# Load the catalog snapshot before the first request when it is on
+if snapshot.catalog is not None:
+    with app.app_context():
+        snapshot.catalog.build()
 
 
 # create a URL route in our application for "/"
@@ -27,6 +46,16 @@ def home():
     return render_template("home.html")
 
 
+@connex_app.route("/metrics")
+def read_metrics():
+    """
+    This function responds to a Prometheus scrape of
+    localhost:5000/metrics
+    :return:        the request metrics of this process in the Prometheus text format
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     # connex_app.run(debug=True)
     connex_app.run(host='127.0.0.1', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+This is the asgi module and serves the application from an ASGI server,
+gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+
+The event loop holds the client connections, so a worker keeps thousands
+of idle keep-alive clients without a thread each. The connexion handlers
+are synchronous and run in a pool of ASGI_THREADS threads, while the
+exports, which hold a database connection for the life of the response,
+stream from an async engine on the event loop itself.
+"""
+
+import json
+from urllib.parse import parse_qs
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+import config
+from app import connex_app
+from models import Directors, Movies
+import directors
+import export
+import movies
+
+
+# asyncio drivers of the databases the application runs on
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+# Export endpoints served from the event loop: columns, sort and file name
+EXPORTS = {
+    "/api/directors/export": (directors.EXPORT_COLUMNS, Directors.id, "directors"),
+    "/api/movies/export": (movies.EXPORT_COLUMNS, Movies.id, "movies"),
+}
+
+
+def async_url(url):
+    """
+    Url of the asyncio driver of a database
+
+    :param url:     database url of the application
+    :return:        url for create_async_engine
+    """
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def create_engine(url):
+    """
+    Async engine with the same pool settings as the application engine
+
+    :param url:     database url of the application
+    :return:        AsyncEngine
+    """
+    options = config.engine_options(url)
+    if "pool_size" in options:
+        options["poolclass"] = AsyncAdaptedQueuePool
+    options.pop("connect_args", None)
+
+    engine = create_async_engine(async_url(url), **options)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect",
+                     lambda dbapi_connection, record: config.sqlite_pragmas(dbapi_connection))
+    return engine
+
+
+# Reads go to the replica when one is configured, like the GET requests
+engine = create_engine(config.app.config["SQLALCHEMY_BINDS"].get("replica")
+                       or config.app.config["SQLALCHEMY_DATABASE_URI"])
+
+
+async def _send_json(send, status, data):
+    body = json.dumps(data).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/problem+json"),
+                    (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def stream_export(scope, send, columns, order_by, filename):
+    """
+    Stream an export from the async engine, chunk by chunk, with the same
+    output as export.stream
+
+    :param scope:       ASGI connection scope
+    :param send:        ASGI send callable
+    :param columns:     table columns to export, in output order
+    :param order_by:    column sorting the rows
+    :param filename:    base name of the downloaded file
+    """
+    query = parse_qs(scope["query_string"].decode())
+    format = query.get("format", ["ndjson"])[-1]
+    if format not in export.MIMETYPES:
+        return await _send_json(send, 400, {
+            "detail": "'{}' is not one of {}".format(format, list(export.MIMETYPES)),
+            "status": 400,
+            "title": "Bad Request",
+            "type": "about:blank",
+        })
+
+    headers = [(b"content-type", "{}; charset=utf-8".format(export.MIMETYPES[format]).encode())]
+    headers += [(name.lower().encode(), value.encode())
+                for name, value in export.headers(format, filename).items()]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+    first, encode = export.encoder([column.key for column in columns], format)
+    if first:
+        await send({"type": "http.response.body", "body": first.encode(), "more_body": True})
+
+    async with engine.connect() as connection:
+        result = await connection.stream(export.statement(columns, order_by))
+        async for rows in result.partitions(export.CHUNK_SIZE):
+            await send({"type": "http.response.body", "body": encode(rows).encode(),
+                        "more_body": True})
+
+    await send({"type": "http.response.body", "body": b""})
+
+
+class Application:
+    """
+    ASGI application of the directors and movies API
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] == "http" and scope["method"] == "GET" and scope["path"] in EXPORTS:
+            return await stream_export(scope, send, *EXPORTS[scope["path"]])
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+application = Application(connex_app, config.app.config["ASGI_THREADS"])
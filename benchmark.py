@@ -0,0 +1,725 @@
+"""
+This is the benchmark module and drives every operation of swagger.yml
+against the real application on a scaled copy of the catalog, reporting
+the latency percentiles, throughput and queries per request of each one
+
+    python benchmark.py --scale 10 --requests 200 --concurrency 8
+    python benchmark.py --compare              # fail on regressions
+    python benchmark.py --save-baseline        # store the new numbers
+    python benchmark.py --startup 10           # time the worker startups
+
+The synthetic catalog repeats final_pk.db scale times with shifted ids,
+uids and names, so every copy keeps the shape of the real data.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+BASELINE = os.path.join(basedir, 'benchmark_baseline.json')
+
+# Share a number may grow over its baseline before it counts as a regression
+TOLERANCE = 0.25
+
+SCENARIOS = {}
+
+
+def scenario(operation_id):
+    """
+    Register the function building the requests of an operation. The
+    function gets the catalog and returns a dict with method, path and
+    optionally query_string, json, data and content_type. Any setup it
+    needs (like creating the row a delete removes) runs untimed.
+
+    :param operation_id:    operationId in swagger.yml
+    :return:                decorator
+    """
+    def decorator(function):
+        SCENARIOS[operation_id] = function
+        return function
+    return decorator
+
+
+def operations(spec_path=os.path.join(basedir, 'swagger.yml')):
+    """
+    Operations of the API
+
+    :param spec_path:   path of the swagger specification
+    :return:            list of (operationId, method, path)
+    """
+    with open(spec_path) as spec_file:
+        spec = yaml.safe_load(spec_file)
+
+    return [
+        (operation['operationId'], method.upper(), spec.get('basePath', '') + path)
+        for path, methods in spec['paths'].items()
+        for method, operation in methods.items()
+    ]
+
+
+def missing_scenarios(spec_path=os.path.join(basedir, 'swagger.yml')):
+    """
+    Operations of the API the benchmark can not drive yet
+
+    :param spec_path:   path of the swagger specification
+    :return:            list of operationIds without a scenario
+    """
+    return [operation_id for operation_id, _, _ in operations(spec_path)
+            if operation_id not in SCENARIOS]
+
+
+def generate(connection, scale):
+    """
+    Grow the catalog to scale copies of itself, ids, uids and names
+    shifted for every copy, and rebuild the stats rollup
+
+    :param connection:  SQLAlchemy connection in a transaction
+    :param scale:       number of copies of the catalog, 1 keeps it as is
+    """
+    from sqlalchemy import text
+    from models import DirectorStats
+    import stats
+
+    spans = connection.execute(text(
+        "SELECT (SELECT max(id) FROM directors), (SELECT max(uid) FROM directors), "
+        "(SELECT max(id) FROM movies), (SELECT max(uid) FROM movies)"
+    )).one()
+    director_span, director_uid_span, movie_span, movie_uid_span = spans
+
+    for copy in range(1, scale):
+        connection.execute(text(
+            """
+            INSERT INTO directors (id, name, gender, uid, department, version, updated_at)
+            SELECT id + :copy * :span, name || ' ' || :copy, gender, uid + :copy * :uid_span,
+                   department, version, updated_at
+            FROM directors WHERE id <= :span
+            """
+        ), {"copy": copy, "span": director_span, "uid_span": director_uid_span})
+        connection.execute(text(
+            """
+            INSERT INTO movies (id, director_id, original_title, budget, popularity,
+                                release_date, revenue, title, vote_average, vote_count,
+                                overview, tagline, uid, version, updated_at)
+            SELECT id + :copy * :span, director_id + :copy * :director_span, original_title,
+                   budget, popularity, release_date, revenue, title || ' ' || :copy,
+                   vote_average, vote_count, overview, tagline, uid + :copy * :uid_span,
+                   version, updated_at
+            FROM movies WHERE id <= :span
+            """
+        ), {"copy": copy, "span": movie_span, "director_span": director_span,
+            "uid_span": movie_uid_span})
+
+    table = DirectorStats.__table__
+    connection.execute(table.delete())
+    connection.execute(table.insert().from_select(
+        ['director_id', 'movies_count', 'total_budget', 'total_revenue', 'vote_points', 'vote_total'],
+        stats.rollup()))
+
+
+class Catalog:
+    """
+    Sample rows of the benchmark database the scenarios pick from, and
+    the counters keeping the created rows unique
+    """
+
+    def __init__(self, connection, client, seed=2021):
+        from sqlalchemy import text
+
+        self.client = client
+        self.random = random.Random(seed)
+        self.directors = [row[0] for row in connection.execute(text(
+            "SELECT id FROM directors ORDER BY random() LIMIT 500"))]
+        self.movies = [tuple(row) for row in connection.execute(text(
+            "SELECT director_id, id FROM movies WHERE director_id IS NOT NULL "
+            "ORDER BY random() LIMIT 500"))]
+        self.keywords = [row[0].split()[0] for row in connection.execute(text(
+            "SELECT title FROM movies WHERE title <> '' ORDER BY random() LIMIT 200"))]
+        self.uids = itertools.count(connection.execute(text(
+            "SELECT max(max(coalesce((SELECT max(uid) FROM movies), 0)), "
+            "coalesce((SELECT max(uid) FROM directors), 0)) + 1000000"
+        )).scalar())
+
+    def director(self):
+        return self.random.choice(self.directors)
+
+    def movie(self):
+        return self.random.choice(self.movies)
+
+    def keyword(self):
+        return self.random.choice(self.keywords)
+
+    def new_director(self):
+        return {"name": "Benchmark Director {}".format(next(self.uids)), "uid": next(self.uids),
+                "gender": 1, "department": "Directing"}
+
+    def new_movie(self, director_id=None):
+        uid = next(self.uids)
+        movie = {
+            "original_title": "Benchmark {}".format(uid), "budget": 1000000, "popularity": 10,
+            "release_date": "2021-10-01", "revenue": 3000000, "title": "Benchmark {}".format(uid),
+            "vote_average": 6.5, "vote_count": 100, "overview": "Benchmark overview",
+            "tagline": "Benchmark tagline", "uid": uid,
+        }
+        if director_id is not None:
+            movie["director_id"] = director_id
+        return movie
+
+    def setup(self, method, path, **kwargs):
+        """
+        Send an untimed request preparing a scenario
+
+        :return:    decoded json body of the response
+        """
+        response = self.client.request(method, path, **kwargs)
+        return response.json()
+
+
+@scenario('directors.read_all')
+def _directors_read_all(catalog):
+    return {"method": "GET", "path": "/api/directors"}
+
+
+@scenario('directors.read_limit')
+def _directors_read_limit(catalog):
+    attribute = catalog.random.choice(['id', 'name', 'gender', 'uid', 'department'])
+    order = catalog.random.choice(['asc', 'desc'])
+    return {"method": "GET", "path": "/api/directors/10/{}/{}".format(order, attribute)}
+
+
+@scenario('directors.read_one')
+def _directors_read_one(catalog):
+    return {"method": "GET", "path": "/api/directors/{}".format(catalog.director())}
+
+
+@scenario('directors.search_all')
+def _directors_search_all(catalog):
+    return {"method": "GET", "path": "/api/directors-name/{}".format(catalog.keyword())}
+
+
+@scenario('directors.create')
+def _directors_create(catalog):
+    return {"method": "POST", "path": "/api/directors", "json": catalog.new_director()}
+
+
+@scenario('directors.update')
+def _directors_update(catalog):
+    id = catalog.setup("POST", "/api/directors", json=catalog.new_director())["id"]
+    return {"method": "PUT", "path": "/api/directors/{}".format(id), "json": catalog.new_director()}
+
+
+@scenario('directors.patch')
+def _directors_patch(catalog):
+    id = catalog.setup("POST", "/api/directors", json=catalog.new_director())["id"]
+    return {"method": "PATCH", "path": "/api/directors/{}".format(id),
+            "json": {"name": catalog.new_director()["name"]}}
+
+
+@scenario('directors.delete')
+def _directors_delete(catalog):
+    id = catalog.setup("POST", "/api/directors", json=catalog.new_director())["id"]
+    return {"method": "DELETE", "path": "/api/directors/{}".format(id)}
+
+
+@scenario('directors.bulk_create')
+def _directors_bulk_create(catalog):
+    return {"method": "POST", "path": "/api/directors/bulk",
+            "json": [catalog.new_director() for _ in range(100)]}
+
+
+@scenario('directors.bulk_update')
+def _directors_bulk_update(catalog):
+    created = catalog.setup("POST", "/api/directors/bulk",
+                            json=[catalog.new_director() for _ in range(100)])
+    return {"method": "PUT", "path": "/api/directors/bulk",
+            "json": [dict(catalog.new_director(), id=item["id"]) for item in created["items"]]}
+
+
+@scenario('directors.bulk_delete')
+def _directors_bulk_delete(catalog):
+    created = catalog.setup("POST", "/api/directors/bulk",
+                            json=[catalog.new_director() for _ in range(100)])
+    return {"method": "DELETE", "path": "/api/directors/bulk",
+            "json": [item["id"] for item in created["items"]]}
+
+
+@scenario('directors.export_all')
+def _directors_export_all(catalog):
+    return {"method": "GET", "path": "/api/directors/export",
+            "query_string": {"format": catalog.random.choice(['ndjson', 'csv'])}}
+
+
+@scenario('movies.read_all')
+def _movies_read_all(catalog):
+    return {"method": "GET", "path": "/api/movies"}
+
+
+@scenario('movies.read_limit')
+def _movies_read_limit(catalog):
+    attribute = catalog.random.choice(['id', 'title', 'budget', 'popularity', 'release date',
+                                       'revenue', 'vote average', 'vote count'])
+    order = catalog.random.choice(['asc', 'desc'])
+    return {"method": "GET", "path": "/api/movies/10/{}/{}".format(order, attribute)}
+
+
+@scenario('movies.read_filmography')
+def _movies_read_filmography(catalog):
+    # a director with movies, the ones of catalog.movie
+    return {"method": "GET", "path": "/api/directors/{}/movies".format(catalog.movie()[0])}
+
+
+@scenario('movies.read_one')
+def _movies_read_one(catalog):
+    return {"method": "GET", "path": "/api/directors/{}/movies/{}".format(*catalog.movie())}
+
+
+@scenario('movies.read_similar')
+def _movies_read_similar(catalog):
+    return {"method": "GET", "path": "/api/movies/{}/similar".format(catalog.movie()[1])}
+
+
+@scenario('movies.search_all')
+def _movies_search_all(catalog):
+    return {"method": "GET", "path": "/api/movies-title/{}".format(catalog.keyword())}
+
+
+@scenario('movies.create')
+def _movies_create(catalog):
+    return {"method": "POST", "path": "/api/directors/{}/movies".format(catalog.director()),
+            "json": catalog.new_movie()}
+
+
+@scenario('movies.update')
+def _movies_update(catalog):
+    director_id = catalog.director()
+    path = "/api/directors/{}/movies".format(director_id)
+    id = catalog.setup("POST", path, json=catalog.new_movie())["id"]
+    return {"method": "PUT", "path": "{}/{}".format(path, id), "json": catalog.new_movie()}
+
+
+@scenario('movies.patch')
+def _movies_patch(catalog):
+    director_id = catalog.director()
+    path = "/api/directors/{}/movies".format(director_id)
+    id = catalog.setup("POST", path, json=catalog.new_movie())["id"]
+    return {"method": "PATCH", "path": "{}/{}".format(path, id),
+            "json": {"title": catalog.new_movie()["title"]}}
+
+
+@scenario('movies.delete')
+def _movies_delete(catalog):
+    path = "/api/directors/{}/movies".format(catalog.director())
+    id = catalog.setup("POST", path, json=catalog.new_movie())["id"]
+    return {"method": "DELETE", "path": "{}/{}".format(path, id)}
+
+
+@scenario('movies.bulk_create')
+def _movies_bulk_create(catalog):
+    return {"method": "POST", "path": "/api/movies/bulk",
+            "json": [catalog.new_movie(catalog.director()) for _ in range(100)]}
+
+
+@scenario('movies.bulk_update')
+def _movies_bulk_update(catalog):
+    movies = [catalog.new_movie(catalog.director()) for _ in range(100)]
+    created = catalog.setup("POST", "/api/movies/bulk", json=movies)
+    return {"method": "PUT", "path": "/api/movies/bulk",
+            "json": [dict(catalog.new_movie(movie["director_id"]), id=item["id"])
+                     for movie, item in zip(movies, created["items"])]}
+
+
+@scenario('movies.bulk_delete')
+def _movies_bulk_delete(catalog):
+    created = catalog.setup("POST", "/api/movies/bulk",
+                            json=[catalog.new_movie(catalog.director()) for _ in range(100)])
+    return {"method": "DELETE", "path": "/api/movies/bulk",
+            "json": [item["id"] for item in created["items"]]}
+
+
+@scenario('movies.export_all')
+def _movies_export_all(catalog):
+    return {"method": "GET", "path": "/api/movies/export",
+            "query_string": {"format": catalog.random.choice(['ndjson', 'csv'])}}
+
+
+@scenario('search.search_all')
+def _search_all(catalog):
+    return {"method": "GET", "path": "/api/search/{}".format(catalog.keyword())}
+
+
+@scenario('stats.read_director')
+def _stats_read_director(catalog):
+    return {"method": "GET", "path": "/api/directors/{}/stats".format(catalog.director())}
+
+
+@scenario('stats.read_leaderboard')
+def _stats_read_leaderboard(catalog):
+    attribute = catalog.random.choice(['movies_count', 'total_budget', 'total_revenue', 'roi',
+                                       'vote_average'])
+    return {"method": "GET", "path": "/api/stats/directors/10/{}".format(attribute)}
+
+
+@scenario('stats.read_years')
+def _stats_read_years(catalog):
+    return {"method": "GET", "path": "/api/stats/years"}
+
+
+@scenario('cache.read_stats')
+def _cache_read_stats(catalog):
+    return {"method": "GET", "path": "/api/cache"}
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class TestClient:
+    """
+    Client sending the requests through the WSGI stack of the application
+    in this process, one Flask test client per thread
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.local = threading.local()
+
+    def request(self, method, path, **kwargs):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.flask_app.test_client()
+        response = self.local.client.open(path, method=method, **kwargs)
+        return Response(response.status_code, response.get_data())
+
+
+class HttpClient:
+    """
+    Client sending the requests to a running server, one session per thread
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.local = threading.local()
+
+    def request(self, method, path, query_string=None, content_type=None, **kwargs):
+        import requests
+
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        headers = {"Content-Type": content_type} if content_type else None
+        response = self.local.session.request(
+            method, self.url + path, params=query_string, headers=headers, **kwargs)
+        return Response(response.status_code, response.content)
+
+
+class QueryCounter:
+    """
+    Count the statements each thread sends to the database
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.local = threading.local()
+        event.listen(engine, "before_cursor_execute", self.callback)
+
+    def callback(self, *args):
+        self.local.count = getattr(self.local, "count", 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    def read(self):
+        return getattr(self.local, "count", 0)
+
+
+def percentile(values, share):
+    """
+    Nearest rank percentile of values
+
+    :param values:  sorted list of numbers
+    :param share:   percentile between 0 and 100
+    :return:        value
+    """
+    index = max(0, min(len(values) - 1, int(round(share / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_operation(catalog, client, counter, operation_id, requests, concurrency, warmup=5):
+    """
+    Time requests requests of an operation sent from concurrency threads
+
+    :param catalog:         Catalog of the benchmark database
+    :param client:          TestClient or HttpClient
+    :param counter:         QueryCounter, None when the app runs elsewhere
+    :param operation_id:    operation to drive
+    :param requests:        number of timed requests
+    :param concurrency:     number of threads sending them
+    :param warmup:          untimed requests sent first
+    :return:                dict of the operation numbers
+    """
+    build = SCENARIOS[operation_id]
+    for _ in range(warmup):
+        spec = build(catalog)
+        client.request(spec.pop("method"), spec.pop("path"), **spec)
+
+    # the setups of the scenarios run before the clock starts
+    specs = [build(catalog) for _ in range(requests)]
+
+    def send(spec):
+        spec = dict(spec)
+        if counter is not None:
+            counter.reset()
+        start = time.perf_counter()
+        response = client.request(spec.pop("method"), spec.pop("path"), **spec)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 500:
+            print("{} {}: {}".format(operation_id, response.status_code, response.body[:200]),
+                  file=sys.stderr)
+        return elapsed, counter.read() if counter is not None else None, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, specs))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in results)
+    queries = [count for _, count, _ in results if count is not None]
+    return {
+        "requests": requests,
+        "errors": sum(1 for _, _, status in results if status >= 500),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "throughput": round(requests / wall, 1),
+        "queries": round(statistics.mean(queries), 2) if queries else None,
+    }
+
+
+# Ways a worker starts: parsing swagger.yml, loading the compiled spec
+# (spec.py) or forked from a master that preloaded the app (gunicorn.conf.py)
+STARTUP_MODES = ("startup.swagger_yml", "startup.compiled", "startup.preloaded")
+
+STARTUP_SCRIPT = """
+import os, sys, time
+start = time.perf_counter()
+import app
+if sys.argv[1] == "startup.preloaded":
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid:
+        sys.exit(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]))
+    import config
+    config.dispose_engines()
+status = app.app.test_client().get("/api/directors/7110").status_code
+print(time.perf_counter() - start, status, flush=True)
+os._exit(0)
+"""
+
+
+def run_startup(mode, runs, workdir):
+    """
+    Time runs fresh workers from their start to the answer of their first
+    request, each one in a new interpreter
+
+    :param mode:        one of STARTUP_MODES
+    :param runs:        number of workers started
+    :param workdir:     where the compiled specs are kept
+    :return:            dict of the numbers, shaped like the ones of an operation
+    """
+    compiled = os.path.join(workdir, "benchmark_swagger.json")
+    durations, errors = [], 0
+    start = time.perf_counter()
+    for run in range(runs):
+        environ = dict(os.environ, SPEC_COMPILED_PATH=compiled)
+        if mode == "startup.swagger_yml":
+            # a new path every time, so the spec is never found compiled
+            environ["SPEC_COMPILED_PATH"] = os.path.join(workdir, "benchmark_swagger_{}.json".format(run))
+        elif not os.path.exists(compiled):
+            subprocess.run([sys.executable, "spec.py"], cwd=basedir, env=environ, check=True)
+
+        process = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, mode], cwd=basedir, env=environ,
+                                 stdout=subprocess.PIPE, universal_newlines=True)
+        if mode == "startup.swagger_yml" and os.path.exists(environ["SPEC_COMPILED_PATH"]):
+            os.remove(environ["SPEC_COMPILED_PATH"])
+        try:
+            seconds, status = process.stdout.split()
+            durations.append(float(seconds) * 1000)
+            errors += int(status) >= 500
+        except ValueError:
+            errors += 1
+    wall = time.perf_counter() - start
+
+    durations = sorted(durations) or [0.0]
+    return {
+        "requests": runs,
+        "errors": errors,
+        "p50_ms": round(percentile(durations, 50), 3),
+        "p95_ms": round(percentile(durations, 95), 3),
+        "p99_ms": round(percentile(durations, 99), 3),
+        "throughput": round(runs / wall, 1),
+        "queries": None,
+    }
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Regressions of results against a baseline run
+
+    :param results:     dict of operationId to numbers
+    :param baseline:    dict of operationId to numbers of the baseline
+    :param tolerance:   share the latency may grow before it counts
+    :return:            list of regression messages
+    """
+    regressions = []
+    for operation_id, numbers in sorted(results.items()):
+        before = baseline.get(operation_id)
+        if before is None:
+            continue
+        if numbers["errors"] > before.get("errors", 0):
+            regressions.append("{}: {} server errors".format(operation_id, numbers["errors"]))
+        # the scenarios pick random rows, so the mean moves a little between runs
+        if (None not in (numbers["queries"], before.get("queries"))
+                and numbers["queries"] > before["queries"] * 1.1):
+            regressions.append("{}: {} queries per request, was {}".format(
+                operation_id, numbers["queries"], before["queries"]))
+        if numbers["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append("{}: p95 {} ms, was {} ms".format(
+                operation_id, numbers["p95_ms"], before["p95_ms"]))
+    return regressions
+
+
+def report(results, baseline=None):
+    """
+    Text table of the results
+
+    :param results:     dict of operationId to numbers
+    :param baseline:    dict of operationId to numbers of the baseline, may be None
+    :return:            string
+    """
+    lines = ["{:<28} {:>9} {:>9} {:>9} {:>9} {:>8} {:>7}".format(
+        "operation", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries", "errors")]
+    for operation_id, numbers in sorted(results.items()):
+        line = "{:<28} {:>9} {:>9} {:>9} {:>9} {:>8} {:>7}".format(
+            operation_id, numbers["p50_ms"], numbers["p95_ms"], numbers["p99_ms"],
+            numbers["throughput"], "-" if numbers["queries"] is None else numbers["queries"],
+            numbers["errors"])
+        if baseline and operation_id in baseline:
+            line += "  (p95 was {})".format(baseline[operation_id]["p95_ms"])
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every operation of swagger.yml")
+    parser.add_argument("--scale", type=int, default=1, help="copies of final_pk.db, 10 to 1000")
+    parser.add_argument("--requests", type=int, default=100, help="timed requests per operation")
+    parser.add_argument("--concurrency", type=int, default=4, help="threads sending requests")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed requests per operation")
+    parser.add_argument("--operations", help="comma separated operationIds, all by default")
+    parser.add_argument("--workdir", default=tempfile.gettempdir(), help="where the catalogs are kept")
+    parser.add_argument("--regenerate", action="store_true", help="build the catalog again")
+    parser.add_argument("--url", help="benchmark a running server instead of the app in process")
+    parser.add_argument("--cache", action="store_true", help="keep the response cache on")
+    parser.add_argument("--snapshot", action="store_true", help="turn the catalog snapshot on")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as baseline")
+    parser.add_argument("--compare", action="store_true", help="exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="latency growth allowed")
+    parser.add_argument("--startup", type=int, metavar="RUNS",
+                        help="time RUNS worker startups of every mode instead of the operations")
+    args = parser.parse_args(argv)
+
+    missing = missing_scenarios()
+    if missing:
+        parser.error("no scenario for {}".format(", ".join(missing)))
+
+    # The benchmark works on its own copy, the configuration reads it at import
+    database = os.path.join(args.workdir, "benchmark_{}x.db".format(args.scale))
+    fresh = args.regenerate or not os.path.exists(database)
+    if fresh:
+        os.makedirs(args.workdir, exist_ok=True)
+        shutil.copyfile(os.path.join(basedir, "final_pk.db"), database)
+    os.environ["DATABASE_URL"] = "sqlite:///" + database
+    if not args.cache:
+        os.environ["CACHE_BACKEND"] = "none"
+    if args.snapshot:
+        os.environ["CATALOG_SNAPSHOT"] = "1"
+
+    from app import connex_app
+    from config import db
+
+    with connex_app.app.app_context():
+        if fresh:
+            print("generating {}x catalog in {}".format(args.scale, database), file=sys.stderr)
+            with db.engine.begin() as connection:
+                generate(connection, args.scale)
+
+        if args.url:
+            client, counter = HttpClient(args.url), None
+        else:
+            client, counter = TestClient(connex_app.app), QueryCounter(db.engine)
+        with db.engine.connect() as connection:
+            catalog = Catalog(connection, client)
+
+    results = {}
+    if args.startup:
+        # the workers start on the same catalog, in their own interpreter
+        for mode in STARTUP_MODES:
+            results[mode] = run_startup(mode, args.startup, args.workdir)
+            print("{:<28} done".format(mode), file=sys.stderr)
+        key = "startup"
+    else:
+        selected = args.operations.split(",") if args.operations else sorted(SCENARIOS)
+        for operation_id in selected:
+            results[operation_id] = run_operation(
+                catalog, client, counter, operation_id, args.requests, args.concurrency, args.warmup)
+            print("{:<28} done".format(operation_id), file=sys.stderr)
+        key = "{}x".format(args.scale)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    baseline = baselines.get(key, {}).get("operations")
+
+    print(report(results, baseline))
+
+    if args.save_baseline:
+        baselines[key] = {
+            "requests": args.startup or args.requests,
+            "concurrency": 1 if args.startup else args.concurrency,
+            "operations": dict(baseline or {}, **results),
+        }
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+
+    if args.compare and baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
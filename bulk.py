@@ -0,0 +1,214 @@
+"""
+This is the bulk module and supports the batch create, update and delete
+endpoints of the directors and movies data
+"""
+
+import json
+from datetime import datetime
+
+from flask import abort, request
+from sqlalchemy import bindparam, select
+import validation
+
+
+NDJSON = "application/x-ndjson"
+
+# SQLite accepts a limited number of bound parameters per statement
+CHUNK_SIZE = 5000
+
+
+def read_items(body):
+    """
+    Read the items of a bulk request body, either one JSON array or one
+    JSON value per line (NDJSON). A line that is not valid JSON becomes a
+    None item so the other lines still go through.
+
+    :param body:    raw request body, read from the request when None
+    :return:        list of decoded items
+    """
+    # connexion only passes the body of POST, PUT and PATCH requests
+    if body is None:
+        body = request.get_data()
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+
+    if request.mimetype == NDJSON:
+        items = []
+        for line in body.splitlines():
+            if line.strip() == "":
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+
+    try:
+        items = json.loads(body)
+    except ValueError:
+        abort(400, "Request body is not valid JSON!")
+    if not isinstance(items, list):
+        abort(400, "Request body must be a JSON array!")
+    return items
+
+
+def validate(items, validator):
+    """
+    Check every item in one pass, with the compiled validator of its
+    definition in swagger.yml like the body of a single write
+
+    :param items:       decoded items of the request
+    :param validator:   validator of validation.definition
+    :return:            tuple of list of (index, row) for the valid items
+                        and dict of index to (400, message) for the others
+    """
+    rows, errors = [], {}
+    for index, item in enumerate(items):
+        message = validation.error(validator, item)
+        if message is None:
+            rows.append((index, item))
+        else:
+            errors[index] = (400, message)
+
+    return rows, errors
+
+
+def _valid_id(value):
+    # bool is an int in python but not in JSON
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_ids(items):
+    """
+    Check the items of a bulk delete are ids
+
+    :param items:   decoded items of the request
+    :return:        tuple of list of (index, id) and dict of index to (400, message)
+    """
+    ids, errors = [], {}
+    for index, item in enumerate(items):
+        if isinstance(item, dict):
+            item = item.get("id")
+        if _valid_id(item):
+            ids.append((index, item))
+        else:
+            errors[index] = (400, "Item must be an id!")
+    return ids, errors
+
+
+def chunks(values):
+    """
+    Split values in lists small enough for one IN (...) clause
+
+    :param values:  iterable of values
+    :return:        generator of lists
+    """
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def select_in(session, columns, column, values):
+    """
+    Rows of columns where column is one of values, in as few statements
+    as the database allows
+
+    :param session:     database session
+    :param columns:     columns to select
+    :param column:      column to match
+    :param values:      values to match
+    :return:            list of rows
+    """
+    rows = []
+    for chunk in chunks(set(values)):
+        rows += session.execute(select(*columns).where(column.in_(chunk))).all()
+    return rows
+
+
+def touch(session, table, ids):
+    """
+    Bump the version and change date of the rows of table with ids, the
+    bulk counterpart of a change through the ORM
+
+    :param session:     database session
+    :param table:       Table with version and updated_at columns
+    :param ids:         ids of the changed rows
+    """
+    now = datetime.utcnow()
+    for chunk in chunks(set(ids)):
+        session.execute(
+            table.update()
+            .where(table.c.id.in_(chunk))
+            .values(version=table.c.version + 1, updated_at=now)
+        )
+
+
+def update_rows(session, table, rows):
+    """
+    Update many rows of table in one executemany, bumping their version
+
+    :param session:     database session
+    :param table:       Table with version and updated_at columns
+    :param rows:        list of dicts holding the id and the new values
+    """
+    if len(rows) == 0:
+        return
+
+    names = [name for name in rows[0] if name != "id"]
+    statement = (
+        table.update()
+        .where(table.c.id == bindparam("b_id"))
+        .values(version=table.c.version + 1, updated_at=bindparam("b_updated_at"),
+                **{name: bindparam("b_" + name) for name in names})
+    )
+    now = datetime.utcnow()
+    session.execute(statement, [
+        dict({"b_" + name: value for name, value in row.items()}, b_updated_at=now)
+        for row in rows
+    ])
+
+
+def update_row(session, table, id, values, *criteria):
+    """
+    Update one row of table in a single statement, bumping its version,
+    the single row counterpart of update_rows
+
+    :param session:     database session
+    :param table:       Table with version and updated_at columns
+    :param id:          id of the row
+    :param values:      dict of the new values
+    :param criteria:    further conditions the row has to meet
+    :return:            True when the row was found
+    """
+    result = session.execute(
+        table.update()
+        .where(table.c.id == id, *criteria)
+        .values(version=table.c.version + 1, updated_at=datetime.utcnow(), **values)
+    )
+    return result.rowcount > 0
+
+
+def result(count, statuses, errors, success):
+    """
+    Body of a bulk response with the status of every item, in request order
+
+    :param count:       number of items in the request
+    :param statuses:    dict of index to dict of the item result, for the
+                        items that went through
+    :param errors:      dict of index to tuple of status code and message
+    :param success:     status code of the items that went through
+    :return:            json object with counters and per item status
+    """
+    items = []
+    for index in range(count):
+        if index in errors:
+            status, message = errors[index]
+            items.append({"index": index, "status": status, "message": message})
+        else:
+            items.append(dict({"index": index, "status": success}, **statuses[index]))
+
+    return {
+        "succeeded": count - len(errors),
+        "failed": len(errors),
+        "items": items,
+    }
@@ -0,0 +1,274 @@
+"""
+This is the cache module and supports caching the responses of the read
+endpoints, invalidated by the writes to the directors and movies data.
+The memory backend only sees the writes of its own worker, with CACHE_STAMP
+set it drops its entries once the stamp of the catalog (snapshot.py)
+moved, which it reads before serving an entry older than
+CACHE_STAMP_INTERVAL seconds; the redis backend shares the invalidations
+of all the workers.
+"""
+
+import functools
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+from sqlalchemy import event
+from config import app, db
+import conditional
+import snapshot
+
+
+class MemoryBackend:
+    """
+    In-process LRU cache, entries expire after ttl seconds and the least
+    recently used entry is dropped past max_entries. With an interval the
+    writes of the other workers are seen from the stamp of the catalog: an
+    entry older than interval seconds is only served once the stamp was
+    read again.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60, interval=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.interval = interval
+        self.entries = OrderedDict()
+        # generations are never evicted, losing one would revive old entries
+        self.generations = {}
+        self.lock = threading.Lock()
+        # stamp read at the last check, and the writes of this worker since
+        self.version = None
+        self.checked = 0.0
+        self.written = 0
+
+    def _check(self):
+        # One query per interval tells whether another worker wrote
+        checked = time.monotonic()
+        with db.engine.connect() as connection:
+            version = snapshot.read_version(connection)
+        with self.lock:
+            if self.version is None or version != self.version + self.written:
+                self.entries.clear()
+            self.version, self.checked, self.written = version, checked, 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, stored, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            stale = (self.interval is not None
+                     and max(stored, self.checked) < time.monotonic() - self.interval)
+            if not stale:
+                self.entries.move_to_end(key)
+        if stale:
+            self._check()
+            with self.lock:
+                if key not in self.entries:
+                    return None
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            now = time.monotonic()
+            self.entries[key] = (now + self.ttl, now, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def generation(self, names):
+        with self.lock:
+            return [self.generations.get(name, 0) for name in names]
+
+    def bump(self, names, moved=False):
+        """
+        :param names:   tags of the data changed by a write
+        :param moved:   the write moved the stamp of the catalog too
+        """
+        with self.lock:
+            for name in names:
+                self.generations[name] = self.generations.get(name, 0) + 1
+            if moved:
+                self.written += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisBackend:
+    """
+    Cache shared by all the workers, stored in a Redis compatible client
+    (anything with get, set(ex=), mget and incr)
+    """
+
+    def __init__(self, client, ttl=60, prefix="movies-api:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def generation(self, names):
+        values = self.client.mget([self.prefix + "gen:" + name for name in names])
+        return [0 if value is None else int(value) for value in values]
+
+    def bump(self, names, moved=False):
+        # the generations are shared, every worker sees every write
+        for name in names:
+            self.client.incr(self.prefix + "gen:" + name)
+
+    def clear(self):
+        # entries keyed by the current generations become unreachable
+        self.bump(["all"])
+
+    def __len__(self):
+        return -1
+
+
+def create_backend(config):
+    """
+    Build the cache backend chosen by the CACHE_BACKEND setting
+
+    :param config:  Flask config with the CACHE_* settings
+    :return:        backend, None when caching is off
+    """
+    name = config["CACHE_BACKEND"]
+    if name == "memory":
+        interval = config["CACHE_STAMP_INTERVAL"] if config["CACHE_STAMP"] else None
+        return MemoryBackend(config["CACHE_MAX_ENTRIES"], config["CACHE_TTL"], interval)
+    if name == "redis":
+        import redis
+        return RedisBackend(redis.Redis.from_url(config["CACHE_REDIS_URL"]), config["CACHE_TTL"])
+    return None
+
+
+backend = create_backend(app.config)
+
+stats = {"hits": 0, "misses": 0, "invalidations": 0}
+stats_lock = threading.Lock()
+
+
+def _count(name):
+    # the requests of a worker run in many threads
+    with stats_lock:
+        stats[name] += 1
+
+
+def _copy(response):
+    # Flask adds the headers of a response tuple to its Response object,
+    # every request gets its own so the cached one never changes
+    if isinstance(response, tuple) and isinstance(response[0], Response):
+        body = response[0]
+        return (Response(body.get_data(), status=body.status_code, mimetype=body.mimetype),) + response[1:]
+    return response
+
+
+def cached(*tags):
+    """
+    Decorator caching the response of a read endpoint under its path and
+    query string. Tags name the data the response is built from and may
+    use the endpoint arguments, e.g. "director:{id}"; the entry is dropped
+    as soon as a write invalidates one of them.
+
+    :param tags:    data the response depends on
+    :return:        decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(**kwargs):
+            if backend is None:
+                return function(**kwargs)
+
+            names = ["all"] + [tag.format(**kwargs) for tag in tags]
+            generations = backend.generation(names)
+            key = "{}?{}|{}".format(
+                request.path,
+                "&".join(sorted("{}={}".format(*arg) for arg in request.args.items(multi=True))),
+                ",".join("{}:{}".format(*pair) for pair in zip(names, generations)),
+            )
+
+            response = backend.get(key)
+            if response is not None:
+                _count("hits")
+                return conditional.revalidate(_copy(response))
+
+            _count("misses")
+            response = function(**kwargs)
+            # a 304 only makes sense to the client that sent the validator
+            if getattr(response, "status_code", None) != 304:
+                backend.set(key, response)
+            return _copy(response)
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*tags):
+    """
+    Drop the cached responses built from tags once the current database
+    transaction commits
+
+    :param tags:    data changed by the write, e.g. "director:7110"
+    """
+    db.session.info.setdefault("cache_tags", set()).update(tags)
+
+
+@event.listens_for(db.session, "after_commit")
+def _after_commit(session):
+    # a savepoint of a group commit batch (writer.py), the tags wait for
+    # the transaction
+    if session.in_nested_transaction():
+        return
+    tags = session.info.pop("cache_tags", None)
+    moved = session.info.pop("catalog_moved", False)
+    if tags and backend is not None:
+        backend.bump(sorted(tags), moved)
+        _count("invalidations")
+
+
+@event.listens_for(db.session, "after_rollback")
+def _after_rollback(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop("cache_tags", None)
+    session.info.pop("catalog_moved", None)
+
+
+def clear():
+    """
+    Drop every cached response
+    """
+    if backend is not None:
+        backend.clear()
+
+
+def read_stats():
+    """
+    This function responds to a request for /api/cache
+    with the hit and miss counters of the response cache
+
+    :return:        json object with the cache counters
+    """
+    return {
+        "backend": app.config["CACHE_BACKEND"],
+        "entries": len(backend) if backend is not None else 0,
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "invalidations": stats["invalidations"],
+    }
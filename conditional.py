@@ -0,0 +1,91 @@
+"""
+This is the conditional module and supports the HTTP conditional requests
+(ETag / If-None-Match / Last-Modified) of the read endpoints
+"""
+
+import hashlib
+
+from flask import make_response, request
+from werkzeug.http import http_date, parse_date
+
+
+# clients and CDN may keep a copy but have to revalidate it on every use
+CACHE_CONTROL = "public, no-cache"
+
+
+def etag(*versions):
+    """
+    Strong ETag of the response to the current request, built from the
+    versions of the rows it is serialized from
+
+    :param versions:    row ids and versions the response depends on
+    :return:            quoted ETag string
+    """
+    digest = hashlib.sha1(repr((request.full_path, versions)).encode()).hexdigest()
+    return '"{}"'.format(digest)
+
+
+def headers(tag, last_modified):
+    """
+    Validator and caching headers of a response
+
+    :param tag:             ETag of the response
+    :param last_modified:   datetime of the latest change, may be None
+    :return:                dict of headers
+    """
+    result = {"ETag": tag, "Cache-Control": CACHE_CONTROL}
+    if last_modified is not None:
+        result["Last-Modified"] = http_date(last_modified)
+    return result
+
+
+def check(versions, dates):
+    """
+    Validators of the response built from some rows, and the 304 Not
+    Modified response when the copy of the client is still current. Called
+    before the rows get serialized.
+
+    :param versions:    row ids and versions the response depends on
+    :param dates:       change dates of those rows
+    :return:            tuple of headers dict and 304 response, None when
+                        the client needs the body
+    """
+    tag = etag(*versions)
+    known = [date for date in dates if date is not None]
+    last_modified = max(known) if known else None
+
+    result = headers(tag, last_modified)
+    if not _fresh(tag, last_modified):
+        return result, None
+
+    return result, _not_modified(result)
+
+
+def _fresh(tag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(tag.strip('"'))
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _not_modified(validators):
+    response = make_response("", 304)
+    response.headers.update(validators)
+    return response
+
+
+def revalidate(response):
+    """
+    Answer 304 Not Modified to a client already holding a cached response
+
+    :param response:    response as returned by an endpoint
+    :return:            304 response or the response itself
+    """
+    if isinstance(response, tuple) and len(response) == 3 and "ETag" in response[2]:
+        validators = {key: value for key, value in response[2].items()
+                      if key in ("ETag", "Cache-Control", "Last-Modified")}
+        if _fresh(validators["ETag"], parse_date(validators.get("Last-Modified"))):
+            return _not_modified(validators)
+
+    return response
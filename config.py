@@ -1,24 +1,213 @@
 import os
+import sqlite3
+import tempfile
 import connexion
-from flask_sqlalchemy import SQLAlchemy
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_marshmallow import Marshmallow
+from flask_migrate import Migrate
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine, make_url
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Values the SQLite pragmas accept, they can not be bound as parameters
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SQLITE_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def env_flag(name, default, environ=os.environ):
+    """
+    Read a boolean setting from the environment
+
+    :param name:        environment variable
+    :param default:     value when the variable is not set
+    :param environ:     environment to read the setting from
+    :return:            bool
+    """
+    value = environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def database_url(url):
+    """
+    Normalize a database url, Heroku still hands out postgres:// urls that
+    SQLAlchemy 1.4 does not know anymore
+
+    :param url:     url from the environment
+    :return:        url SQLAlchemy can use
+    """
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(url, environ=os.environ):
+    """
+    Options of the engine of url, read from the DB_* environment variables
+
+    :param url:         database url
+    :param environ:     environment to read the settings from
+    :return:            dict of create_engine keyword arguments
+    """
+    options = {
+        # drop connections killed by the server or a proxy before using them
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True, environ),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+    }
+
+    pool_size = environ.get('DB_POOL_SIZE')
+    if make_url(url).get_backend_name() == 'sqlite':
+        # SQLite runs without a pool unless a size is asked for, pooled
+        # connections move between the threads of a worker
+        if pool_size:
+            options['pool_size'] = int(pool_size)
+            options['connect_args'] = {'check_same_thread': False}
+    else:
+        options['pool_size'] = int(pool_size or 5)
+        options['max_overflow'] = int(environ.get('DB_MAX_OVERFLOW', 10))
+        options['pool_timeout'] = int(environ.get('DB_POOL_TIMEOUT', 30))
+
+    return options
+
+
 # Create the Connexion application instance
 connex_app = connexion.App(__name__, specification_dir=basedir)
 
 # Get the underlying Flask app instance
 app = connex_app.app
 
-# Configure the SQLAlchemy part of the app instance
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'final_pk.db')
+# Configure the SQLAlchemy part of the app instance, the statements are
+# only logged when SQLALCHEMY_ECHO is set
+app.config['SQLALCHEMY_ECHO'] = env_flag('SQLALCHEMY_ECHO', False)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url(os.environ.get(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'final_pk.db')))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+# Reads of the GET requests go to the replica when one is configured
+app.config['SQLALCHEMY_BINDS'] = {}
+if os.environ.get('DATABASE_REPLICA_URL'):
+    app.config['SQLALCHEMY_BINDS']['replica'] = database_url(os.environ['DATABASE_REPLICA_URL'])
+
+# Configure the SQLite connections: WAL lets readers run next to a writer,
+# busy_timeout makes a writer wait for the lock instead of failing
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL').upper()
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+if app.config['SQLITE_JOURNAL_MODE'] not in SQLITE_JOURNAL_MODES:
+    raise ValueError('Unknown SQLITE_JOURNAL_MODE {}'.format(app.config['SQLITE_JOURNAL_MODE']))
+if app.config['SQLITE_SYNCHRONOUS'] not in SQLITE_SYNCHRONOUS:
+    raise ValueError('Unknown SQLITE_SYNCHRONOUS {}'.format(app.config['SQLITE_SYNCHRONOUS']))
+
+# Threads running the requests of an ASGI worker (asgi.py)
+app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 10))
+
+# Per-request metrics (metrics.py), requests slower than the threshold in
+# milliseconds get their sampled stacks dumped, 0 leaves the profiler off
+app.config['METRICS_PROFILE_THRESHOLD'] = int(os.environ.get('METRICS_PROFILE_THRESHOLD', 0))
+app.config['METRICS_PROFILE_INTERVAL'] = int(os.environ.get('METRICS_PROFILE_INTERVAL', 5))
+app.config['METRICS_PROFILE_DIR'] = os.environ.get(
+    'METRICS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'movies-api-profiles'))
+
+# In-process snapshot of the catalog for the point lookups (snapshot.py),
+# the stamp of the database is checked every interval seconds
+app.config['CATALOG_SNAPSHOT'] = env_flag('CATALOG_SNAPSHOT', False)
+app.config['CATALOG_SNAPSHOT_INTERVAL'] = float(os.environ.get('CATALOG_SNAPSHOT_INTERVAL', 1.0))
+
+# Movies nested in a director at most, the rest is paged through
+# /api/directors/{director_id}/movies from the movies_next link
+app.config['FILMOGRAPHY_PAGE_SIZE'] = int(os.environ.get('FILMOGRAPHY_PAGE_SIZE', 10))
+
+# Similar movies (similar.py), the matrix of the movie vectors is built
+# into SIMILAR_INDEX_PATH and memory-mapped by every worker, which checks
+# every SIMILAR_INDEX_INTERVAL seconds whether it has to be built again
+app.config['SIMILAR_INDEX_PATH'] = os.environ.get(
+    'SIMILAR_INDEX_PATH', os.path.join(tempfile.gettempdir(), 'movies-api-similar.npy'))
+app.config['SIMILAR_TEXT_DIMS'] = int(os.environ.get('SIMILAR_TEXT_DIMS', 1024))
+app.config['SIMILAR_INDEX_INTERVAL'] = float(os.environ.get('SIMILAR_INDEX_INTERVAL', 60.0))
+
+# Group commit of the writes (writer.py): the writes arriving within the
+# window in milliseconds are committed together by one writer thread, a
+# request waits for its batch for the timeout in milliseconds at most
+app.config['GROUP_COMMIT'] = env_flag('GROUP_COMMIT', False)
+app.config['GROUP_COMMIT_WINDOW'] = int(os.environ.get('GROUP_COMMIT_WINDOW', 2))
+app.config['GROUP_COMMIT_MAX_BATCH'] = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+app.config['GROUP_COMMIT_QUEUE'] = int(os.environ.get('GROUP_COMMIT_QUEUE', 256))
+app.config['GROUP_COMMIT_TIMEOUT'] = int(os.environ.get('GROUP_COMMIT_TIMEOUT', 30000))
+
+# Compiled swagger.yml the workers load without parsing and validating it
+# (spec.py), built by python spec.py or by the first worker started
+app.config['SPEC_COMPILED_PATH'] = os.environ.get(
+    'SPEC_COMPILED_PATH', os.path.join(basedir, 'swagger.json'))
+
+# Configure the response cache of the read endpoints (memory, redis or none)
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 60))
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+# With more than one worker the memory cache follows the stamp of the
+# catalog, read again before serving an entry older than the interval
+app.config['CACHE_STAMP'] = env_flag('CACHE_STAMP', int(os.environ.get('WEB_CONCURRENCY', 1)) > 1)
+app.config['CACHE_STAMP_INTERVAL'] = float(os.environ.get('CACHE_STAMP_INTERVAL', 1.0))
+
+
+def sqlite_pragmas(dbapi_connection):
+    """
+    Apply the SQLITE_* settings to a new SQLite connection and enforce its
+    foreign keys
+
+    :param dbapi_connection:    sqlite3 connection, or its asyncio adapter
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = {}'.format(app.config['SQLITE_JOURNAL_MODE']))
+    cursor.execute('PRAGMA busy_timeout = {:d}'.format(app.config['SQLITE_BUSY_TIMEOUT']))
+    cursor.execute('PRAGMA synchronous = {}'.format(app.config['SQLITE_SYNCHRONOUS']))
+    # off by default in SQLite, the deletes of directors cascade to their movies
+    cursor.execute('PRAGMA foreign_keys = ON')
+    cursor.close()
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        sqlite_pragmas(dbapi_connection)
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session reading from the replica during GET requests when a replica is
+    configured, everything else goes to the primary database
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if ('replica' in self.app.config['SQLALCHEMY_BINDS'] and not self._flushing
+                and has_request_context() and request.method in ('GET', 'HEAD')):
+            return db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
 
 # Create the SQLAlchemy db instance
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 
 # Initialize Marshmallow
-ma = Marshmallow(app)
\ No newline at end of file
+ma = Marshmallow(app)
+
+# Initialize the database migrations (flask db upgrade)
+migrate = Migrate(app, db, render_as_batch=True)
+
+
+def dispose_engines():
+    """
+    Close the pooled connections of the primary and replica engines, a
+    worker forked from a preloaded app must not use the ones of the master
+    """
+    for bind in [None] + list(app.config['SQLALCHEMY_BINDS']):
+        db.get_engine(app, bind=bind).dispose()
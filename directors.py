@@ -4,30 +4,84 @@ directors and movies data
 """
 
 from flask import make_response, abort, jsonify
+from sqlalchemy.exc import IntegrityError
 from config import db
-from models import Directors, DirectorsSchema, Movies
-
-
-def read_all():
+from models import Directors, DirectorsSchema
+import bulk
+import cache
+import conditional
+import export
+import fieldsets
+import pagination
+import search
+import serializers
+import similar
+import snapshot
+import validation
+import writer
+
+
+# Attributes the directors lists can be sorted by
+SORT_ATTRIBUTES = {
+    'id': Directors.id,
+    'name': Directors.name,
+    'gender': Directors.gender,
+    'uid': Directors.uid,
+    'department': Directors.department,
+}
+
+# Columns of the directors export, in output order
+EXPORT_COLUMNS = [
+    Directors.id,
+    Directors.name,
+    Directors.gender,
+    Directors.uid,
+    Directors.department,
+]
+
+# Checks of the items of the bulk requests, the same as the body of a
+# single write, an update carries the id too
+BULK_CREATE = validation.definition('Director')
+BULK_UPDATE = validation.definition('Director', id='integer')
+
+
+@cache.cached("directors")
+def read_all(cursor=None, fields=None, include=None):
     """
     This function responds to a request for /api/directors
-    with the complete lists of directors order by id asc
+    with the complete lists of directors order by id asc, 10 per page
 
+    :param cursor:  token of the page to get, from the X-Next-Cursor or
+                    X-Prev-Cursor header of a previous page
+    :param fields:  comma separated fields to return, movies.title style
+                    for the fields of the movies
+    :param include: comma separated relations to nest, empty for none
     :return:        json string of list of directors, message data empty
     """
+    fieldset = fieldsets.Fieldset(DirectorsSchema, 'movies', fields, include)
+
     # Create the list of directors from our data
-    directors = Directors.query.order_by(Directors.id).limit(10)
+    directors, next_cursor, prev_cursor = pagination.keyset_page(
+        serializers.DIRECTORS.query(fieldset),
+        [(Directors.id, False)], 10, cursor, 'id:asc')
 
-    # Serialize the data for the response
-    director_schema = DirectorsSchema(many=True)
-    data = director_schema.dump(directors)
-    if(len(data) == 0):
+    if(len(directors) == 0):
         return abort(404, f"Directors data not found!")
 
-    return data
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = conditional.check(
+        [(director.id, director.version) for director in directors],
+        [director.updated_at for director in directors])
+    if not_modified is not None:
+        return not_modified
+
+    # Serialize the data for the response, the movies come in one more query
+    headers.update(pagination.cursor_headers(next_cursor, prev_cursor))
+    return serializers.response(serializers.DIRECTORS.dumps(directors, fieldset), headers)
 
 
-def read_limit(limit, order, attribute):
+@cache.cached("directors")
+def read_limit(limit, order, attribute, cursor=None, fields=None, include=None):
     """
     This function responds to a request for /api/directors
     with the complete lists limit directors order by request (asc or desc)
@@ -36,64 +90,100 @@ def read_limit(limit, order, attribute):
     :param limit:       for size return directors data
     :param order:       asc or desc order
     :param attribute:   request order by attribute in directors
+    :param cursor:      token of the page to get, from the X-Next-Cursor or
+                        X-Prev-Cursor header of a previous page
+    :param fields:      comma separated fields to return, movies.title style
+                        for the fields of the movies
+    :param include:     comma separated relations to nest, empty for none
     :return:            json string of list of limit directors order by req, message data empty
     """
     # check attribute
-    if not hasattr(Directors, attribute):
+    if attribute not in SORT_ATTRIBUTES:
         abort(404, f"Director not found for attribute {attribute}!")
 
-    # Create the list of directors from our data
-    # match attribute:
-    if attribute == 'id':
-        directors = Directors.query.order_by(db.desc(
-            Directors.id) if f'{order}' == 'desc' else db.asc(Directors.id)).limit(limit)
-    elif attribute == 'name':
-        directors = Directors.query.order_by(db.desc(
-            Directors.name) if f'{order}' == 'desc' else db.asc(Directors.name)).limit(limit)
-    elif attribute == 'gender':
-        directors = Directors.query.order_by(db.desc(
-            Directors.gender) if f'{order}' == 'desc' else db.asc(Directors.gender)).limit(limit)
-    elif attribute == 'uid':
-        directors = Directors.query.order_by(db.desc(
-            Directors.uid) if f'{order}' == 'desc' else db.asc(Directors.uid)).limit(limit)
-    elif attribute == 'department':
-        directors = Directors.query.order_by(db.desc(
-            Directors.department) if f'{order}' == 'desc' else db.asc(Directors.department)).limit(limit)
-
-    # Serialize the data for the response
-    director_schema = DirectorsSchema(many=True)
-    data = director_schema.dump(directors)
-
-    if(len(data) == 0):
+    fieldset = fieldsets.Fieldset(DirectorsSchema, 'movies', fields, include)
+
+    # Create the list of directors from our data, the id breaks ties
+    desc = f'{order}' == 'desc'
+    keys = [(SORT_ATTRIBUTES[attribute], desc)]
+    if attribute != 'id':
+        keys.append((Directors.id, desc))
+
+    directors, next_cursor, prev_cursor = pagination.keyset_page(
+        serializers.DIRECTORS.query(fieldset, [attribute]), keys, limit, cursor,
+        '{}:{}'.format(attribute, 'desc' if desc else 'asc'))
+
+    if(len(directors) == 0):
         return abort(404, f"Directors data not found!")
 
-    return data
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = conditional.check(
+        [(director.id, director.version) for director in directors],
+        [director.updated_at for director in directors])
+    if not_modified is not None:
+        return not_modified
+
+    # Serialize the data for the response, the movies come in one more query
+    headers.update(pagination.cursor_headers(next_cursor, prev_cursor))
+    return serializers.response(serializers.DIRECTORS.dumps(directors, fieldset, [attribute]), headers)
 
 
-def read_one(id):
+@cache.cached("director:{id}")
+def read_one(id, fields=None, include=None):
     """
     This function responds to a request for /api/directors/{id}
     with one matching director from directors
 
     :param id:          Id of director to find
+    :param fields:      comma separated fields to return, movies.title style
+                        for the fields of the movies
+    :param include:     comma separated relations to nest, empty for none
     :return:            director matching id, 404 if not found
     """
-    # Build the initial query
-    director = Directors.query.filter(Directors.id == id).one_or_none()
+    fieldset = fieldsets.Fieldset(DirectorsSchema, 'movies', fields, include)
+
+    # The snapshot answers from memory when it is on
+    if snapshot.catalog is not None:
+        director = snapshot.catalog.director(id)
+        if director is None:
+            abort(404, f"Director not found for ID: {id}!")
+
+        headers, not_modified = conditional.check(
+            [(director["id"], director["version"])], [director["updated_at"]])
+        if not_modified is not None:
+            return not_modified
+
+        filmography = snapshot.catalog.filmography(id)
+        director["movies_count"] = len(filmography)
+        data = serializers.DIRECTORS.dump_item(director, filmography, fieldset)
+        return data, 200, headers
+
+    # Build the initial query, the movies load only once the ETag is checked
+    director = (
+        serializers.DIRECTORS.query(fieldset)
+        .filter(Directors.id == id)
+        .one_or_none()
+    )
 
     # Did we find a director?
     if director is not None:
 
-        # Serialize the data for the response
-        director_schema = DirectorsSchema()
-        data = director_schema.dump(director)
-        return data
+        # Answer 304 before loading the movies when the client copy is current
+        headers, not_modified = conditional.check(
+            [(director.id, director.version)], [director.updated_at])
+        if not_modified is not None:
+            return not_modified
+
+        # Serialize the data for the response, with the first page of movies
+        data = serializers.DIRECTORS.dump([director], fieldset)[0]
+        return data, 200, headers
 
     # Otherwise, nope, didn't find that director
     else:
         abort(404, f"Director not found for ID: {id}!")
 
 
+@writer.grouped
 def create(director):
     """
     This function creates a new director in the directors structure
@@ -102,20 +192,17 @@ def create(director):
     :param director:  director to create in directors structure
     :return:          201 on success, 409 on director exists
     """
-
-    name = director.get("name")
-    uid = director.get("uid")
-    gender = director.get("gender")
-    department = director.get("department")
-
-    if name is None or name is "":
-        abort(400, "Field name must be required!")
-    if uid is None or uid is "":
-        abort(400, "Field uid must be required!")
-    if gender is None or gender is "":
-        abort(400, "Field name must be required!")
-    if department is None or department is "":
-        abort(400, "Field name must be required!")
+    # The body was checked against swagger.yml before the call (validation.py)
+    name = director["name"]
+    uid = director["uid"]
+
+    # A director of the snapshot with that name and uid is a conflict
+    # without asking the database
+    if snapshot.catalog is not None:
+        existing_id = snapshot.catalog.director_id_by_uid(uid)
+        existing = None if existing_id is None else snapshot.catalog.director(existing_id)
+        if existing is not None and existing["name"] == name:
+            abort(409, f"Director with name {name} or UID {uid} exists already!")
 
     existing_director = (
         Directors.query.filter(Directors.name == name)
@@ -126,16 +213,20 @@ def create(director):
     # Can we insert this director?
     if existing_director is None:
 
-        # Create a director instance using the schema and the passed in director
-        schema = DirectorsSchema()
-        new_director = schema.load(director, session=db.session)
+        # Create a director instance from the passed in director
+        new_director = Directors(**director)
 
         # Add the director to the database
         db.session.add(new_director)
-        db.session.commit()
+        db.session.flush()
+        cache.invalidate("directors")
 
-        # Serialize and return the newly created director in the response
-        data = schema.dump(new_director)
+        # Serialize and return the newly created director in the response,
+        # read in the same transaction
+        fieldset = fieldsets.Fieldset(DirectorsSchema, 'movies')
+        row = serializers.DIRECTORS.query(fieldset).filter(Directors.id == new_director.id).one()
+        data = serializers.DIRECTORS.dump([row], fieldset)[0]
+        writer.commit()
 
         return data, 201
 
@@ -144,57 +235,57 @@ def create(director):
         abort(409, f"Director with name {name} or UID {uid} exists already!")
 
 
+def _update(id, values):
+    # One UPDATE, the database checks the uid is still unique
+    try:
+        found = bulk.update_row(db.session, Directors.__table__, id, values)
+    except IntegrityError:
+        writer.rollback()
+        abort(409, f"Director with UID {values.get('uid')} exists already!")
+
+    # Did we find an existing director?
+    if not found:
+        abort(404, f"Director not found for ID: {id}!")
+
+    cache.invalidate("directors", "movies", "director:{}".format(id))
+
+    # return updated director in the response, read in the same transaction
+    fieldset = fieldsets.Fieldset(DirectorsSchema, 'movies')
+    row = serializers.DIRECTORS.query(fieldset).filter(Directors.id == id).one()
+    data = serializers.DIRECTORS.dump([row], fieldset)[0]
+    writer.commit()
+
+    return data, 200
+
+
+@writer.grouped
 def update(id, director):
     """
     This function updates an existing director in the directors structure
 
     :param id:          Id of the director to update in the directors structure
     :param director:    director to update
-    :return:            updated director structure, 404 if not found
-    """
-    name = director.get("name")
-    uid = director.get("uid")
-    gender = director.get("gender")
-    department = director.get("department")
-
-    if name is None or name is "":
-        abort(400, "Field name must be required!")
-    if uid is None or uid is "":
-        abort(400, "Field uid must be required!")
-    if gender is None or gender is "":
-        abort(400, "Field gender must be required!")
-    if department is None or department is "":
-        abort(400, "Field department must be required!")
-
-    # Get the director requested from the db into session
-    update_director = Directors.query.filter(
-        Directors.id == id
-    ).one_or_none()
-
-    # Did we find an existing director?
-    if update_director is not None:
-
-        # turn the passed in director into a db object
-        schema = DirectorsSchema()
-        update = schema.load(director, session=db.session)
-
-        # Set the id to the director we want to update
-        update.id = update_director.id
-
-        # merge the new object into the old and commit it to the db
-        db.session.merge(update)
-        db.session.commit()
+    :return:            updated director structure, 404 if not found, 409 if
+                        another director has the uid
+    """
+    return _update(id, director)
 
-        # return updated director in the response
-        data = schema.dump(update_director)
 
-        return data, 200
+@writer.grouped
+def patch(id, director):
+    """
+    This function updates the fields sent of an existing director in the
+    directors structure, the other fields keep their value
 
-    # Otherwise, nope, didn't find that director
-    else:
-        abort(404, f"Director not found for ID: {id}!")
+    :param id:          Id of the director to update in the directors structure
+    :param director:    fields of the director to update
+    :return:            updated director structure, 404 if not found, 409 if
+                        another director has the uid
+    """
+    return _update(id, director)
 
 
+@writer.grouped
 def delete(id):
     """
     This function deletes a director from the directors structure
@@ -202,13 +293,15 @@ def delete(id):
     :param director_id:   Id of the director to delete
     :return:            200 on successful delete, 404 if not found
     """
-    # Get the director requested
-    director = Directors.query.filter(Directors.id == id).one_or_none()
+    # One DELETE, the database deletes the movies and the stats of the
+    # director with it
+    deleted = db.session.execute(Directors.__table__.delete().where(Directors.id == id))
 
     # Did we find a director?
-    if director is not None:
-        db.session.delete(director)
-        db.session.commit()
+    if deleted.rowcount > 0:
+        cache.invalidate("directors", "movies", "director:{}".format(id))
+        similar.deleted_directors([id])
+        writer.commit()
         return make_response(f"Director with ID {id} deleted successfully!", 200)
 
     # Otherwise, nope, didn't find that director
@@ -216,20 +309,165 @@ def delete(id):
         abort(404, f"Director not found for ID: {id}!")
 
 
-def search_all(keyword):
-    """search data by field name with like
+@writer.grouped
+def bulk_create(directors):
+    """
+    This function creates many directors in the directors structure in
+    one transaction, from a JSON array or NDJSON body
 
-    Keyword arguments:  keyword -- word for search data use like
-    Return: data directors with name like keyword
+    :param directors:   directors to create
+    :return:            status of every director, 201 with its id when created,
+                        400 if invalid, 409 if it exists already
+    """
+    items = bulk.read_items(directors)
+    rows, errors = bulk.validate(items, BULK_CREATE)
+
+    # One query finds the directors that exist already
+    existing = {
+        (director.name, director.uid) for director in bulk.select_in(
+            db.session, [Directors.name, Directors.uid], Directors.uid,
+            [row['uid'] for _, row in rows])
+    }
+
+    inserts = []
+    for index, row in rows:
+        key = (row['name'], row['uid'])
+        if key in existing:
+            errors[index] = (409, "Director with name {} or UID {} exists already!".format(*key))
+        else:
+            existing.add(key)
+            inserts.append((index, row))
+
+    statuses = {}
+    if len(inserts) > 0:
+        db.session.execute(Directors.__table__.insert(), [row for _, row in inserts])
+
+        # Read back the ids given by the database
+        ids = {
+            (director.name, director.uid): director.id for director in bulk.select_in(
+                db.session, [Directors.id, Directors.name, Directors.uid], Directors.uid,
+                [row['uid'] for _, row in inserts])
+        }
+        statuses = {index: {'id': ids[(row['name'], row['uid'])]} for index, row in inserts}
+
+        cache.invalidate("directors")
+        writer.commit()
+
+    return bulk.result(len(items), statuses, errors, 201), 200
+
+
+@writer.grouped
+def bulk_update(directors):
     """
-    search = "%{}%".format(keyword)
-    directors = Directors.query.filter(Directors.name.like(search)).all()
+    This function updates many existing directors in the directors
+    structure in one transaction, from a JSON array or NDJSON body
 
-    # Serialize the data for the response
-    director_schema = DirectorsSchema(many=True)
-    data = director_schema.dump(directors)
+    :param directors:   directors to update, each with its id
+    :return:            status of every director, 200 when updated,
+                        400 if invalid, 404 if not found
+    """
+    items = bulk.read_items(directors)
+    rows, errors = bulk.validate(items, BULK_UPDATE)
+
+    # One query finds the directors to update
+    found = {
+        director.id for director in bulk.select_in(
+            db.session, [Directors.id], Directors.id, [row['id'] for _, row in rows])
+    }
+
+    updates, seen = [], set()
+    for index, row in rows:
+        if row['id'] not in found:
+            errors[index] = (404, "Director not found for ID: {}!".format(row['id']))
+        elif row['id'] in seen:
+            errors[index] = (409, "Director with ID {} is listed twice!".format(row['id']))
+        else:
+            seen.add(row['id'])
+            updates.append((index, row))
+
+    if len(updates) > 0:
+        bulk.update_rows(db.session, Directors.__table__, [row for _, row in updates])
+        cache.invalidate("directors", "movies", *["director:{}".format(id) for id in seen])
+        writer.commit()
+
+    statuses = {index: {'id': row['id']} for index, row in updates}
+    return bulk.result(len(items), statuses, errors, 200), 200
+
+
+@writer.grouped
+def bulk_delete(directors=None):
+    """
+    This function deletes many directors and their movies from the
+    directors structure in one transaction, from a JSON array or NDJSON
+    body of ids
+
+    :param directors:   ids of the directors to delete
+    :return:            status of every director, 200 when deleted,
+                        400 if invalid, 404 if not found
+    """
+    items = bulk.read_items(directors)
+    ids, errors = bulk.validate_ids(items)
+
+    found = {
+        director.id for director in bulk.select_in(
+            db.session, [Directors.id], Directors.id, [id for _, id in ids])
+    }
+
+    deletes = set()
+    for index, id in ids:
+        if id in found:
+            deletes.add(id)
+        else:
+            errors[index] = (404, "Director not found for ID: {}!".format(id))
+
+    if len(deletes) > 0:
+        # The database deletes the movies and the stats of the directors
+        # with them
+        for chunk in bulk.chunks(deletes):
+            db.session.execute(Directors.__table__.delete().where(Directors.id.in_(chunk)))
+        cache.invalidate("directors", "movies", *["director:{}".format(id) for id in deletes])
+        similar.deleted_directors(deletes)
+        writer.commit()
+
+    statuses = {index: {'id': id} for index, id in ids if index not in errors}
+    return bulk.result(len(items), statuses, errors, 200), 200
+
+
+def export_all(format='ndjson'):
+    """
+    This function responds to a request for /api/directors/export
+    with every director streamed as NDJSON or CSV, sorted by id asc
+
+    :param format:      ndjson (one json object per line) or csv
+    :return:            chunked response with all the directors
+    """
+    return export.stream(EXPORT_COLUMNS, Directors.id, format, 'directors')
 
-    if(len(data) == 0):
+
+@cache.cached("directors")
+def search_all(keyword, limit=None, fields=None, include=None):
+    """search data by field name with the full-text index
+
+    Keyword arguments:  keyword -- words for search data, matched as prefixes
+                        limit -- maximum number of directors to return
+                        fields -- comma separated fields to return
+                        include -- comma separated relations to nest
+    Return: data directors with name matching keyword, best match first
+    """
+    fieldset = fieldsets.Fieldset(DirectorsSchema, 'movies', fields, include)
+    directors = search.search_directors(keyword, limit, serializers.DIRECTORS.query(fieldset))
+
+    if(len(directors) == 0):
         return abort(404, f"Directors data not found with keyword {keyword}!")
 
-    return data
\ No newline at end of file
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = conditional.check(
+        [(director.id, director.version) for director in directors],
+        [director.updated_at for director in directors])
+    if not_modified is not None:
+        return not_modified
+
+    # Serialize the data for the response, the movies come in one more query
+    data = serializers.DIRECTORS.dump(directors, fieldset)
+
+    return data, 200, headers
\ No newline at end of file
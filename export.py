@@ -0,0 +1,116 @@
+"""
+This is the export module and supports streaming the full directors and
+movies tables as NDJSON or CSV
+"""
+
+import csv
+import io
+import json
+from datetime import date
+
+from flask import Response, stream_with_context
+from sqlalchemy import select
+from config import db
+
+
+# Rows fetched from the database cursor and written out per chunk
+CHUNK_SIZE = 1000
+
+MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _json_value(value):
+    # dates are written in ISO format, like the CSV and the API responses
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError("Value {!r} is not JSON serializable".format(value))
+
+
+def encoder(names, format):
+    """
+    Encoder turning the rows of an export into text chunks
+
+    :param names:   column names, in output order
+    :param format:  "ndjson" or "csv"
+    :return:        tuple of the first chunk (the csv header) and a function
+                    encoding a list of rows into one chunk
+    """
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+
+        def encode(rows):
+            writer.writerows(rows)
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return chunk
+
+        return encode([names]), encode
+
+    def encode(rows):
+        return "".join(
+            json.dumps(dict(zip(names, row)), separators=(",", ":"), default=_json_value) + "\n"
+            for row in rows
+        )
+
+    return "", encode
+
+
+def statement(columns, order_by):
+    """
+    Select of an export, plain rows without ORM objects
+
+    :param columns:     table columns to export, in output order
+    :param order_by:    column sorting the rows
+    :return:            select statement
+    """
+    return select(*columns).order_by(order_by)
+
+
+def headers(format, filename):
+    """
+    Headers of an export response besides its content type
+
+    :param format:      "ndjson" or "csv"
+    :param filename:    base name of the downloaded file
+    :return:            dict of headers
+    """
+    return {"Content-Disposition": "attachment; filename={}.{}".format(filename, format)}
+
+
+def _stream(columns, order_by, format):
+    first, encode = encoder([column.key for column in columns], format)
+
+    # The connection is held for the life of the response only
+    with db.session.get_bind().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            statement(columns, order_by))
+
+        if first:
+            yield first
+
+        for rows in result.yield_per(CHUNK_SIZE).partitions():
+            yield encode(rows)
+
+
+def stream(columns, order_by, format, filename):
+    """
+    Response streaming every row of columns, fetched from a server side
+    cursor CHUNK_SIZE rows at a time, so memory stays flat whatever the
+    size of the table
+
+    :param columns:     table columns to export, in output order
+    :param order_by:    column sorting the rows
+    :param format:      "ndjson" or "csv"
+    :param filename:    base name of the downloaded file
+    :return:            chunked response
+    """
+    return Response(
+        stream_with_context(_stream(columns, order_by, format)),
+        mimetype=MIMETYPES[format],
+        headers=headers(format, filename),
+    )
@@ -0,0 +1,141 @@
+"""
+This is the fieldsets module and supports the fields and include query
+parameters of the read endpoints, trimming both the SQL columns and the
+serialized output to what the client asks for
+"""
+
+import functools
+
+from flask import abort
+from sqlalchemy.orm import load_only
+
+
+def parse(value):
+    """
+    Read a comma separated list of names from a query parameter
+
+    :param value:   query parameter value, None when not sent
+    :return:        sorted tuple of names, None when not sent
+    """
+    if value is None:
+        return None
+    return tuple(sorted({name.strip() for name in value.split(",") if name.strip()}))
+
+
+@functools.lru_cache(maxsize=256)
+def schema(schema_class, only, exclude, many):
+    """
+    Schema instance trimmed to the requested fields, built once per
+    combination since building a schema is far slower than using it
+
+    :param schema_class:    marshmallow schema class
+    :param only:            tuple of fields to dump, dotted for nested ones,
+                            None for all
+    :param exclude:         tuple of fields to leave out
+    :param many:            dump a list
+    :return:                schema instance
+    """
+    return schema_class(only=only, exclude=exclude, many=many)
+
+
+class Fieldset:
+    """
+    Fields of one resource and of the relation nested in it, as asked by
+    the fields and include query parameters of a request
+    """
+
+    def __init__(self, schema_class, relation, fields=None, include=None):
+        """
+        :param schema_class:    schema of the resource
+        :param relation:        name of the nested relation
+        :param fields:          value of the fields query parameter, like
+                                "id,title,directors.name"
+        :param include:         value of the include query parameter, the
+                                relations to nest, empty for none
+        """
+        names = parse(fields)
+        includes = parse(include)
+        own, related = _fields(schema_class, relation)
+
+        for name in includes or ():
+            if name != relation:
+                abort(400, f"Unknown relation {name}!")
+
+        top, nested = None, None
+        if names is not None:
+            top = [name for name in names if "." not in name and name != relation]
+            nested = [name.split(".", 1)[1] for name in names if "." in name]
+            for name in top:
+                if name not in own:
+                    abort(400, f"Unknown field {name}!")
+            for name in names:
+                if "." in name and (name.split(".", 1)[0] != relation
+                                    or name.split(".", 1)[1] not in related):
+                    abort(400, f"Unknown field {name}!")
+            if relation in names:
+                nested = None
+            elif len(nested) == 0:
+                includes = ()
+
+        self.relation = relation
+        self.nest = includes is None or relation in includes
+        # None stands for every field
+        self.columns = top
+        self.related_columns = nested if self.nest else []
+
+    def schema(self, schema_class, many=False):
+        """
+        Cached schema dumping the requested fields only
+
+        :param schema_class:    schema of the resource
+        :param many:            dump a list
+        :return:                schema instance
+        """
+        if not self.nest:
+            only = None if self.columns is None else tuple(self.columns)
+            return schema(schema_class, only, (self.relation,), many)
+
+        if self.columns is None and self.related_columns is None:
+            return schema(schema_class, None, (), many)
+
+        own = _fields(schema_class, self.relation)[0] if self.columns is None else self.columns
+        own = list(own)
+        if self.related_columns is None:
+            nested = [self.relation]
+        else:
+            nested = ["{}.{}".format(self.relation, name) for name in self.related_columns]
+        return schema(schema_class, tuple(sorted(own + nested)), (), many)
+
+    def options(self, loader, required=(), related_required=(), needs_relation=False):
+        """
+        Loader options fetching the requested columns only
+
+        :param loader:              eager loader option of the relation
+        :param required:            columns the endpoint needs besides the
+                                    requested ones, like the sort key
+        :param related_required:    columns of the relation it needs, like
+                                    the foreign key
+        :param needs_relation:      load the relation even when not nested,
+                                    its versions make the ETag
+        :return:                    list of options for Query.options
+        """
+        options = []
+        if self.columns is not None:
+            options.append(load_only(*_names(self.columns, required)))
+
+        if self.nest and self.related_columns is None:
+            options.append(loader)
+        elif self.nest or needs_relation:
+            options.append(loader.load_only(*_names(self.related_columns or [], related_required)))
+        return options
+
+
+@functools.lru_cache(maxsize=None)
+def _fields(schema_class, relation):
+    fields = schema_class().fields
+    return set(fields) - {relation}, set(fields[relation].schema.fields)
+
+
+def _names(columns, required):
+    # id, version and updated_at make the ETag of every response
+    return set(columns) | {"id", "version", "updated_at"} | set(required)
@@ -0,0 +1,157 @@
+"""
+This is the filters module and supports the filter and sort query
+parameters of the movies list, compiled to SQL expressions on the model
+columns so the database filters and sorts with its indexes.
+
+The filter is a list of conditions joined by ";", FIQL style:
+
+    budget=gt=50000000;release_date=ge=2010-01-01;vote_count=gt=1000
+    director_id=in=(7110,7111);title==Avatar;revenue!=null
+
+The sort is a list of columns, "-" in front for descending:
+
+    -budget,release_date
+"""
+
+import re
+from datetime import date, datetime
+
+from flask import abort
+
+
+# Comparison of each operator, the value is already typed
+COMPARISONS = {
+    "==": lambda column, value: column.is_(None) if value is None else column == value,
+    "!=": lambda column, value: column.isnot(None) if value is None else column != value,
+    "=gt=": lambda column, value: column > value,
+    "=ge=": lambda column, value: column >= value,
+    "=lt=": lambda column, value: column < value,
+    "=le=": lambda column, value: column <= value,
+    "=in=": lambda column, values: column.in_(values),
+    "=out=": lambda column, values: column.notin_(values),
+}
+
+# Operators taking a (a,b,c) list of values
+LIST_OPERATORS = ("=in=", "=out=")
+
+# Operators allowing the null value
+NULL_OPERATORS = ("==", "!=")
+
+# Field, operator and value of one condition
+CONDITION = re.compile(r"^(\w+)(==|!=|=gt=|=ge=|=lt=|=le=|=in=|=out=)(.*)$")
+
+# Values of an =in= list at most, SQLite caps the bound parameters
+MAX_VALUES = 500
+
+
+def _value(column, text):
+    kind = column.type.python_type
+    try:
+        if kind is int:
+            return int(text)
+        if kind is float:
+            return float(text)
+        if kind is date:
+            return date.fromisoformat(text)
+        if kind is datetime:
+            return datetime.fromisoformat(text)
+    except ValueError:
+        abort(400, f"Invalid value {text} for {column.key}!")
+    return text
+
+
+def parse_filter(expression, columns):
+    """
+    Read a filter query parameter
+
+    :param expression:  value of the filter parameter, None when not sent
+    :param columns:     dict of the names that can be filtered on to their
+                        column
+    :return:            list of SQL conditions, all of them have to match
+    """
+    if expression is None:
+        return []
+
+    conditions = []
+    for text in expression.split(";"):
+        match = CONDITION.match(text.strip())
+        if match is None:
+            abort(400, f"Invalid filter {text}!")
+        name, operator, value = match.groups()
+        if name not in columns:
+            abort(400, f"Unknown filter field {name}!")
+        column = columns[name]
+
+        if operator in LIST_OPERATORS:
+            if not (value.startswith("(") and value.endswith(")")):
+                abort(400, f"Filter {name}{operator} needs a (a,b) list of values!")
+            values = [_value(column, item.strip()) for item in value[1:-1].split(",") if item.strip()]
+            if not values or len(values) > MAX_VALUES:
+                abort(400, f"Filter {name}{operator} takes 1 to {MAX_VALUES} values!")
+            conditions.append(COMPARISONS[operator](column, values))
+        elif value == "null":
+            if operator not in NULL_OPERATORS:
+                abort(400, f"Filter {name}{operator} does not take null!")
+            conditions.append(COMPARISONS[operator](column, None))
+        else:
+            conditions.append(COMPARISONS[operator](column, _value(column, value)))
+
+    return conditions
+
+
+def parse_sort(expression, columns, tiebreaker):
+    """
+    Read a sort query parameter
+
+    :param expression:  value of the sort parameter, like "-budget,title"
+    :param columns:     dict of the names that can be sorted by to their
+                        column
+    :param tiebreaker:  unique column ending the sort when missing, it
+                        follows the direction of the last column
+    :return:            list of (column, descending) sort keys
+    """
+    keys = []
+    for name in expression.split(","):
+        name = name.strip()
+        desc = name.startswith("-")
+        name = name.lstrip("+-")
+        if name not in columns:
+            abort(400, f"Unknown sort field {name}!")
+        if any(column is columns[name] for column, _ in keys):
+            abort(400, f"Sort field {name} is repeated!")
+        keys.append((columns[name], desc))
+
+    if not any(column is tiebreaker for column, _ in keys):
+        keys.append((tiebreaker, keys[-1][1]))
+    return keys
+
+
+def date_range(column, start=None, end=None):
+    """
+    Conditions of the released_from and released_to query parameters,
+    both days included, a range the (date, id) index of column seeks
+
+    :param column:      date column
+    :param start:       first day as an ISO string, None for no bound
+    :param end:         last day as an ISO string, None for no bound
+    :return:            list of SQL conditions
+    """
+    conditions = []
+    if start is not None:
+        conditions.append(column >= _value(column, start))
+    if end is not None:
+        conditions.append(column <= _value(column, end))
+    return conditions
+
+
+def signature(keys, *parameters):
+    """
+    Sort and filter a cursor belongs to, a cursor of another list is
+    refused by pagination.decode_cursor
+
+    :param keys:        list of (column, descending) sort keys
+    :param parameters:  values of the filtering query parameters
+    :return:            string
+    """
+    sort = ",".join("{}:{}".format(column.key, "desc" if desc else "asc") for column, desc in keys)
+    return "|".join([sort] + [parameter or "" for parameter in parameters])
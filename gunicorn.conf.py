@@ -0,0 +1,26 @@
+"""
+Settings of gunicorn, read from the working directory (Procfile)
+
+With PRELOAD_APP set (the default) the master imports the app once,
+swagger.yml, the models, the full-text index and the catalog snapshot
+included, and forks the workers from it: they start at once and share
+the memory of the master. Every worker drops the database connections it
+inherited before its first request.
+"""
+
+import os
+import sys
+
+# gunicorn reads PORT and WEB_CONCURRENCY itself
+preload_app = os.environ.get("PRELOAD_APP", "1").strip().lower() in ("1", "true", "yes", "on")
+
+
+def when_ready(server):
+    # the master is done with the connections of the preloading
+    if "config" in sys.modules:
+        sys.modules["config"].dispose_engines()
+
+
+def post_fork(server, worker):
+    if "config" in sys.modules:
+        sys.modules["config"].dispose_engines()
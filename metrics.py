@@ -0,0 +1,386 @@
+"""
+This is the metrics module and supports the timing of every request by
+phase, served at /metrics in the Prometheus text format:
+
+    validation      connexion parsing and validating the request
+    sql             statements sent to the database, with their count
+    serialization   marshmallow dumps and the encoding of the response
+    orm             the rest of the handler, mostly ORM hydration
+
+With METRICS_PROFILE_THRESHOLD set, the stacks of every request are sampled
+and the requests slower than the threshold are dumped in the collapsed
+stack format of flamegraph.pl / speedscope to METRICS_PROFILE_DIR.
+The numbers are kept per worker process.
+"""
+
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from connexion.apis.flask_utils import flaskify_endpoint
+from connexion.utils import get_function_from_name
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import app
+
+
+# Upper bounds of the request duration histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the group commit batch size histogram (writer.py)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# operationIds by the name of their Flask endpoint
+OPERATIONS = {}
+
+
+class Registry:
+    """
+    Counters of the requests served by this process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter()
+            self.buckets = defaultdict(lambda: [0] * len(BUCKETS))
+            self.durations = Counter()
+            self.counts = Counter()
+            self.phases = Counter()
+            self.queries = Counter()
+            self.batch_buckets = [0] * len(BATCH_BUCKETS)
+            self.batch_sizes = 0
+            self.batches = 0
+            self.wait_buckets = [0] * len(BUCKETS)
+            self.waits = 0.0
+            self.waited = 0
+
+    def observe(self, operation, method, status, duration, phases, queries):
+        with self.lock:
+            self.requests[(operation, method, status)] += 1
+            buckets = self.buckets[operation]
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            self.durations[operation] += duration
+            self.counts[operation] += 1
+            for name, seconds in phases.items():
+                self.phases[(operation, name)] += seconds
+            self.queries[operation] += queries
+
+    def observe_batch(self, size, waits):
+        with self.lock:
+            for index, bound in enumerate(BATCH_BUCKETS):
+                if size <= bound:
+                    self.batch_buckets[index] += 1
+            self.batch_sizes += size
+            self.batches += 1
+            for wait in waits:
+                for index, bound in enumerate(BUCKETS):
+                    if wait <= bound:
+                        self.wait_buckets[index] += 1
+                self.waits += wait
+                self.waited += 1
+
+
+registry = Registry()
+
+
+class Sampler(threading.Thread):
+    """
+    Sampling profiler, records the stack of every request thread each
+    interval seconds while the request runs
+    """
+
+    def __init__(self, interval):
+        super().__init__(name="metrics-sampler", daemon=True)
+        self.interval = interval
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def begin(self, ident):
+        with self.lock:
+            self.samples[ident] = Counter()
+
+    def end(self, ident):
+        with self.lock:
+            return self.samples.pop(ident, Counter())
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, samples in self.samples.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_stack(frame)] += 1
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+_sampler = None
+
+
+def sampler():
+    """
+    Sampling profiler of the process, started on first use, None when
+    METRICS_PROFILE_THRESHOLD is not set
+
+    :return:    Sampler
+    """
+    global _sampler
+    if not app.config["METRICS_PROFILE_THRESHOLD"]:
+        return None
+    if _sampler is None:
+        _sampler = Sampler(app.config["METRICS_PROFILE_INTERVAL"] / 1000.0)
+        _sampler.start()
+    return _sampler
+
+
+def dump_profile(samples, operation, duration):
+    """
+    Write the stacks sampled during a slow request to METRICS_PROFILE_DIR
+
+    :param samples:     Counter of collapsed stacks
+    :param operation:   operationId of the request
+    :param duration:    duration of the request in seconds
+    :return:            path of the file
+    """
+    directory = app.config["METRICS_PROFILE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "{}-{}-{}-{}ms.folded".format(
+        time.strftime("%Y%m%d%H%M%S"), os.getpid(), operation, int(duration * 1000)))
+    with open(path, "w") as profile:
+        for stack, count in samples.most_common():
+            profile.write("{} {}\n".format(stack, count))
+    return path
+
+
+class _Request:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.operation = None
+        self.handler_start = None
+        self.handler_end = None
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.serialization = 0.0
+        self.depth = 0
+
+
+def _current():
+    if has_request_context():
+        return g.get("metrics")
+    return None
+
+
+def resolve(operation_id):
+    """
+    Function resolver of connexion, times the handler of every operation
+
+    :param operation_id:    operationId in swagger.yml
+    :return:                handler function
+    """
+    function = get_function_from_name(operation_id)
+    OPERATIONS[flaskify_endpoint(operation_id)] = operation_id
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        metrics = _current()
+        if metrics is None:
+            return function(*args, **kwargs)
+        metrics.operation = operation_id
+        metrics.handler_start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics.handler_end = time.perf_counter()
+
+    return wrapper
+
+
+class phase:
+    """
+    Context manager adding the time of its block, besides the SQL sent
+    meanwhile, to the serialization phase of the current request. Nested
+    blocks count once.
+    """
+
+    def __enter__(self):
+        self.metrics = _current()
+        if self.metrics is not None:
+            self.metrics.depth += 1
+            if self.metrics.depth == 1:
+                self.start = time.perf_counter()
+                self.sql_time = self.metrics.sql_time
+        return self
+
+    def __exit__(self, *exc):
+        if self.metrics is not None:
+            self.metrics.depth -= 1
+            if self.metrics.depth == 0:
+                elapsed = time.perf_counter() - self.start
+                self.metrics.serialization += elapsed - (self.metrics.sql_time - self.sql_time)
+
+
+class TimedSchema:
+    """
+    Schema mixin counting dump in the serialization phase
+    """
+
+    def dump(self, obj, *, many=None):
+        with phase():
+            return super().dump(obj, many=many)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["metrics_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("metrics_start", None)
+    metrics = _current()
+    if metrics is not None and start is not None:
+        metrics.sql_count += 1
+        metrics.sql_time += time.perf_counter() - start
+
+
+@app.before_request
+def _before_request():
+    g.metrics = _Request()
+    profiler = sampler()
+    if profiler is not None:
+        profiler.begin(threading.get_ident())
+
+
+@app.after_request
+def _after_request(response):
+    metrics = g.pop("metrics", None)
+    if metrics is None:
+        return response
+
+    end = time.perf_counter()
+    duration = end - metrics.start
+    operation = metrics.operation or OPERATIONS.get(
+        (request.endpoint or "").rsplit(".", 1)[-1], request.endpoint or "unknown")
+
+    if metrics.handler_start is None:
+        # connexion answered before the handler, e.g. a 400 on validation
+        phases = {"validation": duration, "sql": metrics.sql_time}
+    else:
+        handler = metrics.handler_end - metrics.handler_start
+        serialization = metrics.serialization + (end - metrics.handler_end)
+        phases = {
+            "validation": metrics.handler_start - metrics.start,
+            "sql": metrics.sql_time,
+            "serialization": serialization,
+            "orm": max(0.0, handler - metrics.sql_time - metrics.serialization),
+        }
+
+    registry.observe(operation, request.method, response.status_code, duration, phases,
+                     metrics.sql_count)
+
+    profiler = sampler()
+    if profiler is not None:
+        samples = profiler.end(threading.get_ident())
+        if duration * 1000 >= app.config["METRICS_PROFILE_THRESHOLD"] and samples:
+            path = dump_profile(samples, operation, duration)
+            app.logger.warning("Slow request %s %s (%s) took %.0f ms, profile in %s",
+                               request.method, request.path, operation, duration * 1000, path)
+
+    return response
+
+
+def _labels(**labels):
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    ) + "}"
+
+
+def render():
+    """
+    Metrics of the process in the Prometheus text format
+
+    :return:    string
+    """
+    with registry.lock:
+        lines = [
+            "# HELP api_requests_total Requests served by operation, method and status",
+            "# TYPE api_requests_total counter",
+        ]
+        for (operation, method, status), count in sorted(registry.requests.items()):
+            lines.append("api_requests_total{} {}".format(
+                _labels(operation=operation, method=method, status=status), count))
+
+        lines += [
+            "# HELP api_request_duration_seconds Duration of the requests by operation",
+            "# TYPE api_request_duration_seconds histogram",
+        ]
+        for operation in sorted(registry.counts):
+            for bound, count in zip(BUCKETS, registry.buckets[operation]):
+                lines.append("api_request_duration_seconds_bucket{} {}".format(
+                    _labels(operation=operation, le=bound), count))
+            lines.append("api_request_duration_seconds_bucket{} {}".format(
+                _labels(operation=operation, le="+Inf"), registry.counts[operation]))
+            lines.append("api_request_duration_seconds_sum{} {}".format(
+                _labels(operation=operation), registry.durations[operation]))
+            lines.append("api_request_duration_seconds_count{} {}".format(
+                _labels(operation=operation), registry.counts[operation]))
+
+        lines += [
+            "# HELP api_request_phase_seconds_total Time spent in each phase of the requests",
+            "# TYPE api_request_phase_seconds_total counter",
+        ]
+        for (operation, name), seconds in sorted(registry.phases.items()):
+            lines.append("api_request_phase_seconds_total{} {}".format(
+                _labels(operation=operation, phase=name), seconds))
+
+        lines += [
+            "# HELP api_sql_queries_total SQL statements sent by the requests",
+            "# TYPE api_sql_queries_total counter",
+        ]
+        for operation, count in sorted(registry.queries.items()):
+            lines.append("api_sql_queries_total{} {}".format(_labels(operation=operation), count))
+
+        if registry.batches:
+            lines += [
+                "# HELP api_group_commit_batch_size Writes committed together by the writer thread",
+                "# TYPE api_group_commit_batch_size histogram",
+            ]
+            for bound, count in zip(BATCH_BUCKETS, registry.batch_buckets):
+                lines.append("api_group_commit_batch_size_bucket{} {}".format(_labels(le=bound), count))
+            lines.append("api_group_commit_batch_size_bucket{} {}".format(_labels(le="+Inf"), registry.batches))
+            lines.append("api_group_commit_batch_size_sum {}".format(registry.batch_sizes))
+            lines.append("api_group_commit_batch_size_count {}".format(registry.batches))
+
+            lines += [
+                "# HELP api_group_commit_wait_seconds Time from queueing a write to the commit of its batch",
+                "# TYPE api_group_commit_wait_seconds histogram",
+            ]
+            for bound, count in zip(BUCKETS, registry.wait_buckets):
+                lines.append("api_group_commit_wait_seconds_bucket{} {}".format(_labels(le=bound), count))
+            lines.append("api_group_commit_wait_seconds_bucket{} {}".format(_labels(le="+Inf"), registry.waited))
+            lines.append("api_group_commit_wait_seconds_sum {}".format(registry.waits))
+            lines.append("api_group_commit_wait_seconds_count {}".format(registry.waited))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,50 @@
+"""create directors and movies
+
+Revision ID: 1b69f7822cc6
+Revises: 
+Create Date: 2021-12-20 10:12:41.250184
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b69f7822cc6'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('directors',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.Text(), nullable=False),
+    sa.Column('gender', sa.Integer(), nullable=False),
+    sa.Column('uid', sa.Integer(), nullable=False),
+    sa.Column('department', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('uid')
+    )
+    op.create_table('movies',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('original_title', sa.Text(), nullable=True),
+    sa.Column('budget', sa.Integer(), nullable=True),
+    sa.Column('popularity', sa.Integer(), nullable=True),
+    sa.Column('release_date', sa.Text(), nullable=True),
+    sa.Column('revenue', sa.Integer(), nullable=True),
+    sa.Column('title', sa.Text(), nullable=True),
+    sa.Column('vote_average', sa.Float(), nullable=True),
+    sa.Column('vote_count', sa.Integer(), nullable=True),
+    sa.Column('overview', sa.Text(), nullable=True),
+    sa.Column('tagline', sa.Text(), nullable=True),
+    sa.Column('uid', sa.Integer(), nullable=True),
+    sa.Column('director_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['director_id'], ['directors.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('movies')
+    op.drop_table('directors')
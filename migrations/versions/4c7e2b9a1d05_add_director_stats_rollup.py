@@ -0,0 +1,51 @@
+"""add director stats rollup
+
+Revision ID: 4c7e2b9a1d05
+Revises: 9d2f4a61c7e3
+Create Date: 2026-10-17 15:02:44.180316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c7e2b9a1d05'
+down_revision = '9d2f4a61c7e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('director_stats',
+    sa.Column('director_id', sa.Integer(), nullable=False),
+    sa.Column('movies_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('total_budget', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('total_revenue', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('vote_points', sa.Float(), server_default='0', nullable=False),
+    sa.Column('vote_total', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['director_id'], ['directors.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('director_id')
+    )
+    op.create_index('ix_director_stats_movies_count', 'director_stats', ['movies_count', 'director_id'], unique=False)
+    op.create_index('ix_director_stats_total_budget', 'director_stats', ['total_budget', 'director_id'], unique=False)
+    op.create_index('ix_director_stats_total_revenue', 'director_stats', ['total_revenue', 'director_id'], unique=False)
+
+    # fill the rollup from the existing movies, the application keeps it
+    # current from then on
+    op.execute("""
+        INSERT INTO director_stats
+            (director_id, movies_count, total_budget, total_revenue, vote_points, vote_total)
+        SELECT director_id, count(id), coalesce(sum(budget), 0), coalesce(sum(revenue), 0),
+               coalesce(sum(vote_average * vote_count), 0), coalesce(sum(vote_count), 0)
+        FROM movies
+        WHERE director_id IS NOT NULL
+        GROUP BY director_id
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_director_stats_total_revenue', table_name='director_stats')
+    op.drop_index('ix_director_stats_total_budget', table_name='director_stats')
+    op.drop_index('ix_director_stats_movies_count', table_name='director_stats')
+    op.drop_table('director_stats')
@@ -0,0 +1,49 @@
+"""add secondary indexes
+
+Revision ID: 63f54bd3672c
+Revises: 1b69f7822cc6
+Create Date: 2026-10-17 13:20:38.951235
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '63f54bd3672c'
+down_revision = '1b69f7822cc6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_directors_department_id', 'directors', ['department', 'id'], unique=False)
+    op.create_index('ix_directors_gender_id', 'directors', ['gender', 'id'], unique=False)
+    op.create_index('ix_directors_name_id', 'directors', ['name', 'id'], unique=False)
+
+    op.create_index('ix_movies_budget_id', 'movies', ['budget', 'id'], unique=False)
+    op.create_index('ix_movies_director_id_id', 'movies', ['director_id', 'id'], unique=False)
+    op.create_index('ix_movies_original_title_id', 'movies', ['original_title', 'id'], unique=False)
+    op.create_index('ix_movies_popularity_id', 'movies', ['popularity', 'id'], unique=False)
+    op.create_index('ix_movies_release_date_id', 'movies', ['release_date', 'id'], unique=False)
+    op.create_index('ix_movies_revenue_id', 'movies', ['revenue', 'id'], unique=False)
+    op.create_index('ix_movies_title_id', 'movies', ['title', 'id'], unique=False)
+    op.create_index('ix_movies_uid', 'movies', ['uid'], unique=True)
+    op.create_index('ix_movies_vote_average_id', 'movies', ['vote_average', 'id'], unique=False)
+    op.create_index('ix_movies_vote_count_id', 'movies', ['vote_count', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movies_vote_count_id', table_name='movies')
+    op.drop_index('ix_movies_vote_average_id', table_name='movies')
+    op.drop_index('ix_movies_uid', table_name='movies')
+    op.drop_index('ix_movies_title_id', table_name='movies')
+    op.drop_index('ix_movies_revenue_id', table_name='movies')
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    op.drop_index('ix_movies_popularity_id', table_name='movies')
+    op.drop_index('ix_movies_original_title_id', table_name='movies')
+    op.drop_index('ix_movies_director_id_id', table_name='movies')
+    op.drop_index('ix_movies_budget_id', table_name='movies')
+
+    op.drop_index('ix_directors_name_id', table_name='directors')
+    op.drop_index('ix_directors_gender_id', table_name='directors')
+    op.drop_index('ix_directors_department_id', table_name='directors')
@@ -0,0 +1,31 @@
+"""add catalog version
+
+Revision ID: 7a3e5c0d2b18
+Revises: 4c7e2b9a1d05
+Create Date: 2026-10-17 17:41:09.532871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3e5c0d2b18'
+down_revision = '4c7e2b9a1d05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalog_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    # the single row the writes bump
+    op.execute("INSERT INTO catalog_version (id, version) VALUES (1, 0)")
+
+
+def downgrade():
+    op.drop_table('catalog_version')
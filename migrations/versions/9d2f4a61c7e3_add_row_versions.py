@@ -0,0 +1,78 @@
+"""add row versions
+
+Revision ID: 9d2f4a61c7e3
+Revises: 63f54bd3672c
+Create Date: 2026-10-17 13:40:12.518274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2f4a61c7e3'
+down_revision = '63f54bd3672c'
+branch_labels = None
+depends_on = None
+
+
+# the full-text index only needs refreshing when indexed text changes,
+# not when a row version is bumped
+MOVIES_FTS_UPDATE = """
+    CREATE TRIGGER movies_fts_update
+    AFTER UPDATE OF title, original_title, overview, tagline, director_id ON movies
+    BEGIN
+        DELETE FROM movies_fts WHERE rowid = old.id;
+        INSERT INTO movies_fts (rowid, title, original_title, overview, tagline, director_name)
+        VALUES (new.id, new.title, new.original_title, new.overview, new.tagline,
+                (SELECT name FROM directors WHERE id = new.director_id));
+    END
+"""
+
+DIRECTORS_FTS_UPDATE = """
+    CREATE TRIGGER directors_fts_update AFTER UPDATE OF name ON directors
+    BEGIN
+        DELETE FROM directors_fts WHERE rowid = old.id;
+        INSERT INTO directors_fts (rowid, name) VALUES (new.id, new.name);
+        UPDATE movies_fts SET director_name = new.name
+        WHERE rowid IN (SELECT id FROM movies WHERE director_id = new.id);
+    END
+"""
+
+FTS_TRIGGERS = (
+    'movies_fts_insert', 'movies_fts_update', 'movies_fts_delete',
+    'directors_fts_insert', 'directors_fts_update', 'directors_fts_delete',
+)
+
+
+def _has_fts_index():
+    bind = op.get_bind()
+    return bind.dialect.name == 'sqlite' and bind.execute(sa.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'movies_fts'"
+    )).first() is not None
+
+
+def upgrade():
+    for table in ('directors', 'movies'):
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute("UPDATE {} SET updated_at = CURRENT_TIMESTAMP".format(table))
+
+    if _has_fts_index():
+        op.execute("DROP TRIGGER IF EXISTS movies_fts_update")
+        op.execute("DROP TRIGGER IF EXISTS directors_fts_update")
+        op.execute(MOVIES_FTS_UPDATE)
+        op.execute(DIRECTORS_FTS_UPDATE)
+
+
+def downgrade():
+    # rebuilding the tables would break the triggers, search.init_index
+    # creates them again on the next start
+    if _has_fts_index():
+        for trigger in FTS_TRIGGERS:
+            op.execute("DROP TRIGGER IF EXISTS {}".format(trigger))
+
+    for table in ('movies', 'directors'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('version')
@@ -0,0 +1,42 @@
+"""cascade movies of directors
+
+Revision ID: c3d8e1f0a4b6
+Revises: e5b81c4f9a27
+Create Date: 2026-10-17 20:04:37.618240
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d8e1f0a4b6'
+down_revision = 'e5b81c4f9a27'
+branch_labels = None
+depends_on = None
+
+# The foreign key of movies was created without a name, the convention
+# gives it one the batch can drop
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+FOREIGN_KEY = 'fk_movies_director_id_directors'
+
+
+def replace_foreign_key(ondelete):
+    # SQLite recreates the table, search.init_index puts the full-text
+    # triggers of movies back on the next start
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    if sqlite:
+        op.execute('PRAGMA legacy_alter_table = ON')
+    with op.batch_alter_table('movies', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint(FOREIGN_KEY, type_='foreignkey')
+        batch_op.create_foreign_key(FOREIGN_KEY, 'directors', ['director_id'], ['id'],
+                                    ondelete=ondelete)
+    if sqlite:
+        op.execute('PRAGMA legacy_alter_table = OFF')
+
+
+def upgrade():
+    replace_foreign_key('CASCADE')
+
+
+def downgrade():
+    replace_foreign_key(None)
@@ -0,0 +1,98 @@
+"""release date as date
+
+Revision ID: e5b81c4f9a27
+Revises: 7a3e5c0d2b18
+Create Date: 2026-10-17 18:26:53.104772
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b81c4f9a27'
+down_revision = '7a3e5c0d2b18'
+branch_labels = None
+depends_on = None
+
+# Formats the free text release dates were entered in, ISO first
+DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%m/%d/%Y', '%d-%m-%Y', '%d %B %Y', '%B %d, %Y')
+
+
+def parse_date(text):
+    """
+    Date of a free text release date
+
+    :param text:    stored value
+    :return:        date, None when no format matches
+    """
+    for format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), format).date()
+        except (ValueError, AttributeError):
+            continue
+    return None
+
+
+def backfill(connection):
+    """
+    Copy release_date into release_day, typed, failing on the values no
+    format reads so they get fixed by hand rather than lost
+    """
+    movies = sa.table('movies', sa.column('id', sa.Integer), sa.column('release_date', sa.String),
+                      sa.column('release_day', sa.Date))
+    rows = connection.execute(sa.select(movies.c.id, movies.c.release_date)).fetchall()
+
+    values, invalid = [], []
+    for id, text in rows:
+        day = parse_date(text)
+        if day is None:
+            invalid.append((id, text))
+        else:
+            values.append({'movie_id': id, 'day': day})
+    if invalid:
+        raise ValueError('Unreadable release dates (id, value): {}'.format(invalid[:20]))
+
+    if values:
+        connection.execute(
+            movies.update().where(movies.c.id == sa.bindparam('movie_id'))
+            .values(release_day=sa.bindparam('day')),
+            values)
+
+
+def upgrade():
+    # add, backfill and swap: a batch type change would CAST the text on
+    # SQLite, which turns '2005-08-05' into 2005
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    op.add_column('movies', sa.Column('release_day', sa.Date(), nullable=True))
+    backfill(op.get_bind())
+
+    # SQLite recreates the table, search.init_index puts the full-text
+    # triggers of movies back on the next start. The legacy rename leaves
+    # alone the directors trigger naming movies while the table is away.
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    if sqlite:
+        op.execute('PRAGMA legacy_alter_table = ON')
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('release_date')
+        batch_op.alter_column('release_day', new_column_name='release_date',
+                              existing_type=sa.Date(), nullable=False)
+    if sqlite:
+        op.execute('PRAGMA legacy_alter_table = OFF')
+
+    op.create_index('ix_movies_release_date_id', 'movies', ['release_date', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    if sqlite:
+        op.execute('PRAGMA legacy_alter_table = ON')
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.alter_column('release_date', existing_type=sa.Date(), type_=sa.String(),
+                              nullable=True)
+    if sqlite:
+        op.execute('PRAGMA legacy_alter_table = OFF')
+    op.create_index('ix_movies_release_date_id', 'movies', ['release_date', 'id'], unique=False)
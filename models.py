@@ -1,33 +1,80 @@
-from datetime import datetime
+from datetime import date, datetime
 from config import db, ma
 from marshmallow import fields
+from metrics import TimedSchema
+
+
+class IsoDate(db.TypeDecorator):
+    """
+    Date column also taking the ISO 8601 strings of the request bodies
+    """
+    impl = db.Date
+    cache_ok = True
+
+    @property
+    def python_type(self):
+        return date
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return date.fromisoformat(value)
+        return value
 
 
 class Directors(db.Model):
     __tablename__ = 'directors'
+    # (column, id) indexes serve the keyset pages sorted by that column
+    __table_args__ = (
+        db.Index('ix_directors_name_id', 'name', 'id'),
+        db.Index('ix_directors_gender_id', 'gender', 'id'),
+        db.Index('ix_directors_department_id', 'department', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     gender = db.Column(db.Integer)
     uid = db.Column(db.Integer)
     department = db.Column(db.String, nullable=False)
+    # bumped on every change of the director or of one of its movies
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __mapper_args__ = {'version_id_col': version}
 
+    # a query, the movies are never loaded all at once, not even to delete
+    # them: the database cascades the delete of their director
     movies = db.relationship(
         'Movies',
         backref='directors',
-        cascade='all, delete, delete-orphan',
+        cascade='all, delete-orphan',
+        passive_deletes=True,
         single_parent=True,
+        lazy='dynamic',
         order_by='desc(Movies.id)'
     )
 
 
 class Movies(db.Model):
     __tablename__ = 'movies'
+    # (column, id) indexes serve the keyset pages sorted by that column,
+    # (director_id, id) serves the filmography of a director newest first
+    __table_args__ = (
+        db.Index('ix_movies_director_id_id', 'director_id', 'id'),
+        db.Index('ix_movies_uid', 'uid', unique=True),
+        db.Index('ix_movies_original_title_id', 'original_title', 'id'),
+        db.Index('ix_movies_budget_id', 'budget', 'id'),
+        db.Index('ix_movies_popularity_id', 'popularity', 'id'),
+        db.Index('ix_movies_release_date_id', 'release_date', 'id'),
+        db.Index('ix_movies_revenue_id', 'revenue', 'id'),
+        db.Index('ix_movies_title_id', 'title', 'id'),
+        db.Index('ix_movies_vote_average_id', 'vote_average', 'id'),
+        db.Index('ix_movies_vote_count_id', 'vote_count', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    director_id = db.Column(db.Integer, db.ForeignKey('directors.id'))
+    director_id = db.Column(db.Integer, db.ForeignKey('directors.id', ondelete='CASCADE'))
     original_title = db.Column(db.String, nullable=False)
     budget = db.Column(db.Integer)
     popularity = db.Column(db.Integer)
-    release_date = db.Column(db.String, nullable=False)
+    release_date = db.Column(IsoDate, nullable=False)
     revenue = db.Column(db.Integer)
     title = db.Column(db.String, nullable=False)
     vote_average = db.Column(db.Float)
@@ -35,21 +82,69 @@ class Movies(db.Model):
     overview = db.Column(db.String, nullable=False)
     tagline = db.Column(db.String, nullable=False)
     uid = db.Column(db.Integer)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __mapper_args__ = {'version_id_col': version}
+
+
+# Number of movies of a director, counted from the (director_id, id) index
+# only when selected
+Directors.movies_count = db.column_property(
+    db.select(db.func.count(Movies.id))
+    .where(Movies.director_id == Directors.id)
+    .correlate_except(Movies)
+    .scalar_subquery(),
+    deferred=True
+)
+
+
+class DirectorStats(db.Model):
+    """
+    Rollup of the movies of each director, refreshed by every movie write
+    (stats.refresh) so the stats endpoints never aggregate the movies table
+    """
+    __tablename__ = 'director_stats'
+    # (total, director_id) indexes serve the leaderboards
+    __table_args__ = (
+        db.Index('ix_director_stats_movies_count', 'movies_count', 'director_id'),
+        db.Index('ix_director_stats_total_budget', 'total_budget', 'director_id'),
+        db.Index('ix_director_stats_total_revenue', 'total_revenue', 'director_id'),
+    )
+    director_id = db.Column(db.Integer, db.ForeignKey('directors.id', ondelete='CASCADE'), primary_key=True)
+    movies_count = db.Column(db.Integer, nullable=False, server_default='0')
+    total_budget = db.Column(db.BigInteger, nullable=False, server_default='0')
+    total_revenue = db.Column(db.BigInteger, nullable=False, server_default='0')
+    # sum of vote_average * vote_count, over vote_total gives the weighted average
+    vote_points = db.Column(db.Float, nullable=False, server_default='0')
+    vote_total = db.Column(db.Integer, nullable=False, server_default='0')
+
+
+class CatalogVersion(db.Model):
+    """
+    Stamp of the directors and movies data, moved by every write so the
+    workers know when their catalog snapshot (snapshot.py) is stale
+    """
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, server_default='0')
 
 
-class DirectorsSchema(ma.SQLAlchemyAutoSchema):
+class DirectorsSchema(TimedSchema, ma.SQLAlchemyAutoSchema):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     class Meta:
         model = Directors
         load_instance = True
+        exclude = ('version', 'updated_at')
         # sqla_session = db.session
 
     movies = fields.Nested('DirectorsMoviesSchema', default=[], many=True)
+    movies_count = fields.Int(dump_only=True)
 
 
-class DirectorsMoviesSchema(ma.SQLAlchemyAutoSchema):
+class DirectorsMoviesSchema(TimedSchema, ma.SQLAlchemyAutoSchema):
     """
     This class exists to get around a recursion issue
     """
@@ -62,7 +157,7 @@ class DirectorsMoviesSchema(ma.SQLAlchemyAutoSchema):
     original_title = fields.Str()
     budget = fields.Int()
     popularity = fields.Int()
-    release_date = fields.Str()
+    release_date = fields.Date()
     revenue = fields.Int()
     title = fields.Str()
     vote_average = fields.Float()
@@ -72,19 +167,20 @@ class DirectorsMoviesSchema(ma.SQLAlchemyAutoSchema):
     uid = fields.Int()
 
 
-class MoviesSchema(ma.SQLAlchemyAutoSchema):
+class MoviesSchema(TimedSchema, ma.SQLAlchemyAutoSchema):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     class Meta:
         model = Movies
         load_instance = True
+        exclude = ('version', 'updated_at')
         # sqla_session = db.session
 
     directors = fields.Nested("MoviesDirectorsSchema", default=None)
 
 
-class MoviesDirectorsSchema(ma.SQLAlchemyAutoSchema):
+class MoviesDirectorsSchema(TimedSchema, ma.SQLAlchemyAutoSchema):
     """
     This class exists to get around a recursion issue
     """
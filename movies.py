@@ -4,95 +4,239 @@ directors and movies data
 """
 
 from flask import make_response, abort, jsonify
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload
 from config import db
 from models import Directors, Movies, MoviesSchema
-
-
-def read_all():
+import bulk
+import cache
+import conditional
+import export
+import fieldsets
+import filters
+import pagination
+import search
+import serializers
+import similar
+import snapshot
+import stats
+import validation
+import writer
+
+
+# Attributes the movies lists can be sorted by
+SORT_ATTRIBUTES = {
+    'id': Movies.id,
+    'director id': Movies.director_id,
+    'original title': Movies.original_title,
+    'budget': Movies.budget,
+    'popularity': Movies.popularity,
+    'release date': Movies.release_date,
+    'revenue': Movies.revenue,
+    'title': Movies.title,
+    'vote average': Movies.vote_average,
+    'vote count': Movies.vote_count,
+    'overview': Movies.overview,
+    'tagline': Movies.tagline,
+    'uid': Movies.uid,
+}
+
+# Columns the movies list can be filtered and sorted by (filters.py), the
+# ones leading an index of the model so the database never scans the table
+FILTER_ATTRIBUTES = {
+    column.key: getattr(Movies, column.key)
+    for index in Movies.__table__.indexes for column in list(index.columns)[:1]
+}
+FILTER_ATTRIBUTES['id'] = Movies.id
+
+# Columns of the movies export, in output order
+EXPORT_COLUMNS = [
+    Movies.id,
+    Movies.director_id,
+    Movies.original_title,
+    Movies.budget,
+    Movies.popularity,
+    Movies.release_date,
+    Movies.revenue,
+    Movies.title,
+    Movies.vote_average,
+    Movies.vote_count,
+    Movies.overview,
+    Movies.tagline,
+    Movies.uid,
+]
+
+# Checks of the items of the bulk requests, the same as the body of a
+# single write, an update carries the id too
+BULK_CREATE = validation.definition('Movie', director_id='integer')
+BULK_UPDATE = validation.definition('Movie', director_id='integer', id='integer')
+
+
+# Fields of a movie the director_stats rollup is computed from
+STATS_FIELDS = {'budget', 'revenue', 'vote_average', 'vote_count'}
+
+
+def _load_options(fieldset, required=(), loader=None):
+    # The director versions make the ETag, so it is joined even when not nested
+    if loader is None:
+        loader = joinedload(Movies.directors)
+    return fieldset.options(loader, ['director_id'] + list(required), needs_relation=True)
+
+
+def _check_rows(movies):
+    # Rows of serializers.MOVIES carry the director version as directors_version
+    return conditional.check(
+        [(movie.id, movie.version, movie.directors_version) for movie in movies],
+        [date for movie in movies for date in (movie.updated_at, movie.directors_updated_at)])
+
+
+@cache.cached("movies")
+def read_all(cursor=None, fields=None, include=None, filter=None, sort=None,
+             released_from=None, released_to=None):
     """
     This function responds to a request for /api/movies
-    with the complete list of movies, sorted by movie id desc
-
+    with the complete list of movies, sorted by movie id desc, 10 per page
+
+    :param cursor:          token of the page to get, from the X-Next-Cursor
+                            or X-Prev-Cursor header of a previous page
+    :param fields:          comma separated fields to return, directors.name
+                            style for the fields of the director
+    :param include:         comma separated relations to nest, empty for none
+    :param filter:          conditions the movies have to match, like
+                            budget=gt=50000000;vote_count=gt=1000
+    :param sort:            comma separated fields to sort by, - in front
+                            for descending, like -budget,title
+    :param released_from:   first release date, YYYY-MM-DD
+    :param released_to:     last release date, YYYY-MM-DD
     :return:                json list of all movies, message data empty
     """
-    # Query the database for all the movies
-    movies = Movies.query.order_by(db.desc(Movies.id)).limit(10)
-
-    # Serialize the list of movies from our data
-    movie_schema = MoviesSchema(many=True)
-    data = movie_schema.dump(movies)
-
-    if(len(data) == 0):
+    fieldset = fieldsets.Fieldset(MoviesSchema, 'directors', fields, include)
+
+    # The filter and the sort run in the database, on indexed columns only
+    conditions = filters.parse_filter(filter, FILTER_ATTRIBUTES)
+    conditions += filters.date_range(Movies.release_date, released_from, released_to)
+    keys = [(Movies.id, True)]
+    if sort is not None:
+        keys = filters.parse_sort(sort, FILTER_ATTRIBUTES, Movies.id)
+    signature = 'id:desc'
+    if conditions or sort is not None:
+        signature = filters.signature(keys, filter, released_from, released_to)
+
+    # Query the database for all the movies, as plain rows
+    required = [column.key for column, _ in keys]
+    movies, next_cursor, prev_cursor = pagination.keyset_page(
+        serializers.MOVIES.query(fieldset, required).filter(*conditions),
+        keys, 10, cursor, signature)
+
+    if(len(movies) == 0):
         return abort(404, f"Movies data not found!")
 
-    return data
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = _check_rows(movies)
+    if not_modified is not None:
+        return not_modified
+
+    # Serialize the list of movies from our data
+    headers.update(pagination.cursor_headers(next_cursor, prev_cursor))
+    return serializers.response(serializers.MOVIES.dumps(movies, fieldset, required), headers)
 
 
-def read_limit(limit, order, attribute):
+@cache.cached("movies")
+def read_limit(limit, order, attribute, cursor=None, fields=None, include=None,
+               released_from=None, released_to=None):
     """
     This function responds to a request for /api/movies/{limit}/{order}
     with the complete list of movies, sorted by movie id (custom input asc or desc)
 
     :param limit:       for size return movies data
     :param order:       asc or desc order
+    :param attribute:   request order by attribute in movies
+    :param cursor:      token of the page to get, from the X-Next-Cursor or
+                        X-Prev-Cursor header of a previous page
+    :param fields:      comma separated fields to return, directors.name
+                        style for the fields of the director
+    :param include:     comma separated relations to nest, empty for none
+    :param released_from:   first release date, YYYY-MM-DD
+    :param released_to:     last release date, YYYY-MM-DD
     :return:            json list of limit movies order by request, message if data empty
     """
-
-    # Create the list of movies from our data
-    # match attribute:
-    if attribute == 'id':
-        movies = Movies.query.order_by(db.desc(
-            Movies.id) if f'{order}' == 'desc' else db.asc(Movies.id)).limit(limit)
-    elif attribute == 'director id':
-        movies = Movies.query.order_by(db.desc(
-            Movies.director_id) if f'{order}' == 'desc' else db.asc(Movies.director_id)).limit(limit)
-    elif attribute == 'original title':
-        movies = Movies.query.order_by(db.desc(
-            Movies.original_title) if f'{order}' == 'desc' else db.asc(Movies.original_title)).limit(limit)
-    elif attribute == 'budget':
-        movies = Movies.query.order_by(db.desc(
-            Movies.budget) if f'{order}' == 'desc' else db.asc(Movies.budget)).limit(limit)
-    elif attribute == 'popularity':
-        movies = Movies.query.order_by(db.desc(
-            Movies.popularity) if f'{order}' == 'desc' else db.asc(Movies.popularity)).limit(limit)
-    elif attribute == 'release date':
-        movies = Movies.query.order_by(db.desc(
-            Movies.release_date) if f'{order}' == 'desc' else db.asc(Movies.release_date)).limit(limit)
-    elif attribute == 'revenue':
-        movies = Movies.query.order_by(db.desc(
-            Movies.revenue) if f'{order}' == 'desc' else db.asc(Movies.revenue)).limit(limit)
-    elif attribute == 'title':
-        movies = Movies.query.order_by(db.desc(
-            Movies.title) if f'{order}' == 'desc' else db.asc(Movies.title)).limit(limit)
-    elif attribute == 'vote average':
-        movies = Movies.query.order_by(db.desc(
-            Movies.vote_average) if f'{order}' == 'desc' else db.asc(Movies.vote_average)).limit(limit)
-    elif attribute == 'vote count':
-        movies = Movies.query.order_by(db.desc(
-            Movies.vote_count) if f'{order}' == 'desc' else db.asc(Movies.vote_count)).limit(limit)
-    elif attribute == 'overview':
-        movies = Movies.query.order_by(db.desc(
-            Movies.overview) if f'{order}' == 'desc' else db.asc(Movies.overview)).limit(limit)
-    elif attribute == 'tagline':
-        movies = Movies.query.order_by(db.desc(
-            Movies.tagline) if f'{order}' == 'desc' else db.asc(Movies.tagline)).limit(limit)
-    elif attribute == 'uid':
-        movies = Movies.query.order_by(db.desc(
-            Movies.uid) if f'{order}' == 'desc' else db.asc(Movies.uid)).limit(limit)
-    else:
+    if attribute not in SORT_ATTRIBUTES:
         abort(404, f"Movies not found for attribute {attribute}!")
 
+    fieldset = fieldsets.Fieldset(MoviesSchema, 'directors', fields, include)
+
+    # Create the list of movies from our data, the id breaks ties
+    desc = f'{order}' == 'desc'
+    keys = [(SORT_ATTRIBUTES[attribute], desc)]
+    if attribute != 'id':
+        keys.append((Movies.id, desc))
+
+    # A release date range seeks the (release_date, id) index
+    conditions = filters.date_range(Movies.release_date, released_from, released_to)
+    signature = '{}:{}'.format(attribute, 'desc' if desc else 'asc')
+    if conditions:
+        signature = filters.signature(keys, released_from, released_to)
+
+    required = [SORT_ATTRIBUTES[attribute].key]
+    movies, next_cursor, prev_cursor = pagination.keyset_page(
+        serializers.MOVIES.query(fieldset, required).filter(*conditions),
+        keys, limit, cursor, signature)
+
+    if(len(movies) == 0):
+        return abort(404, f"Movies data not found!")
+
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = _check_rows(movies)
+    if not_modified is not None:
+        return not_modified
+
     # Serialize the list of movies from our data
-    movie_schema = MoviesSchema(many=True)
-    data = movie_schema.dump(movies)
+    headers.update(pagination.cursor_headers(next_cursor, prev_cursor))
+    return serializers.response(serializers.MOVIES.dumps(movies, fieldset, required), headers)
+
 
-    if(len(data) == 0):
+@cache.cached("director:{director_id}")
+def read_filmography(director_id, cursor=None, limit=10, fields=None, include=None):
+    """
+    This function responds to a request for
+    /api/directors/{director_id}/movies
+    with the movies of a director, sorted by movie id desc like the page
+    of movies nested in the director, whose movies_next link leads here
+
+    :param director_id:     Id of director the movies are related to
+    :param cursor:          token of the page to get, from the movies_next
+                            link or a X-Next-Cursor or X-Prev-Cursor header
+    :param limit:           size of the page
+    :param fields:          comma separated fields to return, directors.name
+                            style for the fields of the director
+    :param include:         comma separated relations to nest, empty for none
+    :return:                json list of movies, 404 if not found
+    """
+    if not _director_exists(director_id):
+        abort(404, f"Director not found for ID: {director_id}!")
+
+    fieldset = fieldsets.Fieldset(MoviesSchema, 'directors', fields, include)
+
+    # The (director_id, id) index gives the movies of the page in order
+    movies, next_cursor, prev_cursor = pagination.keyset_page(
+        serializers.MOVIES.query(fieldset).filter(Movies.director_id == director_id),
+        [(Movies.id, True)], limit, cursor, 'id:desc')
+
+    if(len(movies) == 0):
         return abort(404, f"Movies data not found!")
 
-    return data
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = _check_rows(movies)
+    if not_modified is not None:
+        return not_modified
 
+    # Serialize the list of movies from our data
+    headers.update(pagination.cursor_headers(next_cursor, prev_cursor))
+    return serializers.response(serializers.MOVIES.dumps(movies, fieldset), headers)
 
-def read_one(director_id, movie_id):
+
+@cache.cached("movie:{movie_id}", "director:{director_id}")
+def read_one(director_id, movie_id, fields=None, include=None):
     """
     This function responds to a request for
     /api/directors/{director_id}/movies/{movie_id}
@@ -100,8 +244,17 @@ def read_one(director_id, movie_id):
 
     :param director_id:       Id of director the movie is related to
     :param movie_id:          Id of the movie
+    :param fields:            comma separated fields to return, directors.name
+                              style for the fields of the director
+    :param include:           comma separated relations to nest, empty for none
     :return:                  json string of movie data, 404 if not found
     """
+    fieldset = fieldsets.Fieldset(MoviesSchema, 'directors', fields, include)
+
+    # The snapshot answers from memory when it is on
+    if snapshot.catalog is not None:
+        return _read_one_snapshot(director_id, movie_id, fieldset)
+
     check_director = (Directors.query.filter(
         Directors.id == director_id)).one_or_none()
 
@@ -109,6 +262,7 @@ def read_one(director_id, movie_id):
         # Query the database for the movie
         movie = (
             Movies.query.join(Directors, Directors.id == Movies.director_id)
+            .options(*_load_options(fieldset, loader=contains_eager(Movies.directors)))
             .filter(Directors.id == director_id)
             .filter(Movies.id == movie_id)
             .one_or_none()
@@ -116,9 +270,16 @@ def read_one(director_id, movie_id):
 
         # Was a movie found?
         if movie is not None:
-            movie_schema = MoviesSchema()
+            # Answer 304 before serializing when the client copy is current
+            headers, not_modified = conditional.check(
+                [(movie.id, movie.version, check_director.version)],
+                [movie.updated_at, check_director.updated_at])
+            if not_modified is not None:
+                return not_modified
+
+            movie_schema = fieldset.schema(MoviesSchema)
             data = movie_schema.dump(movie)
-            return data
+            return data, 200, headers
 
         # Otherwise, nope, didn't find that movie
         else:
@@ -129,6 +290,33 @@ def read_one(director_id, movie_id):
         abort(404, f"Director not found for ID: {director_id}!")
 
 
+def _read_one_snapshot(director_id, movie_id, fieldset):
+    director = snapshot.catalog.director(director_id)
+    if director is None:
+        abort(404, f"Director not found for ID: {director_id}!")
+
+    movie = snapshot.catalog.movie(movie_id)
+    if movie is None or movie["director_id"] != director_id:
+        abort(404, f"Movie not found for ID: {movie_id}!")
+
+    headers, not_modified = conditional.check(
+        [(movie["id"], movie["version"], director["version"])],
+        [movie["updated_at"], director["updated_at"]])
+    if not_modified is not None:
+        return not_modified
+
+    data = serializers.MOVIES.dump_item(movie, director, fieldset)
+    return data, 200, headers
+
+
+def _director_exists(director_id):
+    # The snapshot answers without a query when it is on
+    if snapshot.catalog is not None:
+        return snapshot.catalog.director(director_id) is not None
+    return db.session.query(Directors.id).filter(Directors.id == director_id).scalar() is not None
+
+
+@writer.grouped
 def create(director_id, movie):
     """
     This function creates a new movie related to the passed in director id.
@@ -137,42 +325,6 @@ def create(director_id, movie):
     :param movie:            The JSON containing the movie data
     :return:                data and 201 on success, 404 if not found, 409 if movie exists already
     """
-    # validate field
-    budget = movie.get("budget")
-    original_title = movie.get("original_title")
-    overview = movie.get("overview")
-    popularity = movie.get("popularity")
-    release_date = movie.get("release_date")
-    revenue = movie.get("revenue")
-    tagline = movie.get("tagline")
-    title = movie.get("title")
-    uid = movie.get("uid")
-    vote_average = movie.get("vote_average")
-    vote_count = movie.get("vote_count")
-
-    if budget is None or budget is "":
-        abort(400, "Field budget must be required!")
-    if original_title is None or original_title is "":
-        abort(400, "Field original_title must be required!")
-    if uid is None or uid is "":
-        abort(400, "Field uid must be required!")
-    if overview is None or overview is "":
-        abort(400, "Field overview must be required!")
-    if popularity is None or popularity is "":
-        abort(400, "Field popularity must be required!")
-    if release_date is None or release_date is "":
-        abort(400, "Field release_date must be required!")
-    if revenue is None or revenue is "":
-        abort(400, "Field revenue must be required!")
-    if tagline is None or tagline is "":
-        abort(400, "Field tagline must be required!")
-    if title is None or title is "":
-        abort(400, "Field title must be required!")
-    if vote_average is None or vote_average is "":
-        abort(400, "Field vote_average must be required!")
-    if vote_count is None or vote_count is "":
-        abort(400, "Field vote_count must be required!")
-
     # get the parent director
     director = Directors.query.filter(
         Directors.id == director_id).one_or_none()
@@ -181,7 +333,11 @@ def create(director_id, movie):
     if director is None:
         abort(404, f"Director not found for ID: {director_id}!")
 
-    uid = movie.get("uid")
+    # The body was checked against swagger.yml before the call (validation.py)
+    uid = movie["uid"]
+    if snapshot.catalog is not None and snapshot.catalog.movie_id_by_uid(uid) is not None:
+        abort(409, f"Movie with UID {uid} exists already!")
+
     existing_movie = (
         Movies.query.filter(Movies.uid == uid).one_or_none()
     )
@@ -189,13 +345,19 @@ def create(director_id, movie):
     # Can we insert this director?
     if existing_movie is None:
 
-        # Create a movie schema instance
+        # Create a movie instance from the passed in movie
         schema = MoviesSchema()
-        new_movie = schema.load(movie, session=db.session)
+        new_movie = Movies(**movie)
 
-        # Add the movie to the director and database
+        # Add the movie to the director and database, the version of the
+        # director moves in one UPDATE without checking the one we read
         director.movies.append(new_movie)
-        db.session.commit()
+        bulk.touch(db.session, Directors.__table__, [director_id])
+        stats.refresh([director_id])
+        cache.invalidate("movies", "directors", "director:{}".format(director_id))
+        similar.changed([dict({column.key: getattr(new_movie, column.key) for column in similar.COLUMNS},
+                              director_id=director_id)])
+        writer.commit()
 
         # Serialize and return the newly created movie in the response
         data = schema.dump(new_movie)
@@ -207,6 +369,40 @@ def create(director_id, movie):
         abort(409, f"Movie with UID {uid} exists already!")
 
 
+def _update(director_id, movie_id, values):
+    # One UPDATE of the movie of that director, the database checks the uid
+    # is still unique, so a movie keeps its own uid
+    try:
+        found = bulk.update_row(db.session, Movies.__table__, movie_id, values,
+                                Movies.__table__.c.director_id == director_id)
+    except IntegrityError:
+        writer.rollback()
+        abort(409, f"Movie with UID {values.get('uid')} exists already!")
+
+    # Tell a missing director from a missing movie only when nothing matched
+    if not found:
+        if not _director_exists(director_id):
+            abort(404, f"Director not found for ID: {director_id}!")
+        abort(404, f"Movie not found for ID: {movie_id}!")
+
+    # The movies are part of the director representation
+    bulk.touch(db.session, Directors.__table__, [director_id])
+    if STATS_FIELDS.intersection(values):
+        stats.refresh([director_id])
+    cache.invalidate("movies", "directors", "director:{}".format(director_id),
+                     "movie:{}".format(movie_id))
+
+    # return updated movie in the response, read in the same transaction
+    fieldset = fieldsets.Fieldset(MoviesSchema, 'directors')
+    row = serializers.MOVIES.query(fieldset).filter(Movies.id == movie_id).one()
+    data = serializers.MOVIES.dump([row], fieldset)[0]
+    similar.changed([dict(data, director_id=director_id)])
+    writer.commit()
+
+    return data, 200
+
+
+@writer.grouped
 def update(director_id, movie_id, movie):
     """
     This function updates an existing movie related to the passed in
@@ -215,95 +411,26 @@ def update(director_id, movie_id, movie):
     :param director_id:       Id of the director the movie is related to
     :param movie_id:         Id of the movie to update
     :param movie:            The JSON containing the movie data
-    :return:                200 on success, 404 if not found, 409 if movie exists already
+    :return:                200 on success, 404 if not found, 409 if another movie has the uid
     """
-    # validate field
-    budget = movie.get("budget")
-    original_title = movie.get("original_title")
-    overview = movie.get("overview")
-    popularity = movie.get("popularity")
-    release_date = movie.get("release_date")
-    revenue = movie.get("revenue")
-    tagline = movie.get("tagline")
-    title = movie.get("title")
-    uid = movie.get("uid")
-    vote_average = movie.get("vote_average")
-    vote_count = movie.get("vote_count")
-
-    if budget is None or budget is "":
-        abort(400, "Field budget must be required!")
-    if original_title is None or original_title is "":
-        abort(400, "Field original_title must be required!")
-    if uid is None or uid is "":
-        abort(400, "Field uid must be required!")
-    if overview is None or overview is "":
-        abort(400, "Field overview must be required!")
-    if popularity is None or popularity is "":
-        abort(400, "Field popularity must be required!")
-    if release_date is None or release_date is "":
-        abort(400, "Field release_date must be required!")
-    if revenue is None or revenue is "":
-        abort(400, "Field revenue must be required!")
-    if tagline is None or tagline is "":
-        abort(400, "Field tagline must be required!")
-    if title is None or title is "":
-        abort(400, "Field title must be required!")
-    if vote_average is None or vote_average is "":
-        abort(400, "Field vote_average must be required!")
-    if vote_count is None or vote_count is "":
-        abort(400, "Field vote_count must be required!")
+    return _update(director_id, movie_id, movie)
 
-    check_director = (Directors.query.filter(
-        Directors.id == director_id)).one_or_none()
-
-    if check_director is not None:
 
-        existing_movie = (
-            Movies.query.filter(Movies.uid == uid).one_or_none()
-        )
-
-        # Can we insert this director?
-        if existing_movie is None:
-
-            update_movie = (
-                Movies.query.filter(Directors.id == director_id)
-                .filter(Movies.id == movie_id)
-                .one_or_none()
-            )
-
-            # Did we find an existing movie?
-            if update_movie is not None:
-
-                # turn the passed in movie into a db object
-                schema = MoviesSchema()
-                update = schema.load(movie, session=db.session)
-
-                # Set the id's to the movie we want to update
-                update.director_id = update_movie.director_id
-                update.id = update_movie.id
-
-                # merge the new object into the old and commit it to the db
-                db.session.merge(update)
-                db.session.commit()
-
-                # return updated movie in the response
-                data = schema.dump(update_movie)
-
-                return data, 200
-
-            # Otherwise, nope, didn't find that movie
-            else:
-                abort(404, f"Movie not found for ID: {movie_id}!")
-
-        # Otherwise, nope, director exists already
-        else:
-            abort(409, f"Movie with UID {uid} exists already!")
+@writer.grouped
+def patch(director_id, movie_id, movie):
+    """
+    This function updates the fields sent of an existing movie related to
+    the passed in director id, the other fields keep their value
 
-    # Otherwise, nope, didn't find that director
-    else:
-        abort(404, f"Director not found for ID: {director_id}!")
+    :param director_id:       Id of the director the movie is related to
+    :param movie_id:         Id of the movie to update
+    :param movie:            The JSON containing the fields to change
+    :return:                200 on success, 404 if not found, 409 if another movie has the uid
+    """
+    return _update(director_id, movie_id, movie)
 
 
+@writer.grouped
 def delete(director_id, movie_id):
     """
     This function deletes a movie from the movie structure
@@ -312,21 +439,23 @@ def delete(director_id, movie_id):
     :param movie_id:     Id of the movie to delete
     :return:            200 on successful delete, 404 if not found
     """
-    check_director = (Directors.query.filter(
-        Directors.id == director_id)).one_or_none()
-
-    if check_director is not None:
-        # Get the movie requested
-        movie = (
-            Movies.query.filter(Directors.id == director_id)
-            .filter(Movies.id == movie_id)
-            .one_or_none()
+    if _director_exists(director_id):
+        # One DELETE of the movie of that director, a movie changed or
+        # deleted meanwhile by another request is no conflict
+        deleted = db.session.execute(
+            Movies.__table__.delete()
+            .where(Movies.director_id == director_id)
+            .where(Movies.id == movie_id)
         )
 
         # did we find a movie?
-        if movie is not None:
-            db.session.delete(movie)
-            db.session.commit()
+        if deleted.rowcount > 0:
+            bulk.touch(db.session, Directors.__table__, [director_id])
+            stats.refresh([director_id])
+            cache.invalidate("movies", "directors", "director:{}".format(director_id),
+                             "movie:{}".format(movie_id))
+            similar.deleted([movie_id])
+            writer.commit()
             return make_response(
                 "Movie with ID {id} deleted successfully!".format(
                     id=movie_id), 200
@@ -341,20 +470,260 @@ def delete(director_id, movie_id):
         abort(404, f"Director not found for Id: {director_id}")
 
 
-def search_all(keyword):
-    """search data by field title with like
+def _bulk_directors(rows, errors):
+    # One query finds the directors the movies are related to
+    found = {
+        director.id for director in bulk.select_in(
+            db.session, [Directors.id], Directors.id, [row['director_id'] for _, row in rows])
+    }
+
+    kept = []
+    for index, row in rows:
+        if row['director_id'] in found:
+            kept.append((index, row))
+        else:
+            errors[index] = (404, "Director not found for ID: {}!".format(row['director_id']))
+    return kept
+
+
+def _bulk_invalidate(movie_ids, director_ids):
+    cache.invalidate("movies", "directors",
+                     *["director:{}".format(id) for id in director_ids],
+                     *["movie:{}".format(id) for id in movie_ids])
+
+
+@writer.grouped
+def bulk_create(movies):
+    """
+    This function creates many movies, each related to the director id it
+    carries, in one transaction, from a JSON array or NDJSON body
+
+    :param movies:      movies to create
+    :return:            status of every movie, 201 with its id when created,
+                        400 if invalid, 404 if the director is not found,
+                        409 if the uid exists already
+    """
+    items = bulk.read_items(movies)
+    rows, errors = bulk.validate(items, BULK_CREATE)
+    rows = _bulk_directors(rows, errors)
+
+    # One query finds the uids taken already
+    taken = {
+        movie.uid for movie in bulk.select_in(
+            db.session, [Movies.uid], Movies.uid, [row['uid'] for _, row in rows])
+    }
+
+    inserts = []
+    for index, row in rows:
+        if row['uid'] in taken:
+            errors[index] = (409, "Movie with UID {} exists already!".format(row['uid']))
+        else:
+            taken.add(row['uid'])
+            inserts.append((index, row))
+
+    statuses = {}
+    if len(inserts) > 0:
+        db.session.execute(Movies.__table__.insert(), [row for _, row in inserts])
+
+        # Read back the ids given by the database
+        ids = {
+            movie.uid: movie.id for movie in bulk.select_in(
+                db.session, [Movies.id, Movies.uid], Movies.uid,
+                [row['uid'] for _, row in inserts])
+        }
+        statuses = {index: {'id': ids[row['uid']]} for index, row in inserts}
+
+        director_ids = {row['director_id'] for _, row in inserts}
+        bulk.touch(db.session, Directors.__table__, director_ids)
+        stats.refresh(director_ids)
+        _bulk_invalidate([], director_ids)
+        similar.changed([dict(row, id=ids[row['uid']]) for _, row in inserts])
+        writer.commit()
+
+    return bulk.result(len(items), statuses, errors, 201), 200
+
+
+@writer.grouped
+def bulk_update(movies):
+    """
+    This function updates many existing movies in one transaction, from a
+    JSON array or NDJSON body
+
+    :param movies:      movies to update, each with its id and director id
+    :return:            status of every movie, 200 when updated, 400 if
+                        invalid, 404 if the movie or director is not found,
+                        409 if the uid belongs to another movie
+    """
+    items = bulk.read_items(movies)
+    rows, errors = bulk.validate(items, BULK_UPDATE)
+    rows = _bulk_directors(rows, errors)
+
+    # One query finds the movies to update, one the owners of the uids
+    found = {
+        movie.id: movie.director_id for movie in bulk.select_in(
+            db.session, [Movies.id, Movies.director_id], Movies.id, [row['id'] for _, row in rows])
+    }
+    owners = {
+        movie.uid: movie.id for movie in bulk.select_in(
+            db.session, [Movies.id, Movies.uid], Movies.uid, [row['uid'] for _, row in rows])
+    }
+
+    updates, seen = [], set()
+    for index, row in rows:
+        if row['id'] not in found:
+            errors[index] = (404, "Movie not found for ID: {}!".format(row['id']))
+        elif row['id'] in seen:
+            errors[index] = (409, "Movie with ID {} is listed twice!".format(row['id']))
+        elif owners.setdefault(row['uid'], row['id']) != row['id']:
+            errors[index] = (409, "Movie with UID {} exists already!".format(row['uid']))
+        else:
+            seen.add(row['id'])
+            updates.append((index, row))
+
+    if len(updates) > 0:
+        bulk.update_rows(db.session, Movies.__table__, [row for _, row in updates])
+
+        # Both the old and the new director of a movie change
+        director_ids = {row['director_id'] for _, row in updates}
+        director_ids.update(found[row['id']] for _, row in updates)
+        bulk.touch(db.session, Directors.__table__, director_ids)
+        stats.refresh(director_ids)
+        _bulk_invalidate(seen, director_ids)
+        similar.changed([row for _, row in updates])
+        writer.commit()
+
+    statuses = {index: {'id': row['id']} for index, row in updates}
+    return bulk.result(len(items), statuses, errors, 200), 200
+
+
+@writer.grouped
+def bulk_delete(movies=None):
+    """
+    This function deletes many movies in one transaction, from a JSON array
+    or NDJSON body of ids
+
+    :param movies:      ids of the movies to delete
+    :return:            status of every movie, 200 when deleted, 400 if
+                        invalid, 404 if not found
+    """
+    items = bulk.read_items(movies)
+    ids, errors = bulk.validate_ids(items)
+
+    found = {
+        movie.id: movie.director_id for movie in bulk.select_in(
+            db.session, [Movies.id, Movies.director_id], Movies.id, [id for _, id in ids])
+    }
+
+    for index, id in ids:
+        if id not in found:
+            errors[index] = (404, "Movie not found for ID: {}!".format(id))
+
+    if len(found) > 0:
+        for chunk in bulk.chunks(found):
+            db.session.execute(Movies.__table__.delete().where(Movies.id.in_(chunk)))
 
-    Keyword arguments:  keyword -- word for search data use like
-    Return: data directors with title like keyword
+        director_ids = set(found.values())
+        bulk.touch(db.session, Directors.__table__, director_ids)
+        stats.refresh(director_ids)
+        _bulk_invalidate(found, director_ids)
+        similar.deleted(list(found))
+        writer.commit()
+
+    statuses = {index: {'id': id} for index, id in ids if index not in errors}
+    return bulk.result(len(items), statuses, errors, 200), 200
+
+
+def export_all(format='ndjson'):
     """
-    search = "%{}%".format(keyword)
-    movies = Movies.query.filter(Movies.title.like(search)).all()
+    This function responds to a request for /api/movies/export
+    with every movie streamed as NDJSON or CSV, sorted by id asc
+
+    :param format:      ndjson (one json object per line) or csv
+    :return:            chunked response with all the movies
+    """
+    return export.stream(EXPORT_COLUMNS, Movies.id, format, 'movies')
+
+
+@cache.cached("movies")
+def search_all(keyword, limit=None, fields=None, include=None):
+    """search data by field title, original title, overview, tagline and
+    director name with the full-text index
+
+    Keyword arguments:  keyword -- words for search data, matched as prefixes
+                        limit -- maximum number of movies to return
+                        fields -- comma separated fields to return
+                        include -- comma separated relations to nest
+    Return: data movies matching keyword, best match first
+    """
+    fieldset = fieldsets.Fieldset(MoviesSchema, 'directors', fields, include)
+    movies = search.search_movies(keyword, limit, _load_options(fieldset))
+
+    if(len(movies) == 0):
+        return abort(404, f"Movies data not found with keyword {keyword}!")
+
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = conditional.check(
+        [(movie.id, movie.version, movie.directors.version) for movie in movies],
+        [date for movie in movies for date in (movie.updated_at, movie.directors.updated_at)])
+    if not_modified is not None:
+        return not_modified
 
     # Serialize the data for the response
-    movie_schema = MoviesSchema(many=True)
+    movie_schema = fieldset.schema(MoviesSchema, many=True)
     data = movie_schema.dump(movies)
 
-    if(len(data) == 0):
-        return abort(404, f"Movies data not found with keyword {keyword}!")
+    return data, 200, headers
+
+
+@cache.cached("movies")
+def read_similar(id, limit=10, fields=None, include=None):
+    """
+    This function responds to a request for /api/movies/{id}/similar
+    with the movies closest to one movie by their words, budget,
+    popularity, vote average and release date, most similar first
+
+    :param id:          Id of the movie
+    :param limit:       maximum number of movies to return
+    :param fields:      comma separated fields to return, directors.name
+                        style for the fields of the director
+    :param include:     comma separated relations to nest, empty for none
+    :return:            json list of movies with their similarity, 404 if
+                        not found
+    """
+    fieldset = fieldsets.Fieldset(MoviesSchema, 'directors', fields, include)
+
+    # One product with the mapped matrix scores every movie. The movies
+    # deleted by another worker since the build are only missing from the
+    # rows, twice as many are scored until limit movies are left or the
+    # index has no more
+    query = serializers.MOVIES.query(fieldset)
+    count, scores, rows, wanted = limit, {}, {}, [id]
+    while True:
+        ranked, = similar.index.search([id], count)
+        if ranked is None:
+            abort(404, f"Movie not found for ID: {id}!")
+        wanted += [movie_id for movie_id, _ in ranked if movie_id not in scores]
+        scores.update(ranked)
+        rows.update((movie.id, movie) for movie in query.filter(Movies.id.in_(wanted)))
+        if id not in rows:
+            abort(404, f"Movie not found for ID: {id}!")
+        if len(rows) > limit or len(ranked) < count:
+            break
+        count, wanted = count * 2, []
+
+    del rows[id]
+    movies = sorted(rows.values(), key=lambda movie: -scores[movie.id])[:limit]
+
+    if(len(movies) == 0):
+        return abort(404, f"Movies data not found!")
+
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = _check_rows(movies)
+    if not_modified is not None:
+        return not_modified
 
-    return data
\ No newline at end of file
+    # Serialize the list of movies from our data, with their similarity
+    data = serializers.MOVIES.dump(movies, fieldset)
+    for item, movie in zip(data, movies):
+        item['similarity'] = round(scores[movie.id], 4)
+    return data, 200, headers
@@ -0,0 +1,167 @@
+"""
+This is the pagination module and supports the keyset (cursor) paging
+of the directors and movies lists
+"""
+
+import base64
+import binascii
+import json
+from datetime import date
+
+from flask import abort
+from sqlalchemy import and_, false, or_, tuple_
+
+
+def encode_cursor(signature, values, direction):
+    """
+    Build the opaque cursor token given to the client
+
+    :param signature:   sort the cursor belongs to, e.g. "title:desc"
+    :param values:      sort key values of the boundary row, id last
+    :param direction:   "next" or "prev"
+    :return:            url safe token string
+    """
+    payload = json.dumps({"s": signature, "v": values, "d": direction},
+                         separators=(",", ":"), default=_json_value)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def _json_value(value):
+    # dates travel as ISO strings, the column type reads them back
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError("Cursor value {!r} is not JSON serializable".format(value))
+
+
+def decode_cursor(token, signature):
+    """
+    Read back a cursor token, 400 if the token is damaged or was issued
+    for another sort
+
+    :param token:       token string sent by the client
+    :param signature:   sort of the current request
+    :return:            tuple of sort key values and direction
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, direction = payload["v"], payload["d"]
+        valid = payload["s"] == signature and direction in ("next", "prev")
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        valid = False
+
+    if not valid:
+        abort(400, "Invalid cursor!")
+
+    return values, direction
+
+
+def _segments(keys, values):
+    """
+    Filters matching the rows that come after values in keys order, as
+    consecutive segments the database can each read straight from an
+    index. NULL sorts before any value, like SQLite does.
+    """
+    column, desc = keys[0]
+    if len(keys) == 1:
+        return [column < values[0] if desc else column > values[0]]
+
+    tail, tail_desc = keys[1]
+    if len(keys) == 2 and tail.primary_key and tail_desc == desc:
+        value, last = values
+        if value is None:
+            if desc:
+                return [and_(column.is_(None), tail < last)]
+            return [and_(column.is_(None), tail > last), column.isnot(None)]
+
+        # Row value comparison lets the database seek the (key, id) index,
+        # the values are bound with the column types
+        bound = tuple_(value, last, types=[column.type, tail.type])
+        if desc:
+            return [tuple_(column, tail) < bound, column.is_(None)]
+        return [tuple_(column, tail) > bound]
+
+    clauses = []
+    for i, (column, desc) in enumerate(keys):
+        equal = [
+            keys[j][0].is_(None) if values[j] is None else keys[j][0] == values[j]
+            for j in range(i)
+        ]
+        if values[i] is None:
+            beyond = false() if desc else column.isnot(None)
+        elif desc:
+            beyond = or_(column < values[i], column.is_(None))
+        else:
+            beyond = column > values[i]
+        clauses.append(and_(*equal, beyond))
+
+    return [or_(*clauses)]
+
+
+def keyset_page(query, keys, limit, cursor, signature):
+    """
+    Fetch one page of query sorted by keys, starting from cursor
+
+    :param query:       query to page through
+    :param keys:        list of (column, descending) sort keys, ending with
+                        a unique column as tiebreaker
+    :param limit:       page size
+    :param cursor:      token from a previous page, None for the first page
+    :param signature:   sort the tokens are bound to
+    :return:            tuple of page rows, next token and prev token
+    """
+    direction = "next"
+    if cursor is not None:
+        values, direction = decode_cursor(cursor, signature)
+        if len(values) != len(keys):
+            abort(400, "Invalid cursor!")
+
+    # A previous page is read backwards from the cursor and flipped again
+    walk = keys if direction == "next" else [(column, not desc) for column, desc in keys]
+    query = query.order_by(*[
+        column.desc().nullslast() if desc else column.asc().nullsfirst()
+        for column, desc in walk
+    ])
+
+    if cursor is None:
+        rows = query.limit(limit + 1).all()
+    else:
+        rows = []
+        for segment in _segments(walk, values):
+            rows += query.filter(segment).limit(limit + 1 - len(rows)).all()
+            if len(rows) > limit:
+                break
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        rows.reverse()
+
+    def token(row, token_direction):
+        return encode_cursor(
+            signature, [getattr(row, column.key) for column, _ in keys], token_direction)
+
+    next_token = prev_token = None
+    if len(rows) > 0:
+        if more or direction == "prev":
+            next_token = token(rows[-1], "next")
+        if cursor is not None and (more or direction == "next"):
+            prev_token = token(rows[0], "prev")
+
+    return rows, next_token, prev_token
+
+
+def cursor_headers(next_token, prev_token):
+    """
+    Response headers carrying the cursors of the neighbour pages
+
+    :param next_token:  token of the next page, None on the last page
+    :param prev_token:  token of the previous page, None on the first page
+    :return:            dict of headers
+    """
+    headers = {}
+    if next_token is not None:
+        headers["X-Next-Cursor"] = next_token
+    if prev_token is not None:
+        headers["X-Prev-Cursor"] = prev_token
+    return headers
@@ -0,0 +1,262 @@
+"""
+This is the search module and supports the full-text search over the
+directors and movies data
+"""
+
+import re
+
+from flask import abort
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload
+from config import db
+from models import Directors, DirectorsSchema, Movies, MoviesSchema
+import cache
+import conditional
+import fieldsets
+import serializers
+
+
+# bm25 weights of the movies_fts columns, in declaration order:
+# title, original_title, overview, tagline, director_name
+MOVIES_RANK = "bm25(movies_fts, 10.0, 5.0, 1.0, 2.0, 3.0)"
+
+# PostgreSQL has no fts5, the documents are built with the same weights
+# order at query time: A title, B original_title and director_name,
+# C tagline, D overview
+MOVIES_DOCUMENT = """
+    setweight(to_tsvector('simple', coalesce(movies.title, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(movies.original_title, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(directors.name, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(movies.tagline, '')), 'C') ||
+    setweight(to_tsvector('simple', coalesce(movies.overview, '')), 'D')
+"""
+DIRECTORS_DOCUMENT = "to_tsvector('simple', coalesce(directors.name, ''))"
+
+INDEX_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5(
+        title, original_title, overview, tagline, director_name,
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS directors_fts USING fts5(
+        name,
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies
+    BEGIN
+        INSERT INTO movies_fts (rowid, title, original_title, overview, tagline, director_name)
+        VALUES (new.id, new.title, new.original_title, new.overview, new.tagline,
+                (SELECT name FROM directors WHERE id = new.director_id));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS movies_fts_update
+    AFTER UPDATE OF title, original_title, overview, tagline, director_id ON movies
+    BEGIN
+        DELETE FROM movies_fts WHERE rowid = old.id;
+        INSERT INTO movies_fts (rowid, title, original_title, overview, tagline, director_name)
+        VALUES (new.id, new.title, new.original_title, new.overview, new.tagline,
+                (SELECT name FROM directors WHERE id = new.director_id));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies
+    BEGIN
+        DELETE FROM movies_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS directors_fts_insert AFTER INSERT ON directors
+    BEGIN
+        INSERT INTO directors_fts (rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS directors_fts_update AFTER UPDATE OF name ON directors
+    BEGIN
+        DELETE FROM directors_fts WHERE rowid = old.id;
+        INSERT INTO directors_fts (rowid, name) VALUES (new.id, new.name);
+        UPDATE movies_fts SET director_name = new.name
+        WHERE rowid IN (SELECT id FROM movies WHERE director_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS directors_fts_delete AFTER DELETE ON directors
+    BEGIN
+        DELETE FROM directors_fts WHERE rowid = old.id;
+    END
+    """,
+]
+
+
+def init_index():
+    """
+    Create the full-text index tables and the triggers keeping them in
+    sync with the directors and movies tables, and fill the index the
+    first time it is created. Only SQLite needs them.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return
+
+    with db.engine.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'movies_fts'"
+        )).first()
+
+        for statement in INDEX_DDL:
+            connection.execute(text(statement))
+
+        if exists is None:
+            _fill_index(connection)
+
+
+def rebuild_index():
+    """
+    Drop the content of the full-text index and fill it again from the
+    directors and movies tables
+    """
+    with db.engine.begin() as connection:
+        connection.execute(text("DELETE FROM movies_fts"))
+        connection.execute(text("DELETE FROM directors_fts"))
+        _fill_index(connection)
+
+
+def _fill_index(connection):
+    connection.execute(text(
+        """
+        INSERT INTO movies_fts (rowid, title, original_title, overview, tagline, director_name)
+        SELECT movies.id, movies.title, movies.original_title, movies.overview,
+               movies.tagline, directors.name
+        FROM movies LEFT JOIN directors ON directors.id = movies.director_id
+        """
+    ))
+    connection.execute(text(
+        "INSERT INTO directors_fts (rowid, name) SELECT id, name FROM directors"
+    ))
+
+
+def match_expression(keyword, dialect="sqlite"):
+    """
+    Turn a free text keyword into a match expression where every word of
+    the keyword must match as a prefix
+
+    :param keyword:     free text typed by the client
+    :param dialect:     sqlite for an fts5 expression, postgresql for a tsquery
+    :return:            match expression, None if keyword has no words
+    """
+    terms = re.findall(r"\w+", keyword)
+    if len(terms) == 0:
+        return None
+
+    if dialect == "postgresql":
+        return " & ".join("{}:*".format(term) for term in terms)
+    return " ".join('"{}"*'.format(term) for term in terms)
+
+
+def search_movies(keyword, limit=None, options=None):
+    """
+    Ranked list of movies matching keyword on title, original title,
+    overview, tagline or director name
+
+    :param keyword:     free text to search
+    :param limit:       maximum number of movies to return
+    :param options:     loader options of the query, the director joined by default
+    :return:            list of Movies, best match first
+    """
+    ids = _ranked_ids(
+        "SELECT rowid FROM movies_fts WHERE movies_fts MATCH :match "
+        "ORDER BY " + MOVIES_RANK,
+        "SELECT movies.id FROM movies LEFT JOIN directors ON directors.id = movies.director_id "
+        "WHERE ({0}) @@ to_tsquery('simple', :match) "
+        "ORDER BY ts_rank({0}, to_tsquery('simple', :match)) DESC, movies.id".format(MOVIES_DOCUMENT),
+        keyword, limit
+    )
+    if options is None:
+        options = [joinedload(Movies.directors)]
+    return _load_ranked(Movies.query.options(*options), Movies, ids)
+
+
+def search_directors(keyword, limit=None, query=None):
+    """
+    Ranked list of directors matching keyword on name
+
+    :param keyword:     free text to search
+    :param limit:       maximum number of directors to return
+    :param query:       query of the directors, like the rows of
+                        serializers.DIRECTORS, Directors.query by default
+    :return:            list of Directors or rows, best match first
+    """
+    ids = _ranked_ids(
+        "SELECT rowid FROM directors_fts WHERE directors_fts MATCH :match "
+        "ORDER BY rank",
+        "SELECT directors.id FROM directors "
+        "WHERE {0} @@ to_tsquery('simple', :match) "
+        "ORDER BY ts_rank({0}, to_tsquery('simple', :match)) DESC, directors.id".format(DIRECTORS_DOCUMENT),
+        keyword, limit
+    )
+    if query is None:
+        query = Directors.query
+    return _load_ranked(query, Directors, ids)
+
+
+def _ranked_ids(statement, postgresql_statement, keyword, limit):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql_statement
+
+    match = match_expression(keyword, dialect)
+    if match is None:
+        return []
+
+    params = {"match": match}
+    if limit is not None:
+        statement += " LIMIT :limit"
+        params["limit"] = limit
+
+    return [row[0] for row in db.session.execute(text(statement), params)]
+
+
+def _load_ranked(query, model, ids):
+    if len(ids) == 0:
+        return []
+
+    rows = {row.id: row for row in query.filter(model.id.in_(ids))}
+    return [rows[id] for id in ids if id in rows]
+
+
+@cache.cached("directors", "movies")
+def search_all(keyword, limit=10):
+    """
+    This function responds to a request for /api/search/{keyword}
+    with the best matching directors and movies for the keyword
+
+    :param keyword:     free text to search
+    :param limit:       maximum number of directors and of movies to return
+    :return:            json object with directors and movies lists, 404 if nothing matches
+    """
+    fieldset = fieldsets.Fieldset(DirectorsSchema, "movies")
+    directors = search_directors(keyword, limit, serializers.DIRECTORS.query(fieldset))
+    movies = search_movies(keyword, limit)
+
+    if len(directors) == 0 and len(movies) == 0:
+        return abort(404, f"Data not found with keyword {keyword}!")
+
+    # Answer 304 before serializing when the client copy is current
+    headers, not_modified = conditional.check(
+        [(director.id, director.version) for director in directors] +
+        [(movie.id, movie.version, movie.directors.version) for movie in movies],
+        [director.updated_at for director in directors] +
+        [date for movie in movies for date in (movie.updated_at, movie.directors.updated_at)])
+    if not_modified is not None:
+        return not_modified
+
+    # Serialize the data for the response
+    data = {
+        "directors": serializers.DIRECTORS.dump(directors, fieldset),
+        "movies": MoviesSchema(many=True).dump(movies),
+    }
+    return data, 200, headers
@@ -0,0 +1,269 @@
+"""
+This is the serializers module and supports the fast path of the list
+endpoints: the rows are selected as plain tuples and encoded by orjson,
+with serializers compiled once from the marshmallow schemas of models.py
+so the JSON keeps the shape of a schema dump
+"""
+
+import operator
+
+import orjson
+from flask import Response
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import configure_mappers
+from config import app, db
+from models import Directors, DirectorsSchema, Movies, MoviesSchema
+import bulk
+import metrics
+import pagination
+
+
+# Columns every fast query selects, they make the ETag of the response
+REQUIRED = ("id", "version", "updated_at")
+
+
+def _getter(positions):
+    # itemgetter of a single position returns the value, not a tuple
+    if len(positions) == 0:
+        return lambda row: ()
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda row: (row[position],)
+    return operator.itemgetter(*positions)
+
+
+class Serializer:
+    """
+    Encoder of the rows of one model and of the relation nested in it,
+    the fields, columns and relation are read once from the schema
+    """
+
+    def __init__(self, schema_class, model, relation, page_size=None, link=None):
+        """
+        :param schema_class:    marshmallow schema of the model
+        :param model:           model the schema dumps
+        :param relation:        name of the nested relation
+        :param page_size:       items of a many relation nested at most, the
+                                rest is behind the relation_next link
+        :param link:            function of the item id and of the id of its
+                                last nested item giving the relation_next link
+        """
+        configure_mappers()
+        fields = schema_class().fields
+        prop = inspect(model).relationships[relation]
+        (local, remote), = prop.local_remote_pairs
+
+        self.model = model
+        self.relation = relation
+        self.related_model = prop.mapper.class_
+        self.fields = tuple(sorted(name for name in fields if name != relation))
+        self.related_fields = tuple(sorted(fields[relation].schema.fields))
+        # many: a list fetched in a second query, else a row joined in
+        self.many = prop.uselist
+        self.local = local
+        self.remote = remote
+        self.order_by = list(prop.order_by or ())
+        self.related_key = inspect(self.related_model).primary_key[0]
+        self.page_size = page_size
+        self.link = link
+
+        for name in self.fields:
+            getattr(model, name)
+        for name in self.related_fields:
+            getattr(self.related_model, name)
+
+    def _own(self, fieldset, required):
+        requested = self.fields if fieldset.columns is None else tuple(sorted(fieldset.columns))
+        return requested, list(requested) + sorted(set(REQUIRED + tuple(required)) - set(requested))
+
+    def _related(self, fieldset):
+        if not fieldset.nest:
+            return None
+        if fieldset.related_columns is None:
+            return self.related_fields
+        return tuple(sorted(fieldset.related_columns))
+
+    def _joined(self, fieldset):
+        related = self._related(fieldset) or ()
+        return list(related) + sorted(set(REQUIRED) - set(related))
+
+    def query(self, fieldset, required=()):
+        """
+        Query of the rows to serialize, to order and page like a model query.
+        A joined relation comes as columns named relation_field.
+
+        :param fieldset:    Fieldset of the request
+        :param required:    names of the columns the endpoint needs besides
+                            the requested ones, like the sort key
+        :return:            Query of row tuples
+        """
+        _, selected = self._own(fieldset, required)
+        columns = [getattr(self.model, name) for name in selected]
+        if self.many:
+            return db.session.query(*columns)
+
+        columns += [getattr(self.related_model, name).label("{}_{}".format(self.relation, name))
+                    for name in self._joined(fieldset)]
+        return (
+            db.session.query(*columns)
+            .select_from(self.model)
+            .outerjoin(self.related_model, self.local == self.remote)
+        )
+
+    def _related_rows(self, names, ids):
+        # The key of the related row comes second, the next link needs it
+        columns = [self.related_key] + [getattr(self.related_model, name) for name in names]
+        groups = {}
+        for chunk in bulk.chunks(ids):
+            if self.page_size is None:
+                rows = (
+                    db.session.query(self.remote, *columns)
+                    .filter(self.remote.in_(chunk))
+                    .order_by(self.remote, *self.order_by)
+                )
+            elif len(chunk) == 1:
+                # One item reads its first page straight from the index
+                rows = (
+                    db.session.query(self.remote, *columns)
+                    .filter(self.remote == chunk[0])
+                    .order_by(*self.order_by)
+                    .limit(self.page_size + 1)
+                )
+            else:
+                # One more than the page per item tells whether there is a next
+                # page, the database numbers the rows of each item
+                number = func.row_number().over(
+                    partition_by=self.remote, order_by=self.order_by).label("number")
+                numbered = (
+                    db.session.query(self.remote.label("parent"), *columns, number)
+                    .filter(self.remote.in_(chunk))
+                    .subquery()
+                )
+                rows = (
+                    db.session.query(numbered)
+                    .filter(numbered.c.number <= self.page_size + 1)
+                    .order_by(numbered.c.parent, numbered.c.number)
+                )
+            for row in rows:
+                groups.setdefault(row[0], []).append(row)
+        return groups
+
+    def _page(self, id, children, key):
+        # First page of the nested list and the link to the rest
+        if self.page_size is None or len(children) <= self.page_size:
+            return children, None
+        children = children[:self.page_size]
+        return children, self.link(id, key(children[-1]))
+
+    def dump(self, rows, fieldset, required=()):
+        """
+        Dicts of rows, fetching the nested lists in one more query
+
+        :param rows:        rows of the query method, same fieldset
+        :param fieldset:    Fieldset of the request
+        :param required:    same as for the query method
+        :return:            list of dicts
+        """
+        with metrics.phase():
+            requested, selected = self._own(fieldset, required)
+            own = _getter([selected.index(name) for name in requested])
+            related = self._related(fieldset)
+
+            if related is None:
+                items = [dict(zip(requested, own(row))) for row in rows]
+
+            elif self.many:
+                nested = _getter([index + 2 for index in range(len(related))])
+                id_position = selected.index("id")
+                groups = self._related_rows(related, [row[id_position] for row in rows])
+                items = []
+                for row in rows:
+                    item = dict(zip(requested, own(row)))
+                    children, link = self._page(
+                        row[id_position], groups.get(row[id_position], ()), operator.itemgetter(1))
+                    item[self.relation] = [dict(zip(related, nested(child))) for child in children]
+                    if self.page_size is not None:
+                        item[self.relation + "_next"] = link
+                    items.append(item)
+
+            else:
+                offset = len(selected)
+                nested = _getter([offset + index for index in range(len(related))])
+                id_position = offset + self._joined(fieldset).index("id")
+                items = []
+                for row in rows:
+                    item = dict(zip(requested, own(row)))
+                    item[self.relation] = (None if row[id_position] is None
+                                           else dict(zip(related, nested(row))))
+                    items.append(item)
+
+            return items
+
+    def dump_item(self, item, related, fieldset):
+        """
+        Dict of one item already in memory, like the rows of the catalog
+        snapshot (snapshot.py)
+
+        :param item:        dict of the columns of the model
+        :param related:     dict of the related row, a list of them for a
+                            many relation in the relation order, None when
+                            there is none
+        :param fieldset:    Fieldset of the request
+        :return:            dict
+        """
+        with metrics.phase():
+            requested, _ = self._own(fieldset, ())
+            data = {name: item[name] for name in requested}
+            names = self._related(fieldset)
+            if names is not None:
+                if self.many:
+                    children, link = self._page(
+                        item[self.local.key], related, operator.itemgetter(self.related_key.key))
+                    data[self.relation] = [{name: child[name] for name in names} for child in children]
+                    if self.page_size is not None:
+                        data[self.relation + "_next"] = link
+                else:
+                    data[self.relation] = (None if related is None
+                                           else {name: related[name] for name in names})
+            return data
+
+    def dumps(self, rows, fieldset, required=()):
+        """
+        JSON list of rows, same arguments as the dump method
+
+        :return:            bytes
+        """
+        with metrics.phase():
+            # sorted keys like the json encoder of Flask
+            return orjson.dumps(self.dump(rows, fieldset, required), option=orjson.OPT_SORT_KEYS)
+
+
+def response(body, headers):
+    """
+    Response tuple of an encoded JSON body, connexion passes a Response
+    through where it would encode a list again
+
+    :param body:        bytes from Serializer.dumps
+    :param headers:     dict of headers
+    :return:            tuple the endpoints return
+    """
+    return Response(body, mimetype="application/json"), 200, headers
+
+
+def filmography_link(director_id, movie_id):
+    """
+    Link of the movies of a director after movie_id, the page of movies
+    nested in a director continues there
+
+    :param director_id: id of the director
+    :param movie_id:    id of the last movie nested
+    :return:            URL path of /api/directors/{director_id}/movies
+    """
+    cursor = pagination.encode_cursor("id:desc", [movie_id], "next")
+    return "/api/directors/{}/movies?cursor={}".format(director_id, cursor)
+
+
+DIRECTORS = Serializer(DirectorsSchema, Directors, "movies",
+                       app.config["FILMOGRAPHY_PAGE_SIZE"], filmography_link)
+
+MOVIES = Serializer(MoviesSchema, Movies, "directors")
@@ -0,0 +1,452 @@
+"""
+This is the similar module and supports the similar movies endpoint.
+Every movie is a vector of the TF-IDF weights of the words of its title,
+tagline and overview, hashed into SIMILAR_TEXT_DIMS buckets, next to its
+scaled budget, popularity, vote average and release date. The vectors are
+normalized, so one matrix product with the matrix of all the movies gives
+their cosine similarity.
+
+The matrix is built once into a .npy file beside SIMILAR_INDEX_PATH and
+memory-mapped read-only, the workers share its pages. The .npz file of the
+ids, the directors and the weights names the .npy it goes with, so moving
+it in place switches both at once. The index is built again when it was
+made from another state of the catalog, which every worker checks each
+SIMILAR_INDEX_INTERVAL seconds. The movies written by a worker go to a
+small matrix of changes next to it and the movies it deleted are hidden,
+the movies of its deleted directors too; the writes of the other workers
+show up once the index is built again.
+"""
+
+import glob
+import math
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from datetime import date
+
+import numpy as np
+from sqlalchemy import event, func, select
+from config import app, db
+from models import Movies
+
+
+# Columns a vector is made of, with the director the movie is deleted with
+COLUMNS = (Movies.id, Movies.director_id, Movies.title, Movies.tagline, Movies.overview,
+           Movies.budget, Movies.popularity, Movies.vote_average, Movies.release_date)
+
+# Text fields and the weight of their words, a word of the title counts twice
+TEXT_FIELDS = (("title", 2.0), ("tagline", 1.0), ("overview", 1.0))
+
+# Weight of the standardized numbers next to the unit text vector
+NUMBER_WEIGHT = 0.1
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def _words(movie):
+    counts = {}
+    for field, weight in TEXT_FIELDS:
+        for word in WORD.findall((movie[field] or "").lower()):
+            counts[word] = counts.get(word, 0.0) + weight
+    return counts
+
+
+def _buckets(movie, dims):
+    # crc32 rather than hash, which changes from one process to the next
+    buckets = {}
+    for word, count in _words(movie).items():
+        bucket = zlib.crc32(word.encode()) % dims
+        buckets[bucket] = buckets.get(bucket, 0.0) + count
+    return buckets
+
+
+def _numbers(movie):
+    released = movie["release_date"]
+    if isinstance(released, str):
+        released = date.fromisoformat(released)
+    return [
+        math.log1p(max(movie["budget"] or 0, 0)),
+        math.log1p(max(movie["popularity"] or 0, 0)),
+        movie["vote_average"] or 0.0,
+        released.toordinal() / 365.25,
+    ]
+
+
+def signature(connection):
+    """
+    State of the catalog an index is built from, another one means the
+    movies changed since
+
+    :param connection:  connection or session to read it with
+    :return:            string
+    """
+    count, last_id, updated_at = connection.execute(
+        select(func.count(Movies.id), func.max(Movies.id), func.max(Movies.updated_at))).one()
+    return "{}|{}|{}|{}".format(app.config["SQLALCHEMY_DATABASE_URI"], count, last_id, updated_at)
+
+
+class Index:
+    """
+    Matrix of the movie vectors, one row per movie, with the words weights
+    and the number scales it was built with so the vectors of new movies
+    land in the same space
+    """
+
+    def __init__(self, path, text_dims=1024, interval=60.0):
+        """
+        :param path:        .npy name of the matrix, every build writes
+                            its own beside it, named by the .npz file of
+                            the ids and the weights
+        :param text_dims:   buckets of the words
+        :param interval:    seconds between two checks of the state of the
+                            catalog
+        """
+        self.path = path
+        self.base = os.path.splitext(path)[0]
+        self.meta_path = self.base + ".npz"
+        self.text_dims = text_dims
+        self.interval = interval
+        self.checked = 0.0
+        self.state = None
+        self.lock = threading.Lock()
+        # one thread builds or maps the files, the others wait for it
+        self.loading = threading.Lock()
+        self.vectors = None
+        self.ids = None
+        self.directors = None
+        self.rows = {}
+        self.idf = None
+        self.mean = None
+        self.std = None
+        # movies written by this worker since the build, they hide their
+        # row of the matrix
+        self.changed_ids = np.empty(0, dtype=np.int64)
+        self.changed = np.empty((0, text_dims + 4), dtype=np.float32)
+        self.changed_directors = np.empty(0, dtype=np.int64)
+        self.hidden = np.empty(0, dtype=np.int64)
+        # movies deleted by this worker since the build
+        self.removed = frozenset()
+
+    def _vectors(self, movies):
+        matrix = np.zeros((len(movies), self.text_dims + 4), dtype=np.float32)
+        for position, movie in enumerate(movies):
+            for bucket, count in _buckets(movie, self.text_dims).items():
+                # sublinear term frequency
+                matrix[position, bucket] = (1.0 + math.log(count)) * self.idf[bucket]
+            matrix[position, self.text_dims:] = _numbers(movie)
+
+        text = matrix[:, :self.text_dims]
+        norms = np.linalg.norm(text, axis=1, keepdims=True)
+        text /= np.where(norms == 0, 1.0, norms)
+        numbers = matrix[:, self.text_dims:]
+        numbers -= self.mean
+        numbers *= NUMBER_WEIGHT / self.std
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+    def build(self):
+        """
+        Compute the vectors of every movie into new index files, the .npz
+        is written aside and moved in place last so the workers never map
+        half a file nor the .npy of another build
+        """
+        with db.engine.connect() as connection:
+            with connection.begin():
+                state = signature(connection)
+                movies = [row._mapping for row in connection.execute(
+                    select(*COLUMNS).order_by(Movies.id))]
+
+        # smoothed inverse document frequency of the buckets
+        frequencies = np.zeros(self.text_dims)
+        for movie in movies:
+            frequencies[list(_buckets(movie, self.text_dims))] += 1
+        self.idf = (np.log((1 + len(movies)) / (1 + frequencies)) + 1).astype(np.float32)
+        numbers = np.array([_numbers(movie) for movie in movies] or [[0.0] * 4])
+        self.mean = numbers.mean(axis=0).astype(np.float32)
+        self.std = np.where(numbers.std(axis=0) == 0, 1.0, numbers.std(axis=0)).astype(np.float32)
+
+        vectors = self._vectors(movies)
+        ids = np.array([movie["id"] for movie in movies], dtype=np.int64)
+        directors = _directors(movies)
+
+        # the .npy of a build is never replaced, only the .npz naming it
+        vectors_path = "{}.{}.npy".format(self.base, uuid.uuid4().hex)
+        suffix = ".{}.tmp".format(os.getpid())
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(vectors_path + suffix, "wb") as vectors_file:
+            np.save(vectors_file, vectors)
+        os.replace(vectors_path + suffix, vectors_path)
+        with open(self.meta_path + suffix, "wb") as meta_file:
+            np.savez(meta_file, ids=ids, directors=directors, idf=self.idf, mean=self.mean,
+                     std=self.std, signature=np.array(state),
+                     vectors=np.array(os.path.basename(vectors_path)))
+        os.replace(self.meta_path + suffix, self.meta_path)
+
+        # the workers still mapping an older .npy keep its pages
+        for path in glob.glob(glob.escape(self.base) + ".*.npy"):
+            if path != vectors_path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _open(self):
+        # a build may remove the .npy named by the .npz read just before,
+        # the new .npz names the new one
+        for attempt in range(3):
+            with np.load(self.meta_path) as meta:
+                arrays = {name: meta[name] for name in
+                          ("ids", "directors", "idf", "mean", "std", "signature", "vectors")}
+            try:
+                vectors = np.load(os.path.join(os.path.dirname(self.meta_path) or ".",
+                                               str(arrays["vectors"])), mmap_mode="r")
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                continue
+            return arrays, vectors
+
+    def load(self):
+        """
+        Map the index files, built first when missing or made from another
+        state of the catalog
+        """
+        with db.engine.connect() as connection:
+            state = signature(connection)
+        try:
+            arrays, vectors = self._open()
+            fresh = (str(arrays["signature"]) == state
+                     and arrays["idf"].shape == (self.text_dims,))
+        except (OSError, ValueError, KeyError):
+            fresh = False
+        if not fresh:
+            self.build()
+            arrays, vectors = self._open()
+
+        with self.lock:
+            self.state, self.checked = str(arrays["signature"]), time.monotonic()
+            self.idf, self.mean, self.std = arrays["idf"], arrays["mean"], arrays["std"]
+            self.vectors, self.ids, self.directors = vectors, arrays["ids"], arrays["directors"]
+            self.rows = {int(id): row for row, id in enumerate(self.ids)}
+            self.changed_ids = np.empty(0, dtype=np.int64)
+            self.changed = np.empty((0, self.text_dims + 4), dtype=np.float32)
+            self.changed_directors = np.empty(0, dtype=np.int64)
+            self.hidden = np.empty(0, dtype=np.int64)
+            self.removed = frozenset()
+
+    def _check(self):
+        # One query per interval tells whether another worker wrote, a
+        # single thread builds or maps the new index meanwhile
+        if time.monotonic() - self.checked < self.interval:
+            return
+        if not self.loading.acquire(blocking=False):
+            return
+        try:
+            self.checked = time.monotonic()
+            with db.engine.connect() as connection:
+                state = signature(connection)
+            if state != self.state:
+                self.load()
+        finally:
+            self.loading.release()
+
+    def _hidden(self, ids):
+        return np.array([self.rows[id] for id in ids if id in self.rows], dtype=np.int64)
+
+    def update(self, movies):
+        """
+        Put the vectors of movies written by this worker in the index,
+        nothing to do before the index is loaded
+
+        :param movies:      dicts with the columns of COLUMNS by name
+        """
+        if self.vectors is None or len(movies) == 0:
+            return
+        vectors = self._vectors(movies)
+        with self.lock:
+            changes = dict(zip(self.changed_ids.tolist(),
+                               zip(self.changed, self.changed_directors.tolist())))
+            changes.update(zip((movie["id"] for movie in movies), zip(vectors, _directors(movies))))
+            # SQLite gives the id of the last movie deleted to the next one
+            self.removed = self.removed - {movie["id"] for movie in movies}
+            self.changed_ids = np.fromiter(changes, dtype=np.int64, count=len(changes))
+            self.changed = np.array([vector for vector, _ in changes.values()],
+                                    dtype=np.float32).reshape(len(changes), self.text_dims + 4)
+            self.changed_directors = np.array([director for _, director in changes.values()],
+                                              dtype=np.int64)
+            self.hidden = self._hidden(set(changes) | self.removed)
+
+    def _remove(self, ids):
+        self.removed = self.removed | set(ids)
+        keep = ~np.isin(self.changed_ids, list(self.removed))
+        self.changed_ids, self.changed = self.changed_ids[keep], self.changed[keep]
+        self.changed_directors = self.changed_directors[keep]
+        self.hidden = self._hidden(set(self.changed_ids.tolist()) | self.removed)
+
+    def remove(self, ids):
+        """
+        Take the movies deleted by this worker out of the index, nothing to
+        do before the index is loaded
+
+        :param ids:         ids of the movies
+        """
+        if self.vectors is None or len(ids) == 0:
+            return
+        with self.lock:
+            self._remove(ids)
+
+    def remove_directors(self, director_ids):
+        """
+        Take the movies of the directors deleted by this worker out of the
+        index, the database deleted them with their director
+
+        :param director_ids:    ids of the directors
+        """
+        if self.vectors is None or len(director_ids) == 0:
+            return
+        director_ids = list(director_ids)
+        with self.lock:
+            # a movie changed since the build has its director among the changes
+            ids = set(self.ids[np.isin(self.directors, director_ids)].tolist())
+            ids.difference_update(self.changed_ids.tolist())
+            ids.update(self.changed_ids[np.isin(self.changed_directors, director_ids)].tolist())
+            self._remove(ids)
+
+    def refresh(self, ids):
+        """
+        Put the vectors of the movies of ids in the index, read from the
+        database, nothing to do before the index is loaded
+
+        :param ids:         ids of the movies
+        """
+        if self.vectors is None or len(ids) == 0:
+            return
+        rows = db.session.execute(select(*COLUMNS).where(Movies.id.in_(list(ids))))
+        self.update([row._mapping for row in rows])
+
+    def search(self, ids, limit):
+        """
+        Most similar movies of each movie of ids, all the movies of ids
+        scored by one product with the matrix
+
+        :param ids:         ids of the movies
+        :param limit:       movies to return per movie
+        :return:            list of [(id, similarity)] best first, None for a
+                            movie that does not exist
+        """
+        if self.vectors is None:
+            with self.loading:
+                if self.vectors is None:
+                    self.load()
+        else:
+            self._check()
+        missing = [id for id in ids if id not in self.rows and id not in self.changed_ids]
+        if missing:
+            self.refresh(missing)
+
+        with self.lock:
+            vectors, base_ids, hidden = self.vectors, self.ids, self.hidden
+            changed_ids, changed, removed = self.changed_ids, self.changed, self.removed
+            rows = self.rows
+        changes = {id: position for position, id in enumerate(changed_ids.tolist())}
+
+        queries, found = [], []
+        for id in ids:
+            if id in removed:
+                continue
+            if id in changes:
+                queries.append(changed[changes[id]])
+            elif id in rows:
+                queries.append(vectors[rows[id]])
+            else:
+                continue
+            found.append(id)
+        if not found:
+            return [None] * len(ids)
+
+        # one pass over the mapped matrix for all the queries
+        queries = np.array(queries, dtype=np.float32).T
+        scores = np.vstack([vectors @ queries, changed @ queries])
+        scores[hidden] = -np.inf
+        candidates = np.concatenate([base_ids, changed_ids])
+
+        results = {}
+        for column, id in enumerate(found):
+            column_scores = scores[:, column]
+            column_scores[candidates == id] = -np.inf
+            count = min(limit, len(column_scores) - 1)
+            if count <= 0:
+                results[id] = []
+                continue
+            best = np.argpartition(-column_scores, count - 1)[:count]
+            best = best[np.argsort(-column_scores[best], kind="stable")]
+            results[id] = [(int(candidates[row]), float(column_scores[row]))
+                           for row in best if column_scores[row] > -np.inf]
+        return [results.get(id) for id in ids]
+
+
+def _directors(movies):
+    # 0 for a movie without director, no director has that id
+    return np.array([movie["director_id"] or 0 for movie in movies], dtype=np.int64)
+
+
+def changed(movies):
+    """
+    Put the vectors of movies written by the current request in the index
+    once the database transaction commits
+
+    :param movies:      dicts with the columns of COLUMNS by name
+    """
+    _record("update", movies)
+
+
+def deleted(ids):
+    """
+    Take the movies deleted by the current request out of the index once
+    the database transaction commits
+
+    :param ids:         ids of the movies
+    """
+    _record("remove", ids)
+
+
+def deleted_directors(ids):
+    """
+    Take the movies of the directors deleted by the current request out of
+    the index once the database transaction commits
+
+    :param ids:         ids of the directors
+    """
+    _record("remove_directors", ids)
+
+
+def _record(method, values):
+    # a write of a group commit batch (writer.py) runs in a savepoint, its
+    # changes go away with it
+    session = db.session()
+    session.info.setdefault("similar", []).append(
+        (session.get_nested_transaction(), method, list(values)))
+
+
+@event.listens_for(db.session, "after_commit")
+def _after_commit(session):
+    if session.in_nested_transaction():
+        return
+    for _, method, values in session.info.pop("similar", ()):
+        getattr(index, method)(values)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _after_soft_rollback(session, previous_transaction):
+    if previous_transaction.nested:
+        session.info["similar"] = [change for change in session.info.get("similar", ())
+                                   if change[0] is not previous_transaction]
+    else:
+        session.info.pop("similar", None)
+
+
+index = Index(app.config["SIMILAR_INDEX_PATH"], app.config["SIMILAR_TEXT_DIMS"],
+              app.config["SIMILAR_INDEX_INTERVAL"])
@@ -0,0 +1,290 @@
+"""
+This is the snapshot module and supports the point lookups of directors
+and movies from an in-process copy of the catalog, built at startup and
+read through on a miss. Every write bumps the stamp of the catalog_version
+table in its transaction, for the memory cache of the workers (cache.py)
+too when CACHE_STAMP is set; the worker that wrote drops the rows it
+changed, the other workers see the stamp move within
+CATALOG_SNAPSHOT_INTERVAL seconds and rebuild their copy.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event, select
+from config import app, db
+from models import CatalogVersion, Directors, Movies
+
+
+DIRECTOR_COLUMNS = tuple(column.name for column in Directors.__table__.columns)
+
+MOVIE_COLUMNS = tuple(column.name for column in Movies.__table__.columns)
+
+# Position of the columns the lookups read in the row tuples
+_DIRECTOR_UID = DIRECTOR_COLUMNS.index("uid")
+_MOVIE_DIRECTOR_ID = MOVIE_COLUMNS.index("director_id")
+_MOVIE_UID = MOVIE_COLUMNS.index("uid")
+
+
+def read_version(session):
+    """
+    Stamp of the catalog in the database
+
+    :param session:     session or connection to read it with
+    :return:            int, 0 before the first write
+    """
+    version = session.execute(
+        select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar()
+    return version or 0
+
+
+def bump_version(session):
+    """
+    Move the stamp of the catalog, in the transaction of the write
+
+    :param session:     session of the write
+    :return:            new stamp
+    """
+    move_version(session)
+    return read_version(session)
+
+
+def move_version(session):
+    """
+    Move the stamp of the catalog without reading it back
+
+    :param session:     session of the write
+    """
+    table = CatalogVersion.__table__
+    result = session.execute(
+        table.update().where(table.c.id == 1).values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        session.execute(table.insert().values(id=1, version=1))
+
+
+class Snapshot:
+    """
+    Rows of the directors and movies as tuples keyed by id, with the uids
+    and the movie ids of every director beside them. A director is loaded
+    and dropped together with its movies.
+    """
+
+    def __init__(self, interval=1.0):
+        """
+        :param interval:    seconds between two checks of the stamp
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked = 0.0
+        # bumped on every change, a read-through started before is not kept
+        self.generation = 0
+        self.directors = {}
+        self.movies = {}
+        self.filmographies = {}
+        self.director_uids = {}
+        self.movie_uids = {}
+
+    def build(self):
+        """
+        Load the whole catalog, with the stamp it was read at
+        """
+        with db.engine.connect() as connection:
+            with connection.begin():
+                version = read_version(connection)
+                directors = connection.execute(select(Directors.__table__)).fetchall()
+                movies = connection.execute(
+                    select(Movies.__table__).order_by(Movies.id.desc())).fetchall()
+
+        filmographies = {}
+        for row in movies:
+            filmographies.setdefault(row[_MOVIE_DIRECTOR_ID], []).append(row[0])
+
+        with self.lock:
+            self.generation += 1
+            self.directors = {row[0]: tuple(row) for row in directors}
+            self.movies = {row[0]: tuple(row) for row in movies}
+            self.filmographies = {
+                row[0]: tuple(filmographies.get(row[0], ())) for row in directors}
+            self.director_uids = {row[_DIRECTOR_UID]: row[0] for row in directors}
+            self.movie_uids = {row[_MOVIE_UID]: row[0] for row in movies}
+            self.version = version
+            self.checked = time.monotonic()
+
+    def _check(self):
+        # One query per interval tells whether another worker wrote
+        if time.monotonic() - self.checked < self.interval:
+            return
+        self.checked = time.monotonic()
+        with db.engine.connect() as connection:
+            version = read_version(connection)
+        if version != self.version:
+            self.build()
+
+    def _load(self, director_id):
+        generation = self.generation
+        director = db.session.execute(
+            select(Directors.__table__).where(Directors.id == director_id)).fetchone()
+        if director is None:
+            return
+        movies = db.session.execute(
+            select(Movies.__table__).where(Movies.director_id == director_id)
+            .order_by(Movies.id.desc())).fetchall()
+
+        with self.lock:
+            # a write committed meanwhile, the rows read may be older
+            if generation != self.generation:
+                return
+            self._drop(director_id)
+            self.directors[director_id] = tuple(director)
+            self.director_uids[director[_DIRECTOR_UID]] = director_id
+            self.filmographies[director_id] = tuple(row[0] for row in movies)
+            for row in movies:
+                self.movies[row[0]] = tuple(row)
+                self.movie_uids[row[_MOVIE_UID]] = row[0]
+
+    def _drop(self, director_id):
+        director = self.directors.pop(director_id, None)
+        if director is not None and self.director_uids.get(director[_DIRECTOR_UID]) == director_id:
+            del self.director_uids[director[_DIRECTOR_UID]]
+        for movie_id in self.filmographies.pop(director_id, ()):
+            movie = self.movies.pop(movie_id, None)
+            if movie is not None and self.movie_uids.get(movie[_MOVIE_UID]) == movie_id:
+                del self.movie_uids[movie[_MOVIE_UID]]
+
+    def director(self, id):
+        """
+        Director of an id, read from the database when not in the snapshot
+
+        :param id:      id of the director
+        :return:        dict of the columns of the director, None if not found
+        """
+        self._check()
+        row = self.directors.get(id)
+        if row is None:
+            self._load(id)
+            row = self.directors.get(id)
+        return None if row is None else dict(zip(DIRECTOR_COLUMNS, row))
+
+    def filmography(self, id):
+        """
+        Movies of a director, newest first
+
+        :param id:      id of the director
+        :return:        list of dicts of the columns of the movies
+        """
+        movies = [self.movies.get(movie_id) for movie_id in self.filmographies.get(id, ())]
+        return [dict(zip(MOVIE_COLUMNS, row)) for row in movies if row is not None]
+
+    def movie(self, id):
+        """
+        Movie of an id, read from the database when not in the snapshot
+
+        :param id:      id of the movie
+        :return:        dict of the columns of the movie, None if not found
+        """
+        self._check()
+        row = self.movies.get(id)
+        if row is None:
+            director_id = db.session.execute(
+                select(Movies.director_id).where(Movies.id == id)).scalar()
+            if director_id is not None:
+                self._load(director_id)
+            row = self.movies.get(id)
+        return None if row is None else dict(zip(MOVIE_COLUMNS, row))
+
+    def director_id_by_uid(self, uid):
+        """
+        :param uid:     uid of a director
+        :return:        id of the director in the snapshot, None if not found
+        """
+        self._check()
+        return self.director_uids.get(uid)
+
+    def movie_id_by_uid(self, uid):
+        """
+        :param uid:     uid of a movie
+        :return:        id of the movie in the snapshot, None if not found
+        """
+        self._check()
+        return self.movie_uids.get(uid)
+
+    def apply(self, version, tags):
+        """
+        Drop the rows changed by a write of this worker once committed
+
+        :param version:     stamp the write moved the catalog to
+        :param tags:        cache tags of the write, "director:7110" style
+        """
+        director_ids = set()
+        movie_ids = set()
+        for tag in tags:
+            name, _, id = tag.partition(":")
+            if name == "director" and id:
+                director_ids.add(int(id))
+            elif name == "movie" and id:
+                movie_ids.add(int(id))
+
+        with self.lock:
+            self.generation += 1
+            for movie_id in movie_ids:
+                movie = self.movies.get(movie_id)
+                if movie is not None:
+                    director_ids.add(movie[_MOVIE_DIRECTOR_ID])
+            for director_id in director_ids:
+                self._drop(director_id)
+            # another worker wrote in between when the stamp skipped one
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+            else:
+                self.checked = 0.0
+
+
+def create_snapshot(config):
+    """
+    Build the catalog snapshot when CATALOG_SNAPSHOT is set
+
+    :param config:  Flask config with the CATALOG_SNAPSHOT* settings
+    :return:        Snapshot, None when the snapshot is off
+    """
+    if not config["CATALOG_SNAPSHOT"]:
+        return None
+    return Snapshot(config["CATALOG_SNAPSHOT_INTERVAL"])
+
+
+catalog = create_snapshot(app.config)
+
+
+@event.listens_for(db.session, "before_commit")
+def _before_commit(session):
+    # every write names what it changed for the response cache (cache.py),
+    # the savepoints of a group commit batch (writer.py) wait for the end
+    if session.in_nested_transaction():
+        return
+    tags = session.info.get("cache_tags")
+    if not tags:
+        return
+    if catalog is not None:
+        session.info["snapshot"] = (bump_version(session), set(tags))
+    elif app.config["CACHE_STAMP"]:
+        # the memory cache of the other workers (cache.py) watches it
+        move_version(session)
+    else:
+        return
+    session.info["catalog_moved"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def _after_commit(session):
+    if session.in_nested_transaction():
+        return
+    changes = session.info.pop("snapshot", None)
+    if changes is not None and catalog is not None:
+        catalog.apply(*changes)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _after_rollback(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop("snapshot", None)
@@ -0,0 +1,134 @@
+"""
+This is the spec module and supports the fast startup of the workers.
+Parsing swagger.yml and validating it against the swagger 2.0 schema
+takes most of the time of add_api, so the parsed and validated spec is
+compiled once into the SPEC_COMPILED_PATH JSON file, with the digest of
+the swagger.yml it was made from:
+
+    python spec.py          # at build time
+
+The workers load the compiled spec without validating it again, and
+compile it themselves when it is missing or made from another swagger.yml.
+"""
+
+import contextlib
+import copy
+import hashlib
+import os
+import sys
+import threading
+
+import connexion
+import orjson
+import yaml
+from connexion.spec import Specification, Swagger2Specification
+from config import app, basedir
+
+
+SOURCE = os.path.join(basedir, "swagger.yml")
+
+
+def digest(path=SOURCE):
+    """
+    Digest of a swagger.yml, the compiled spec is only used for the one
+    it was made from
+
+    :param path:    path of the swagger.yml
+    :return:        string
+    """
+    with open(path, "rb") as source:
+        return "{}|{}".format(connexion.__version__, hashlib.sha256(source.read()).hexdigest())
+
+
+def compile_spec(path=SOURCE, target=None):
+    """
+    Parse and validate a swagger.yml into the compiled spec file, written
+    aside and moved in place so a worker never reads half a file
+
+    :param path:    path of the swagger.yml
+    :param target:  path of the compiled spec, SPEC_COMPILED_PATH by default
+    :return:        spec dict
+    """
+    target = target or app.config["SPEC_COMPILED_PATH"]
+    with open(path) as source:
+        raw = yaml.safe_load(source)
+
+    # connexion checks it against the swagger 2.0 schema, and raises
+    # InvalidSpecification when it does not hold
+    spec = Specification.from_dict(raw).raw
+
+    temporary = "{}.{}.tmp".format(target, os.getpid())
+    with open(temporary, "wb") as compiled:
+        compiled.write(orjson.dumps({"digest": digest(path), "spec": spec}))
+    os.replace(temporary, target)
+    return spec
+
+
+def load(path=SOURCE, target=None):
+    """
+    Spec of a swagger.yml, from the compiled spec when it was made from
+    it, compiled first otherwise
+
+    :param path:    path of the swagger.yml
+    :param target:  path of the compiled spec, SPEC_COMPILED_PATH by default
+    :return:        spec dict
+    """
+    target = target or app.config["SPEC_COMPILED_PATH"]
+    try:
+        with open(target, "rb") as compiled:
+            data = orjson.loads(compiled.read())
+        if data["digest"] == digest(path):
+            return data["spec"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        return compile_spec(path, target)
+    except OSError:
+        # a read-only deployment parses swagger.yml in every worker
+        app.logger.warning("Could not write the compiled spec %s", target)
+        with open(path) as source:
+            return Specification.from_dict(yaml.safe_load(source)).raw
+
+
+_validating = threading.Lock()
+
+
+@contextlib.contextmanager
+def _validated(spec):
+    # connexion validates every spec it is given, the compiled spec was
+    # validated when it was compiled; any other spec loaded meanwhile, by
+    # another thread, is still validated
+    loaded = copy.deepcopy(spec)
+    Swagger2Specification._set_defaults(loaded)
+    validate = Swagger2Specification.__dict__["_validate_spec"]
+
+    def _validate_spec(cls, raw):
+        if raw != loaded:
+            validate.__func__(cls, raw)
+
+    with _validating:
+        Swagger2Specification._validate_spec = classmethod(_validate_spec)
+        try:
+            yield
+        finally:
+            Swagger2Specification._validate_spec = validate
+
+
+def add_api(connex_app, **kwargs):
+    """
+    Configure the endpoints of connex_app from the compiled spec of
+    swagger.yml, like connex_app.add_api("swagger.yml")
+
+    :param connex_app:  connexion application
+    :param kwargs:      options of add_api
+    :return:            connexion api
+    """
+    spec = load()
+    with _validated(spec):
+        return connex_app.add_api(spec, **kwargs)
+
+
+if __name__ == "__main__":
+    compile_spec()
+    print("compiled {} into {}".format(SOURCE, app.config["SPEC_COMPILED_PATH"]), file=sys.stderr)
@@ -0,0 +1,181 @@
+"""
+This is the stats module and supports the analytics endpoints of the
+directors and movies data, served from the director_stats rollup table
+and GROUP BY queries
+"""
+
+from flask import abort
+from sqlalchemy import Float, case, cast, extract, func, select
+from config import db
+from models import Directors, DirectorStats, Movies
+import bulk
+import cache
+import filters
+
+
+# Share of the budget earned back on top of it, None without a budget
+ROI = case(
+    (DirectorStats.total_budget > 0,
+     cast(DirectorStats.total_revenue - DirectorStats.total_budget, Float) / DirectorStats.total_budget),
+    else_=None,
+)
+
+# Average vote weighted by the number of votes of every movie
+VOTE_AVERAGE = case(
+    (DirectorStats.vote_total > 0, DirectorStats.vote_points / DirectorStats.vote_total),
+    else_=None,
+)
+
+# Attributes the leaderboard can be sorted by
+LEADERBOARD_ATTRIBUTES = {
+    'movies_count': DirectorStats.movies_count,
+    'total_budget': DirectorStats.total_budget,
+    'total_revenue': DirectorStats.total_revenue,
+    'roi': ROI,
+    'vote_average': VOTE_AVERAGE,
+}
+
+
+def rollup(director_ids=None):
+    """
+    Select computing the director_stats rows from the movies table
+
+    :param director_ids:    directors to compute, None for all
+    :return:                select with the director_stats columns
+    """
+    query = (
+        select(
+            Movies.director_id,
+            func.count(Movies.id),
+            func.coalesce(func.sum(Movies.budget), 0),
+            func.coalesce(func.sum(Movies.revenue), 0),
+            func.coalesce(func.sum(Movies.vote_average * Movies.vote_count), 0),
+            func.coalesce(func.sum(Movies.vote_count), 0),
+        )
+        .where(Movies.director_id.isnot(None))
+        .group_by(Movies.director_id)
+    )
+    if director_ids is not None:
+        query = query.where(Movies.director_id.in_(director_ids))
+    return query
+
+
+def refresh(director_ids):
+    """
+    Compute again the rollup rows of the directors whose movies changed,
+    in the transaction of the change. A director without movies has no row.
+
+    :param director_ids:    ids of the directors to refresh
+    """
+    # The pending ORM changes have to reach the movies table first
+    db.session.flush()
+
+    table = DirectorStats.__table__
+    columns = ['director_id', 'movies_count', 'total_budget', 'total_revenue',
+               'vote_points', 'vote_total']
+    for chunk in bulk.chunks({id for id in director_ids if id is not None}):
+        db.session.execute(table.delete().where(table.c.director_id.in_(chunk)))
+        db.session.execute(table.insert().from_select(columns, rollup(chunk)))
+
+
+def _director_stats(row):
+    return {
+        "director_id": row.id,
+        "name": row.name,
+        "movies_count": row.movies_count or 0,
+        "total_budget": row.total_budget or 0,
+        "total_revenue": row.total_revenue or 0,
+        "roi": row.roi,
+        "vote_average": row.vote_average,
+    }
+
+
+def _director_query():
+    return (
+        db.session.query(
+            Directors.id, Directors.name,
+            DirectorStats.movies_count, DirectorStats.total_budget,
+            DirectorStats.total_revenue, ROI.label('roi'), VOTE_AVERAGE.label('vote_average'),
+        )
+        .select_from(Directors)
+        .outerjoin(DirectorStats, DirectorStats.director_id == Directors.id)
+    )
+
+
+@cache.cached("director:{id}")
+def read_director(id):
+    """
+    This function responds to a request for /api/directors/{id}/stats
+    with the totals of the movies of the director
+
+    :param id:          Id of the director
+    :return:            json object of the director stats, 404 if not found
+    """
+    row = _director_query().filter(Directors.id == id).one_or_none()
+
+    if row is None:
+        abort(404, f"Director not found for ID: {id}!")
+
+    return _director_stats(row)
+
+
+@cache.cached("movies")
+def read_leaderboard(limit, attribute):
+    """
+    This function responds to a request for /api/stats/directors/{limit}/{attribute}
+    with the top limit directors by attribute, highest first
+
+    :param limit:       number of directors to return
+    :param attribute:   movies_count, total_budget, total_revenue, roi or vote_average
+    :return:            json list of director stats
+    """
+    if attribute not in LEADERBOARD_ATTRIBUTES:
+        abort(404, f"Stats not found for attribute {attribute}!")
+
+    rows = (
+        _director_query()
+        .filter(LEADERBOARD_ATTRIBUTES[attribute].isnot(None))
+        .order_by(LEADERBOARD_ATTRIBUTES[attribute].desc(), Directors.id)
+        .limit(limit)
+        .all()
+    )
+
+    return [_director_stats(row) for row in rows]
+
+
+@cache.cached("movies")
+def read_years(released_from=None, released_to=None):
+    """
+    This function responds to a request for /api/stats/years
+    with the totals of the movies released each year
+
+    :param released_from:   first release date, YYYY-MM-DD
+    :param released_to:     last release date, YYYY-MM-DD
+    :return:            json list of year stats, oldest year first
+    """
+    year = extract('year', Movies.release_date)
+    rows = db.session.execute(
+        select(
+            year.label('year'),
+            func.count(Movies.id).label('movies_count'),
+            func.coalesce(func.sum(Movies.budget), 0).label('total_budget'),
+            func.coalesce(func.sum(Movies.revenue), 0).label('total_revenue'),
+            (func.sum(Movies.vote_average * Movies.vote_count)
+             / func.nullif(func.sum(Movies.vote_count), 0)).label('vote_average'),
+        )
+        .where(Movies.release_date.isnot(None),
+               *filters.date_range(Movies.release_date, released_from, released_to))
+        .group_by(year)
+        .order_by(year)
+    )
+
+    return [
+        {
+            "year": int(row.year),
+            "movies_count": row.movies_count,
+            "total_budget": row.total_budget,
+            "total_revenue": row.total_revenue,
+            "vote_average": row.vote_average,
+        }
+        for row in rows if row.year is not None
+    ]
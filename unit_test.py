@@ -1,7 +1,41 @@
+import asyncio
+import os
+import re
+import shutil
+import tempfile
 import unittest
-from app import connex_app
+import unittest.mock
 import json
+import threading
+
+# Run the tests against a copy of the database so the shipped one stays untouched
+TEST_DB = os.path.join(tempfile.mkdtemp(), 'final_pk.db')
+shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'final_pk.db'), TEST_DB)
+os.environ['DATABASE_URL'] = 'sqlite:///' + TEST_DB
+os.environ['SIMILAR_INDEX_PATH'] = os.path.join(os.path.dirname(TEST_DB), 'similar.npy')
+os.environ['SPEC_COMPILED_PATH'] = os.path.join(os.path.dirname(TEST_DB), 'swagger.json')
 
+import werkzeug.exceptions
+from sqlalchemy import create_engine, event, text
+from app import connex_app
+import asgi
+import benchmark
+import config
+from config import db
+import cache
+import metrics
+import models
+import directors
+import fieldsets
+import movies
+import search
+import serializers
+import similar
+import snapshot
+import spec
+import stats
+import validation
+import writer
 
 
 BASE_DIRECTORS_URL = '/api/directors'
@@ -11,11 +45,37 @@ GET_DIRECTORS_ONE = '{}/7110'.format(BASE_DIRECTORS_URL)
 BASE_MOVIES_URL = '{}/movies'.format(GET_DIRECTORS_ONE)
 GET_MOVIES_ONE = '{}/48399'.format(BASE_MOVIES_URL)
 
+BASE_ALL_MOVIES_URL = '/api/movies'
+
+SEARCH_DIRECTORS_URL = '/api/directors-name'
+SEARCH_MOVIES_URL = '/api/movies-title'
+SEARCH_URL = '/api/search'
+
+class QueryCounter:
+    """
+    Count the SQL statements sent to the database while active
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self.callback)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self.callback)
+
+    def callback(self, *args):
+        self.count += 1
+
+
 class TestFlaskApi(unittest.TestCase):
 
     def setUp(self):
         self.connex_app = connex_app.app.test_client()
         self.connex_app.testing = True
+        cache.clear()
 
     
     def test_get_directors(self):
@@ -38,6 +98,1493 @@ class TestFlaskApi(unittest.TestCase):
         self.assertEqual(data['original_title'], 'My Date with Drew')
         self.assertEqual(type(data), dict)
 
+    def test_search_movies_prefix(self):
+        response = self.connex_app.get('{}/drew'.format(SEARCH_MOVIES_URL))
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('My Date with Drew', [movie['title'] for movie in data])
+
+        response = self.connex_app.get('{}/dat dre?limit=1'.format(SEARCH_MOVIES_URL))
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['title'], 'My Date with Drew')
+
+    def test_search_not_found(self):
+        response = self.connex_app.get('{}/zzqqxx'.format(SEARCH_DIRECTORS_URL))
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_all(self):
+        response = self.connex_app.get('{}/herzlinger'.format(SEARCH_URL))
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['directors'][0]['name'], 'Brian Herzlinger')
+        self.assertIn('My Date with Drew', [movie['title'] for movie in data['movies']])
+
+    def test_search_index_follows_writes(self):
+        director = {'name': 'Quentinette Zyxwarino', 'uid': 990001, 'gender': 1, 'department': 'Directing'}
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+        self.assertEqual(response.status_code, 201)
+        director_id = json.loads(response.get_data())['id']
+
+        response = self.connex_app.get('{}/zyxwar'.format(SEARCH_DIRECTORS_URL))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.get_data())[0]['id'], director_id)
+
+        response = self.connex_app.delete('{}/{}'.format(BASE_DIRECTORS_URL, director_id))
+        self.assertEqual(response.status_code, 200)
+        response = self.connex_app.get('{}/zyxwar'.format(SEARCH_DIRECTORS_URL))
+        self.assertEqual(response.status_code, 404)
+
+    def walk_pages(self, url):
+        ids, cursor = [], None
+        while True:
+            response = self.connex_app.get(url, query_string={'cursor': cursor} if cursor else None)
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in json.loads(response.get_data())]
+            cursor = response.headers.get('X-Next-Cursor')
+            if cursor is None:
+                return ids
+
+    def test_cursor_pages_cover_sort(self):
+        for order in ('asc', 'desc'):
+            ids = self.walk_pages('{}/700/{}/tagline'.format(BASE_ALL_MOVIES_URL, order))
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertEqual(len(ids), 4774)
+
+        ids = self.walk_pages('{}/1000/desc/name'.format(BASE_DIRECTORS_URL))
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_cursor_prev_page(self):
+        first = self.connex_app.get('{}/5/desc/budget'.format(BASE_ALL_MOVIES_URL))
+        self.assertIsNone(first.headers.get('X-Prev-Cursor'))
+        second = self.connex_app.get('{}/5/desc/budget'.format(BASE_ALL_MOVIES_URL),
+                                     query_string={'cursor': first.headers['X-Next-Cursor']})
+        back = self.connex_app.get('{}/5/desc/budget'.format(BASE_ALL_MOVIES_URL),
+                                   query_string={'cursor': second.headers['X-Prev-Cursor']})
+        self.assertEqual(json.loads(back.get_data()), json.loads(first.get_data()))
+        self.assertNotEqual(json.loads(second.get_data()), json.loads(first.get_data()))
+
+    def test_cursor_invalid(self):
+        first = self.connex_app.get(BASE_DIRECTORS_URL)
+        response = self.connex_app.get('{}/5/asc/name'.format(BASE_DIRECTORS_URL),
+                                       query_string={'cursor': first.headers['X-Next-Cursor']})
+        self.assertEqual(response.status_code, 400)
+        response = self.connex_app.get(BASE_DIRECTORS_URL, query_string={'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+    def count_queries(self, url):
+        with QueryCounter() as counter:
+            response = self.connex_app.get(url)
+        self.assertEqual(response.status_code, 200)
+        return counter.count
+
+    def test_query_budget(self):
+        budgets = [
+            ('{}/{}/desc/id'.format(BASE_DIRECTORS_URL, '{}'), 2),
+            ('{}/{}/asc/title'.format(BASE_ALL_MOVIES_URL, '{}'), 1),
+            ('{}/the?limit={}'.format(SEARCH_DIRECTORS_URL, '{}'), 3),
+            ('{}/the?limit={}'.format(SEARCH_MOVIES_URL, '{}'), 2),
+        ]
+        for url, budget in budgets:
+            self.assertEqual(self.count_queries(url.format(5)), budget, url)
+            self.assertEqual(self.count_queries(url.format(200)), budget, url)
+
+        self.assertEqual(self.count_queries(BASE_DIRECTORS_URL), 2)
+        self.assertEqual(self.count_queries(BASE_ALL_MOVIES_URL), 1)
+        self.assertEqual(self.count_queries(GET_MOVIES_ONE), 2)
+
+
+    def test_export_movies_ndjson(self):
+        with QueryCounter() as counter:
+            response = self.connex_app.get('{}/export'.format(BASE_ALL_MOVIES_URL))
+            self.assertTrue(response.is_streamed)
+            lines = response.get_data().decode().splitlines()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 4774)
+        self.assertEqual(json.loads(lines[0])['title'], 'Avatar')
+        # one streamed select, not one query per page
+        self.assertEqual(counter.count, 1)
+
+    def test_export_directors_csv(self):
+        response = self.connex_app.get('{}/export?format=csv'.format(BASE_DIRECTORS_URL))
+        lines = response.get_data().decode().splitlines()
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,name,gender,uid,department')
+        self.assertEqual(len(lines), 2351)
+
+        response = self.connex_app.get('{}/export?format=xml'.format(BASE_DIRECTORS_URL))
+        self.assertEqual(response.status_code, 400)
+
+    def test_sparse_fieldsets(self):
+        response = self.connex_app.get('{}?fields=id,name'.format(BASE_DIRECTORS_URL))
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data[0]), {'id', 'name'})
+
+        response = self.connex_app.get('{}?fields=name,movies.title'.format(GET_DIRECTORS_ONE))
+        data = json.loads(response.get_data())
+        self.assertEqual(data, {'name': 'Brian Herzlinger', 'movies': [{'title': 'My Date with Drew'}],
+                                'movies_next': None})
+
+        response = self.connex_app.get('{}?include='.format(GET_MOVIES_ONE))
+        data = json.loads(response.get_data())
+        self.assertNotIn('directors', data)
+        self.assertEqual(data['title'], 'My Date with Drew')
+
+        response = self.connex_app.get('{}?fields=title,budget'.format(BASE_ALL_MOVIES_URL))
+        self.assertEqual(response.status_code, 200)
+
+        for url in ('{}?fields=nope'.format(BASE_DIRECTORS_URL),
+                    '{}?fields=directors.nope'.format(BASE_ALL_MOVIES_URL),
+                    '{}?include=movies'.format(BASE_ALL_MOVIES_URL)):
+            self.assertEqual(self.connex_app.get(url).status_code, 400)
+
+    def test_sparse_fieldsets_trim_sql(self):
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.connex_app.get('{}/10/asc/title?fields=title'.format(BASE_ALL_MOVIES_URL))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('overview', statements[0])
+        self.assertNotIn('directors.name', statements[0])
+
+class QueryRecorder(QueryCounter):
+    """
+    Record the SELECT statements sent to the database while active
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.statements = []
+
+    def callback(self, conn, cursor, statement, parameters, context, executemany):
+        super().callback()
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.statements.append((statement, parameters))
+
+
+class TestQueryPlans(unittest.TestCase):
+    """
+    Every query run by the endpoints of movies.py and directors.py must be
+    served by an index, never by a full table scan
+    """
+
+    # free text columns stay unindexed, sorting by them scans the table
+    UNINDEXED = {'overview', 'tagline'}
+
+    # the rows of a subquery were found by an index already, scanning
+    # them is no table scan
+    FULL_SCAN = re.compile(r'^SCAN ({})$'.format('|'.join(db.metadata.tables)))
+
+    # walking the table in id order stops after LIMIT rows, SQLite still
+    # reports it as a SCAN
+    ID_ORDER = re.compile(r'ORDER BY \w+\.id (ASC|DESC)( NULLS (FIRST|LAST))?\s+LIMIT')
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        # every request has to reach the database to record its queries
+        self.backend, cache.backend = cache.backend, None
+
+    def tearDown(self):
+        cache.backend = self.backend
+
+    def assert_no_full_scan(self, *requests):
+        with QueryRecorder() as recorder:
+            for method, url, body in requests:
+                response = self.connex_app.open(url, method=method, json=body)
+                self.assertLess(response.status_code, 500, url)
+        self.assertGreater(len(recorder.statements), 0)
+
+        with db.engine.connect() as connection:
+            for statement, parameters in recorder.statements:
+                plan = connection.exec_driver_sql(
+                    'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                scans = [row[-1] for row in plan if self.FULL_SCAN.match(row[-1])]
+                if self.ID_ORDER.search(statement) and len(scans) == 1:
+                    scans = []
+                self.assertEqual(scans, [], statement)
+
+    def list_requests(self, base_url, attributes):
+        requests = []
+        for attribute in attributes:
+            for order in ('asc', 'desc'):
+                url = '{}/5/{}/{}'.format(base_url, order, attribute)
+                cursor = self.connex_app.get(url).headers['X-Next-Cursor']
+                requests.append(('GET', url, None))
+                requests.append(('GET', '{}?cursor={}'.format(url, cursor), None))
+        return requests
+
+    def test_read_directors(self):
+        self.assert_no_full_scan(
+            ('GET', BASE_DIRECTORS_URL, None),
+            ('GET', GET_DIRECTORS_ONE, None),
+            ('GET', '{}/herz'.format(SEARCH_DIRECTORS_URL), None),
+            *self.list_requests(BASE_DIRECTORS_URL, directors.SORT_ATTRIBUTES),
+        )
+
+    def test_read_movies(self):
+        attributes = set(movies.SORT_ATTRIBUTES) - self.UNINDEXED
+        self.assert_no_full_scan(
+            ('GET', BASE_ALL_MOVIES_URL, None),
+            ('GET', GET_MOVIES_ONE, None),
+            ('GET', '{}/drew'.format(SEARCH_MOVIES_URL), None),
+            ('GET', '{}/drew'.format(SEARCH_URL), None),
+            ('GET', '{}?filter=budget=gt=50000000;vote_count=gt=1000'.format(BASE_ALL_MOVIES_URL), None),
+            ('GET', '{}?filter=director_id=in=(7110,7111)&sort=-release_date'.format(BASE_ALL_MOVIES_URL), None),
+            ('GET', '{}?sort=-budget'.format(BASE_ALL_MOVIES_URL), None),
+            ('GET', '{}?released_from=2010-01-01&released_to=2010-12-31'.format(BASE_ALL_MOVIES_URL), None),
+            ('GET', '{}/5/desc/release date?released_from=2010-01-01'.format(BASE_ALL_MOVIES_URL), None),
+            *self.list_requests(BASE_ALL_MOVIES_URL, attributes),
+        )
+
+    def test_writes(self):
+        director = {'name': 'Plan Checker', 'uid': 990002, 'gender': 0, 'department': 'Directing'}
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+        director_url = '{}/{}'.format(BASE_DIRECTORS_URL, json.loads(response.get_data())['id'])
+        movie = {
+            'original_title': 'Plan', 'title': 'Plan', 'budget': 1, 'popularity': 1,
+            'release_date': '2020-01-01', 'revenue': 1, 'vote_average': 1.0, 'vote_count': 1,
+            'overview': 'Plan', 'tagline': 'Plan', 'uid': 990003,
+        }
+        response = self.connex_app.post('{}/movies'.format(director_url), json=movie)
+        movie_url = '{}/movies/{}'.format(director_url, json.loads(response.get_data())['id'])
+
+        self.assert_no_full_scan(
+            ('POST', BASE_DIRECTORS_URL, director),
+            ('PUT', director_url, dict(director, name='Plan Checked')),
+            ('POST', '{}/movies'.format(director_url), movie),
+            ('PUT', movie_url, dict(movie, uid=990004)),
+            ('PATCH', movie_url, {'title': 'Plan Patched'}),
+            ('PATCH', director_url, {'name': 'Plan Patched'}),
+            ('DELETE', movie_url, None),
+            ('DELETE', director_url, None),
+        )
+
+
+class FakeRedis:
+    """
+    Stand-in for a Redis client, keeps the values in a dict
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        cache.clear()
+
+    def test_hit_skips_database(self):
+        before = json.loads(self.connex_app.get('/api/cache').get_data())
+        with QueryCounter() as counter:
+            first = self.connex_app.get('{}/3/desc/popularity'.format(BASE_ALL_MOVIES_URL))
+        self.assertGreater(counter.count, 0)
+        with QueryCounter() as counter:
+            second = self.connex_app.get('{}/3/desc/popularity'.format(BASE_ALL_MOVIES_URL))
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(first.get_data(), second.get_data())
+        self.assertEqual(first.headers['X-Next-Cursor'], second.headers['X-Next-Cursor'])
+
+        after = json.loads(self.connex_app.get('/api/cache').get_data())
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+    def test_hits_keep_their_headers(self):
+        responses = [self.connex_app.get(BASE_DIRECTORS_URL) for _ in range(5)]
+        for response in responses:
+            self.assertEqual(len(response.headers.getlist('ETag')), 1)
+            self.assertEqual(len(response.headers.getlist('X-Next-Cursor')), 1)
+            self.assertEqual(len(response.headers), len(responses[0].headers))
+        self.assertEqual(responses[-1].get_data(), responses[0].get_data())
+
+    def test_write_invalidates(self):
+        director = {'name': 'Cache Warmer', 'uid': 990005, 'gender': 2, 'department': 'Directing'}
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+        director_url = '{}/{}'.format(BASE_DIRECTORS_URL, json.loads(response.get_data())['id'])
+        movie = {
+            'original_title': 'Cached', 'title': 'Cached', 'budget': 1, 'popularity': 1,
+            'release_date': '2020-01-01', 'revenue': 1, 'vote_average': 1.0, 'vote_count': 1,
+            'overview': 'Cached', 'tagline': 'Cached', 'uid': 990006,
+        }
+        response = self.connex_app.post('{}/movies'.format(director_url), json=movie)
+        movie_url = '{}/movies/{}'.format(director_url, json.loads(response.get_data())['id'])
+
+        self.assertEqual(json.loads(self.connex_app.get(movie_url).get_data())['directors']['name'], 'Cache Warmer')
+        self.assertEqual(len(json.loads(self.connex_app.get(director_url).get_data())['movies']), 1)
+
+        self.connex_app.put(director_url, json=dict(director, name='Cache Cooler'))
+        self.assertEqual(json.loads(self.connex_app.get(movie_url).get_data())['directors']['name'], 'Cache Cooler')
+
+        self.connex_app.delete(movie_url)
+        self.assertEqual(len(json.loads(self.connex_app.get(director_url).get_data())['movies']), 0)
+        self.connex_app.delete(director_url)
+        self.assertEqual(self.connex_app.get(director_url).status_code, 404)
+
+    def test_memory_backend_follows_other_workers(self):
+        backend, cache.backend = cache.backend, cache.MemoryBackend(interval=0.0)
+        connex_app.app.config['CACHE_STAMP'] = True
+        try:
+            self.assertEqual(json.loads(self.connex_app.get(GET_DIRECTORS_ONE).get_data())['name'],
+                             'Brian Herzlinger')
+            # another worker renames the director, its cache tags stay there
+            with db.engine.begin() as connection:
+                connection.execute(models.Directors.__table__.update()
+                                   .where(models.Directors.id == 7110).values(name='Renamed Elsewhere'))
+                snapshot.bump_version(connection)
+            self.assertEqual(json.loads(self.connex_app.get(GET_DIRECTORS_ONE).get_data())['name'],
+                             'Renamed Elsewhere')
+
+            # a write of this worker keeps the entries it did not change
+            self.connex_app.get('{}/3/desc/popularity'.format(BASE_ALL_MOVIES_URL))
+            self.connex_app.patch(GET_DIRECTORS_ONE, json={'name': 'Brian Herzlinger'})
+            with QueryCounter() as counter:
+                self.connex_app.get('{}/3/desc/popularity'.format(BASE_ALL_MOVIES_URL))
+            self.assertEqual(counter.count, 1)
+        finally:
+            connex_app.app.config['CACHE_STAMP'] = False
+            cache.backend = backend
+            with db.engine.begin() as connection:
+                connection.execute(models.Directors.__table__.update()
+                                   .where(models.Directors.id == 7110).values(name='Brian Herzlinger'))
+
+    def test_redis_backend(self):
+        backend, cache.backend = cache.backend, cache.RedisBackend(FakeRedis())
+        try:
+            first = self.connex_app.get(GET_DIRECTORS_ONE)
+            with QueryCounter() as counter:
+                second = self.connex_app.get(GET_DIRECTORS_ONE)
+            self.assertEqual(counter.count, 0)
+            self.assertEqual(first.get_data(), second.get_data())
+
+            cache.clear()
+            with QueryCounter() as counter:
+                self.connex_app.get(GET_DIRECTORS_ONE)
+            self.assertGreater(counter.count, 0)
+        finally:
+            cache.backend = backend
+
+
+class TestConditional(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        cache.clear()
+
+    def test_etag_not_modified(self):
+        for url in (GET_DIRECTORS_ONE, GET_MOVIES_ONE, BASE_DIRECTORS_URL,
+                    '{}/5/desc/revenue'.format(BASE_ALL_MOVIES_URL), '{}/drew'.format(SEARCH_URL)):
+            response = self.connex_app.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], 'public, no-cache')
+            self.assertIn('Last-Modified', response.headers)
+
+            again = self.connex_app.get(url, headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(again.status_code, 304, url)
+            self.assertEqual(again.get_data(), b'')
+            self.assertEqual(again.headers['ETag'], response.headers['ETag'])
+
+            since = self.connex_app.get(url, headers={'If-Modified-Since': response.headers['Last-Modified']})
+            self.assertEqual(since.status_code, 304, url)
+
+    def test_not_modified_skips_serialization(self):
+        backend, cache.backend = cache.backend, None
+        try:
+            etag = self.connex_app.get(GET_DIRECTORS_ONE).headers['ETag']
+            with QueryCounter() as counter:
+                response = self.connex_app.get(GET_DIRECTORS_ONE, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            # the movies of the director are never loaded
+            self.assertEqual(counter.count, 1)
+        finally:
+            cache.backend = backend
+
+    def test_etag_changes_with_movies(self):
+        director = {'name': 'Etag Maker', 'uid': 990007, 'gender': 1, 'department': 'Directing'}
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+        director_url = '{}/{}'.format(BASE_DIRECTORS_URL, json.loads(response.get_data())['id'])
+        etag = self.connex_app.get(director_url).headers['ETag']
+
+        movie = {
+            'original_title': 'Etag', 'title': 'Etag', 'budget': 1, 'popularity': 1,
+            'release_date': '2020-01-01', 'revenue': 1, 'vote_average': 1.0, 'vote_count': 1,
+            'overview': 'Etag', 'tagline': 'Etag', 'uid': 990008,
+        }
+        response = self.connex_app.post('{}/movies'.format(director_url), json=movie)
+        self.assertEqual(response.status_code, 201)
+
+        response = self.connex_app.get(director_url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(response.get_data())['movies']), 1)
+
+        self.connex_app.delete(director_url)
+
+
+class TestBulk(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        cache.clear()
+
+    def movie(self, uid, **fields):
+        movie = {
+            'director_id': 7110, 'original_title': 'Bulk {}'.format(uid), 'budget': 1,
+            'popularity': 1, 'release_date': '2020-01-01', 'revenue': 1,
+            'title': 'Bulk {}'.format(uid), 'vote_average': 5.5, 'vote_count': 1,
+            'overview': 'Overview', 'tagline': 'Tagline', 'uid': uid,
+        }
+        movie.update(fields)
+        return movie
+
+    def test_create_movies_per_item_status(self):
+        body = [self.movie(880001), self.movie(880002), self.movie(880001),
+                self.movie(880003, director_id=1), self.movie(880004, title='')]
+        with QueryCounter() as counter:
+            response = self.connex_app.post('{}/bulk'.format(BASE_ALL_MOVIES_URL), json=body)
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['status'] for item in data['items']], [201, 201, 409, 404, 400])
+        self.assertEqual((data['succeeded'], data['failed']), (2, 3))
+        # lookups, one executemany insert, id read back and director touch
+        self.assertLessEqual(counter.count, 8)
+
+        ids = [item['id'] for item in data['items'][:2]]
+        response = self.connex_app.get('{}/{}'.format(BASE_MOVIES_URL, ids[0]))
+        self.assertEqual(json.loads(response.get_data())['uid'], 880001)
+
+        updates = [dict(self.movie(880001, title='Bulk renamed'), id=ids[0]),
+                   dict(self.movie(880001), id=ids[1])]
+        response = self.connex_app.put('{}/bulk'.format(BASE_ALL_MOVIES_URL), json=updates)
+        data = json.loads(response.get_data())
+        self.assertEqual([item['status'] for item in data['items']], [200, 409])
+        response = self.connex_app.get('{}/{}'.format(BASE_MOVIES_URL, ids[0]))
+        self.assertEqual(json.loads(response.get_data())['title'], 'Bulk renamed')
+
+        response = self.connex_app.delete('{}/bulk'.format(BASE_ALL_MOVIES_URL), json=ids + [999999999])
+        data = json.loads(response.get_data())
+        self.assertEqual([item['status'] for item in data['items']], [200, 200, 404])
+        response = self.connex_app.get('{}/{}'.format(BASE_MOVIES_URL, ids[0]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_ndjson_directors(self):
+        lines = [
+            json.dumps({'name': 'Ndjson Bulkdirector', 'uid': 880101, 'gender': 0, 'department': 'Directing'}),
+            'not json',
+            '',
+            json.dumps({'name': 'Ndjson Otherdirector', 'uid': 880102, 'gender': 1, 'department': 'Directing'}),
+        ]
+        response = self.connex_app.post('{}/bulk'.format(BASE_DIRECTORS_URL), data='\n'.join(lines),
+                                         content_type='application/x-ndjson')
+        data = json.loads(response.get_data())
+        self.assertEqual([item['status'] for item in data['items']], [201, 400, 201])
+
+        response = self.connex_app.get('{}/bulkdirector'.format(SEARCH_DIRECTORS_URL))
+        self.assertEqual(response.status_code, 200)
+
+        ids = '\n'.join(str(item['id']) for item in data['items'] if 'id' in item)
+        response = self.connex_app.delete('{}/bulk'.format(BASE_DIRECTORS_URL), data=ids,
+                                          content_type='application/x-ndjson')
+        data = json.loads(response.get_data())
+        self.assertEqual(data['succeeded'], 2)
+        response = self.connex_app.get('{}/bulkdirector'.format(SEARCH_DIRECTORS_URL))
+        self.assertEqual(response.status_code, 404)
+
+    def test_delete_cascades_to_movies(self):
+        directors = [{'name': 'Cascade Director {}'.format(index), 'uid': 880201 + index, 'gender': 0,
+                      'department': 'Directing'} for index in range(2)]
+        response = self.connex_app.post('{}/bulk'.format(BASE_DIRECTORS_URL), json=directors)
+        director_ids = [item['id'] for item in json.loads(response.get_data())['items']]
+        body = [self.movie(880211 + index, director_id=director_ids[index % 2], title='Cascadetitle')
+                for index in range(4)]
+        response = self.connex_app.post('{}/bulk'.format(BASE_ALL_MOVIES_URL), json=body)
+        movie_ids = [item['id'] for item in json.loads(response.get_data())['items']]
+
+        # the movies are deleted by the database, never loaded
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.connex_app.delete('{}/bulk'.format(BASE_DIRECTORS_URL), json=director_ids)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(json.loads(response.get_data())['succeeded'], 2)
+        self.assertFalse([statement for statement in statements if 'FROM movies' in statement])
+        self.assertLessEqual(len(statements), 4)
+
+        with config.app.app_context():
+            self.assertEqual(models.Movies.query.filter(models.Movies.id.in_(movie_ids)).count(), 0)
+            self.assertEqual(models.DirectorStats.query.filter(
+                models.DirectorStats.director_id.in_(director_ids)).count(), 0)
+        response = self.connex_app.get('{}/cascadetitle'.format(SEARCH_MOVIES_URL))
+        self.assertEqual(response.status_code, 404)
+
+    def test_items_follow_the_single_write_rules(self):
+        movie = self.movie(880301, rating=5)
+        single = self.connex_app.post('{}/7110/movies'.format(BASE_DIRECTORS_URL),
+                                      json={name: value for name, value in movie.items() if name != 'director_id'})
+        self.assertEqual(single.status_code, 400)
+
+        body = [movie, self.movie(880302, release_date='2020-02-30'), self.movie(880303, gender=1)]
+        response = self.connex_app.post('{}/bulk'.format(BASE_ALL_MOVIES_URL), json=body)
+        data = json.loads(response.get_data())
+        self.assertEqual([item['status'] for item in data['items']], [400, 400, 400])
+        self.assertIn('release_date', data['items'][1]['message'])
+
+        response = self.connex_app.put('{}/bulk'.format(BASE_DIRECTORS_URL),
+                                       json=[{'name': 'No Id', 'uid': 880304, 'gender': 0, 'department': 'Directing'}])
+        self.assertEqual(json.loads(response.get_data())['items'][0]['status'], 400)
+
+    def test_body_must_be_array(self):
+        response = self.connex_app.post('{}/bulk'.format(BASE_DIRECTORS_URL), json={'name': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestDatabaseConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        cache.clear()
+
+    def test_sqlite_pragmas(self):
+        with db.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+            # NORMAL
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+        self.assertFalse(config.app.config['SQLALCHEMY_ECHO'])
+
+    def test_postgresql_options(self):
+        self.assertEqual(config.database_url('postgres://user@host/movies'), 'postgresql://user@host/movies')
+        options = config.engine_options('postgresql://user@host/movies', {'DB_POOL_SIZE': '20'})
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertTrue(options['pool_pre_ping'])
+
+        options = config.engine_options('sqlite:///movies.db', {})
+        self.assertNotIn('pool_size', options)
+
+        self.assertEqual(search.match_expression('dat dre', 'postgresql'), 'dat:* & dre:*')
+
+    def test_replica_routing(self):
+        replica = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        shutil.copyfile(TEST_DB, replica)
+        config.app.config['SQLALCHEMY_BINDS']['replica'] = 'sqlite:///' + replica
+        try:
+            engine = db.get_engine(config.app, bind='replica')
+            with QueryCounter() as primary:
+                counter = QueryCounter()
+                event.listen(engine, 'before_cursor_execute', counter.callback)
+                try:
+                    response = self.connex_app.get(GET_DIRECTORS_ONE)
+                    self.assertEqual(response.status_code, 200)
+                    reads, primary_reads = counter.count, primary.count
+
+                    director = {'name': 'Replica Routing', 'uid': 990101, 'gender': 1, 'department': 'Directing'}
+                    response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+                    self.assertEqual(response.status_code, 201)
+                    self.connex_app.delete('{}/{}'.format(BASE_DIRECTORS_URL, json.loads(response.get_data())['id']))
+                finally:
+                    event.remove(engine, 'before_cursor_execute', counter.callback)
+        finally:
+            del config.app.config['SQLALCHEMY_BINDS']['replica']
+
+        self.assertGreater(reads, 0)
+        self.assertEqual(primary_reads, 0)
+        self.assertEqual(counter.count, reads)
+        self.assertGreater(primary.count, 0)
+
+class TestAsgi(unittest.TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def call(self, path, query_string=b''):
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query_string,
+            'root_path': '', 'headers': [(b'host', b'testserver')],
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        async def run():
+            await asgi.application(scope, receive, send)
+            await asgi.engine.dispose()
+
+        asyncio.run(run())
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], dict(messages[0]['headers']), body, len(messages)
+
+    def test_export_streams_from_async_engine(self):
+        status, headers, body, messages = self.call('{}/export'.format(BASE_ALL_MOVIES_URL))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/x-ndjson; charset=utf-8')
+        self.assertEqual(len(body.splitlines()), 4774)
+        # sent in chunks, not as one body
+        self.assertGreater(messages, 3)
+
+        status, headers, body, messages = self.call('{}/export'.format(BASE_DIRECTORS_URL), b'format=xml')
+        self.assertEqual(status, 400)
+
+    def test_other_requests_run_the_connexion_app(self):
+        status, headers, body, messages = self.call(GET_DIRECTORS_ONE)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['name'], 'Brian Herzlinger')
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        cache.clear()
+
+    def test_director_stats_follow_writes(self):
+        with QueryCounter() as counter:
+            response = self.connex_app.get('{}/stats'.format(GET_DIRECTORS_ONE))
+        before = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(before['movies_count'], 1)
+        self.assertEqual(counter.count, 1)
+
+        movie = {
+            'original_title': 'Stats Movie', 'budget': 100, 'popularity': 1, 'release_date': '2020-01-01',
+            'revenue': 300, 'title': 'Stats Movie', 'vote_average': 8.0, 'vote_count': 1000,
+            'overview': 'Overview', 'tagline': 'Tagline', 'uid': 880201,
+        }
+        response = self.connex_app.post(BASE_MOVIES_URL, json=movie)
+        self.assertEqual(response.status_code, 201)
+        movie_id = json.loads(response.get_data())['id']
+
+        after = json.loads(self.connex_app.get('{}/stats'.format(GET_DIRECTORS_ONE)).get_data())
+        self.assertEqual(after['movies_count'], 2)
+        self.assertEqual(after['total_budget'], before['total_budget'] + 100)
+        self.assertEqual(after['total_revenue'], before['total_revenue'] + 300)
+
+        self.connex_app.delete('{}/{}'.format(BASE_MOVIES_URL, movie_id))
+        again = json.loads(self.connex_app.get('{}/stats'.format(GET_DIRECTORS_ONE)).get_data())
+        self.assertEqual(again, before)
+
+    def test_rollup_matches_movies(self):
+        with config.app.app_context():
+            rollup = {row[0]: tuple(row[1:]) for row in db.session.execute(stats.rollup())}
+            stored = {row[0]: tuple(row[1:]) for row in db.session.execute(text(
+                'SELECT director_id, movies_count, total_budget, total_revenue, vote_points, vote_total '
+                'FROM director_stats'))}
+        self.assertEqual(rollup, stored)
+
+    def test_leaderboard_and_years(self):
+        response = self.connex_app.get('/api/stats/directors/3/total_revenue')
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data[0]['name'], 'Steven Spielberg')
+        self.assertGreaterEqual(data[0]['total_revenue'], data[1]['total_revenue'])
+
+        response = self.connex_app.get('/api/stats/directors/3/nope')
+        self.assertEqual(response.status_code, 404)
+
+        response = self.connex_app.get('/api/stats/years')
+        data = json.loads(response.get_data())
+        self.assertEqual(data[0]['year'], 1916)
+        self.assertEqual(sum(year['movies_count'] for year in data), 4774)
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_every_operation_has_a_scenario(self):
+        self.assertEqual(benchmark.missing_scenarios(), [])
+
+    def test_generate_scales_the_catalog(self):
+        path = os.path.join(tempfile.mkdtemp(), 'benchmark_3x.db')
+        shutil.copyfile(TEST_DB, path)
+        engine = create_engine('sqlite:///' + path)
+        with engine.begin() as connection:
+            directors_count = connection.execute(text('SELECT count(*) FROM directors')).scalar()
+            movies_count = connection.execute(text('SELECT count(*) FROM movies')).scalar()
+            benchmark.generate(connection, 3)
+
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('SELECT count(*) FROM directors')).scalar(),
+                             3 * directors_count)
+            self.assertEqual(connection.execute(text('SELECT count(*) FROM movies')).scalar(),
+                             3 * movies_count)
+            self.assertEqual(connection.execute(text(
+                "SELECT count(*) FROM directors_fts WHERE directors_fts MATCH 'Herzlinger'")).scalar(), 3)
+            self.assertEqual(connection.execute(text(
+                'SELECT sum(movies_count) FROM director_stats')).scalar(), 3 * movies_count)
+        engine.dispose()
+
+    def test_run_operation(self):
+        client = benchmark.TestClient(connex_app.app)
+        with config.app.app_context():
+            counter = benchmark.QueryCounter(db.engine)
+            with db.engine.connect() as connection:
+                catalog = benchmark.Catalog(connection, client)
+            try:
+                numbers = benchmark.run_operation(catalog, client, counter, 'stats.read_director',
+                                                  requests=10, concurrency=2, warmup=1)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', counter.callback)
+
+        self.assertEqual(numbers['requests'], 10)
+        self.assertEqual(numbers['errors'], 0)
+        self.assertLessEqual(numbers['p50_ms'], numbers['p95_ms'])
+        self.assertLessEqual(numbers['p95_ms'], numbers['p99_ms'])
+        self.assertLessEqual(numbers['queries'], 1)
+
+        slower = dict(numbers, p95_ms=numbers['p95_ms'] * 2 + 1, queries=5)
+        regressions = benchmark.compare({'stats.read_director': slower}, {'stats.read_director': numbers})
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(benchmark.compare({'stats.read_director': numbers},
+                                           {'stats.read_director': numbers}), [])
+
+
+    def test_run_startup(self):
+        # a forked worker answers without importing the app again
+        numbers = benchmark.run_startup('startup.preloaded', 1, tempfile.mkdtemp())
+        self.assertEqual((numbers['requests'], numbers['errors']), (1, 0))
+        self.assertGreater(numbers['p50_ms'], 0)
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        cache.clear()
+        metrics.registry.reset()
+
+    def test_phases_by_operation(self):
+        self.connex_app.get('{}/10/asc/name'.format(BASE_DIRECTORS_URL))
+        self.connex_app.get('{}/10/desc/name'.format(BASE_DIRECTORS_URL))
+        self.connex_app.get('{}?cursor=nope'.format(BASE_DIRECTORS_URL))
+
+        response = self.connex_app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        body = response.get_data(as_text=True)
+
+        self.assertIn('api_requests_total{operation="directors.read_limit",method="GET",status="200"} 2', body)
+        self.assertIn('api_request_duration_seconds_count{operation="directors.read_limit"} 2', body)
+        self.assertIn('api_request_duration_seconds_bucket{operation="directors.read_limit",le="+Inf"} 2', body)
+        self.assertIn('api_sql_queries_total{operation="directors.read_limit"} 4', body)
+        for phase in ('validation', 'sql', 'serialization', 'orm'):
+            match = re.search(r'api_request_phase_seconds_total\{{operation="directors.read_limit",phase="{}"\}} (\S+)'
+                              .format(phase), body)
+            self.assertGreater(float(match.group(1)), 0)
+
+        total = metrics.registry.durations['directors.read_limit']
+        phases = sum(seconds for (operation, _), seconds in metrics.registry.phases.items()
+                     if operation == 'directors.read_limit')
+        self.assertLessEqual(phases, total * 1.01)
+
+        self.assertIn('api_requests_total{operation="directors.read_all",method="GET",status="400"} 1', body)
+
+    def test_slow_request_profile(self):
+        directory = tempfile.mkdtemp()
+        settings = {'METRICS_PROFILE_THRESHOLD': 1, 'METRICS_PROFILE_INTERVAL': 1,
+                    'METRICS_PROFILE_DIR': directory}
+        previous = {name: config.app.config[name] for name in settings}
+        config.app.config.update(settings)
+        try:
+            response = self.connex_app.get('{}/export?format=csv'.format(BASE_ALL_MOVIES_URL))
+            response.get_data()
+            self.connex_app.get(BASE_ALL_MOVIES_URL)
+            # a few samples for sure
+            self.connex_app.get('{}/1000/desc/title'.format(BASE_ALL_MOVIES_URL))
+        finally:
+            config.app.config.update(previous)
+
+        profiles = os.listdir(directory)
+        self.assertTrue(profiles)
+        with open(os.path.join(directory, profiles[0])) as profile:
+            line = profile.readline()
+        self.assertRegex(line, r'^\S.*;.* \d+$')
+
+
+class TestSerializers(unittest.TestCase):
+
+    def setUp(self):
+        self.context = config.app.test_request_context('/')
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+
+    def assertSameAsSchema(self, serializer, schema_class, model, relation, fields=None, include=None):
+        fieldset = fieldsets.Fieldset(schema_class, relation, fields, include)
+        rows = serializer.query(fieldset).order_by(model.id).limit(50).all()
+        objects = model.query.filter(model.id.in_([row.id for row in rows])).order_by(model.id).all()
+        expected = fieldset.schema(schema_class, many=True).dump(objects)
+        if serializer.page_size is not None and fieldset.nest:
+            # the schema dumps the whole relation, the serializer its first page
+            for item, obj in zip(expected, objects):
+                children = item[relation]
+                item[relation] = children[:serializer.page_size]
+                item[relation + '_next'] = None
+                if len(children) > serializer.page_size:
+                    last = getattr(obj, relation)[serializer.page_size - 1]
+                    item[relation + '_next'] = serializer.link(obj.id, last.id)
+        self.assertEqual(json.loads(serializer.dumps(rows, fieldset)), expected)
+
+    def test_movies_match_the_schema(self):
+        for fields, include in [(None, None), (None, ''), ('id,title,directors.name', None),
+                                ('title,directors', None), ('directors.name', None)]:
+            self.assertSameAsSchema(serializers.MOVIES, models.MoviesSchema, models.Movies,
+                                    'directors', fields, include)
+
+    def test_directors_match_the_schema(self):
+        for fields, include in [(None, None), (None, ''), ('name,movies.title', None),
+                                ('id,movies', None), ('uid', None)]:
+            self.assertSameAsSchema(serializers.DIRECTORS, models.DirectorsSchema, models.Directors,
+                                    'movies', fields, include)
+
+    def test_directors_nest_a_page_of_movies(self):
+        page_size, serializers.DIRECTORS.page_size = serializers.DIRECTORS.page_size, 1
+        try:
+            for fields in (None, 'name,movies.title', 'movies_count'):
+                self.assertSameAsSchema(serializers.DIRECTORS, models.DirectorsSchema, models.Directors,
+                                        'movies', fields)
+        finally:
+            serializers.DIRECTORS.page_size = page_size
+
+
+class TestValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+
+    def test_every_error_at_once(self):
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json={'name': '', 'gender': 'x', 'nope': 1})
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['field'] for error in data['errors']],
+                         ['department', 'gender', 'name', 'nope', 'uid'])
+        self.assertIn('Field uid must be required!', data['detail'])
+
+        response = self.connex_app.put(GET_MOVIES_ONE, json={'title': 'Only a title'})
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(data['errors']), 10)
+
+    def test_validators_are_compiled_once(self):
+        schema = {'type': 'object', 'required': ['name'], 'properties': {'name': {'type': 'string'}}}
+        self.assertIs(validation.compile(schema), validation.compile(dict(schema)))
+        self.assertEqual(validation.compile(schema)({'name': 'x'}), {'name': 'x'})
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        cache.clear()
+
+    def create(self):
+        director = {'name': 'Update Checker', 'uid': 990101, 'gender': 0, 'department': 'Directing'}
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+        director_url = '{}/{}'.format(BASE_DIRECTORS_URL, json.loads(response.get_data())['id'])
+        movie = {
+            'original_title': 'Update', 'title': 'Update', 'budget': 1, 'popularity': 1,
+            'release_date': '2020-01-01', 'revenue': 1, 'vote_average': 1.0, 'vote_count': 1,
+            'overview': 'Update', 'tagline': 'Update', 'uid': 990102,
+        }
+        response = self.connex_app.post('{}/movies'.format(director_url), json=movie)
+        movie_url = '{}/movies/{}'.format(director_url, json.loads(response.get_data())['id'])
+        self.addCleanup(self.connex_app.delete, director_url)
+        return director_url, director, movie_url, movie
+
+    def test_put_keeps_its_own_uid(self):
+        director_url, director, movie_url, movie = self.create()
+        response = self.connex_app.put(movie_url, json=dict(movie, title='Updated'))
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((data['title'], data['uid']), ('Updated', 990102))
+        self.assertEqual(data['directors']['name'], 'Update Checker')
+
+        response = self.connex_app.put(director_url, json=dict(director, name='Updated Checker'))
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['name'], 'Updated Checker')
+        self.assertEqual([item['title'] for item in data['movies']], ['Updated'])
+
+    def test_patch_changes_only_the_fields_sent(self):
+        director_url, director, movie_url, movie = self.create()
+        response = self.connex_app.patch(movie_url, json={'budget': 5})
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((data['budget'], data['title']), (5, 'Update'))
+
+        response = self.connex_app.patch(director_url, json={'gender': 2})
+        data = json.loads(response.get_data())
+        self.assertEqual((data['gender'], data['name']), (2, 'Update Checker'))
+
+        response = self.connex_app.patch(director_url, json={})
+        self.assertEqual(response.status_code, 400)
+
+    def test_conflicts_and_not_found(self):
+        director_url, director, movie_url, movie = self.create()
+        taken = json.loads(self.connex_app.get(GET_MOVIES_ONE).get_data())['uid']
+        response = self.connex_app.patch(movie_url, json={'uid': taken})
+        self.assertEqual(response.status_code, 409)
+
+        other_director = movie_url.replace(director_url, GET_DIRECTORS_ONE)
+        response = self.connex_app.patch(other_director, json={'title': 'Moved'})
+        self.assertEqual(response.status_code, 404)
+        response = self.connex_app.patch('{}/0/movies/1'.format(BASE_DIRECTORS_URL), json={'title': 'x'})
+        self.assertIn('Director not found', json.loads(response.get_data())['detail'])
+
+    def test_update_sends_few_queries(self):
+        director_url, director, movie_url, movie = self.create()
+        with QueryCounter() as counter:
+            self.connex_app.patch(movie_url, json={'title': 'Counted'})
+        # update, touch of the director, select of the response
+        self.assertLessEqual(counter.count, 3)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        cache.clear()
+        # every lookup has to reach the handler
+        self.backend, cache.backend = cache.backend, None
+        with connex_app.app.app_context():
+            catalog = snapshot.Snapshot(interval=0.5)
+            catalog.build()
+        self.catalog, snapshot.catalog = snapshot.catalog, catalog
+
+    def tearDown(self):
+        cache.backend = self.backend
+        snapshot.catalog = self.catalog
+
+    def get(self, url):
+        response = self.connex_app.get(url)
+        return response.status_code, json.loads(response.get_data())
+
+    def test_lookups_match_the_database(self):
+        urls = [
+            GET_DIRECTORS_ONE, GET_MOVIES_ONE,
+            '{}?fields=name,movies.title'.format(GET_DIRECTORS_ONE),
+            '{}?include='.format(GET_DIRECTORS_ONE),
+            '{}?fields=title,directors.name'.format(GET_MOVIES_ONE),
+            '{}/0'.format(BASE_DIRECTORS_URL), '{}/0'.format(BASE_MOVIES_URL),
+            '{}/4799'.format(BASE_DIRECTORS_URL),
+            '{}/4799?fields=movies_count,movies.id'.format(BASE_DIRECTORS_URL),
+        ]
+        fast = [self.get(url) for url in urls]
+        snapshot.catalog = None
+        self.assertEqual(fast, [self.get(url) for url in urls])
+
+    def test_lookups_skip_database(self):
+        self.connex_app.get(GET_MOVIES_ONE)
+        with QueryCounter() as counter:
+            self.assertEqual(self.connex_app.get(GET_DIRECTORS_ONE).status_code, 200)
+            self.assertEqual(self.connex_app.get(GET_MOVIES_ONE).status_code, 200)
+        self.assertEqual(counter.count, 0)
+
+    def test_writes_update_the_snapshot(self):
+        director = {'name': 'Snapshot Taker', 'uid': 990201, 'gender': 0, 'department': 'Directing'}
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+        director_url = '{}/{}'.format(BASE_DIRECTORS_URL, json.loads(response.get_data())['id'])
+        self.addCleanup(self.connex_app.delete, director_url)
+        self.assertEqual(self.get(director_url)[1]['movies'], [])
+
+        movie = {
+            'original_title': 'Snap', 'title': 'Snap', 'budget': 1, 'popularity': 1,
+            'release_date': '2020-01-01', 'revenue': 1, 'vote_average': 1.0, 'vote_count': 1,
+            'overview': 'Snap', 'tagline': 'Snap', 'uid': 990202,
+        }
+        response = self.connex_app.post('{}/movies'.format(director_url), json=movie)
+        movie_url = '{}/movies/{}'.format(director_url, json.loads(response.get_data())['id'])
+        self.assertEqual([item['title'] for item in self.get(director_url)[1]['movies']], ['Snap'])
+
+        self.connex_app.patch(movie_url, json={'title': 'Snapped'})
+        self.assertEqual(self.get(movie_url)[1]['title'], 'Snapped')
+        self.assertEqual(self.connex_app.post('{}/movies'.format(director_url), json=movie).status_code, 409)
+
+        self.connex_app.delete(movie_url)
+        self.assertEqual(self.get(movie_url)[0], 404)
+        self.assertEqual(self.get(director_url)[1]['movies'], [])
+
+    def test_stamp_rebuilds_other_workers(self):
+        # another worker renames the director behind the back of this one
+        with db.engine.begin() as connection:
+            connection.execute(models.Directors.__table__.update()
+                               .where(models.Directors.id == 7110).values(name='Renamed Elsewhere'))
+            snapshot.bump_version(connection)
+        self.addCleanup(self.rename, 'Brian Herzlinger')
+
+        snapshot.catalog.checked = 0.0
+        self.assertEqual(self.get(GET_DIRECTORS_ONE)[1]['name'], 'Renamed Elsewhere')
+
+    def rename(self, name):
+        with db.engine.begin() as connection:
+            connection.execute(models.Directors.__table__.update()
+                               .where(models.Directors.id == 7110).values(name=name))
+
+
+class TestFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+
+    def pages(self, query):
+        url = '{}?{}&fields=id,budget,release_date,vote_count&include='.format(BASE_ALL_MOVIES_URL, query)
+        items = []
+        while url is not None:
+            response = self.connex_app.get(url)
+            self.assertEqual(response.status_code, 200)
+            items += json.loads(response.get_data())
+            cursor = response.headers.get('X-Next-Cursor')
+            url = None if cursor is None else '{}?{}&fields=id,budget,release_date,vote_count&include=&cursor={}'.format(
+                BASE_ALL_MOVIES_URL, query, cursor)
+        return items
+
+    def test_filter_and_sort_in_the_database(self):
+        items = self.pages('filter=budget=gt=50000000;release_date=ge=2010-01-01;vote_count=gt=1000'
+                           '&sort=-budget,release_date')
+        with connex_app.app.app_context():
+            expected = (
+                db.session.query(models.Movies.id)
+                .filter(models.Movies.budget > 50000000, models.Movies.release_date >= '2010-01-01',
+                        models.Movies.vote_count > 1000)
+                .order_by(models.Movies.budget.desc(), models.Movies.release_date, models.Movies.id)
+                .all()
+            )
+        self.assertGreater(len(items), 10)
+        self.assertEqual([item['id'] for item in items], [row.id for row in expected])
+
+    def test_in_and_null(self):
+        items = self.pages('filter=id=in=(48399,48400,1);budget!=null')
+        self.assertEqual(sorted(item['id'] for item in items), [48399, 48400])
+
+    def test_invalid_filters(self):
+        for query in ('filter=budget=gt=x', 'filter=overview==x', 'filter=budget>1',
+                      'filter=budget=gt=null', 'filter=id=in=1', 'sort=nope', 'sort=id,-id'):
+            response = self.connex_app.get('{}?{}'.format(BASE_ALL_MOVIES_URL, query))
+            self.assertEqual(response.status_code, 400, query)
+
+    def test_release_date_range(self):
+        url = '{}/100/asc/release date?released_from=2010-01-01&released_to=2010-12-31'.format(BASE_ALL_MOVIES_URL)
+        dates = []
+        while url is not None:
+            response = self.connex_app.get(url)
+            dates += [item['release_date'] for item in json.loads(response.get_data())]
+            cursor = response.headers.get('X-Next-Cursor')
+            url = None if cursor is None else '{}/100/asc/release date?released_from=2010-01-01' \
+                '&released_to=2010-12-31&cursor={}'.format(BASE_ALL_MOVIES_URL, cursor)
+        self.assertEqual(dates, sorted(dates))
+        self.assertTrue(all('2010-01-01' <= day <= '2010-12-31' for day in dates))
+
+        years = json.loads(self.connex_app.get(
+            '/api/stats/years?released_from=2010-01-01&released_to=2010-12-31').get_data())
+        self.assertEqual([(year['year'], year['movies_count']) for year in years], [(2010, len(dates))])
+
+        response = self.connex_app.get('{}?released_from=2010-13-01'.format(BASE_ALL_MOVIES_URL))
+        self.assertEqual(response.status_code, 400)
+
+    def test_release_date_must_be_a_day(self):
+        response = self.connex_app.patch(GET_MOVIES_ONE, json={'release_date': '2005-02-30'})
+        data = json.loads(response.get_data())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['errors'], [{'field': 'release_date', 'message': 'Field release_date must be date!'}])
+
+    def test_cursor_is_bound_to_the_filter(self):
+        response = self.connex_app.get('{}?filter=budget=gt=1'.format(BASE_ALL_MOVIES_URL))
+        cursor = response.headers['X-Next-Cursor']
+        response = self.connex_app.get('{}?filter=budget=gt=2&cursor={}'.format(BASE_ALL_MOVIES_URL, cursor))
+        self.assertEqual(response.status_code, 400)
+
+class TestFilmography(unittest.TestCase):
+    """
+    A director nests the first page of its movies, newest first, and links
+    to /api/directors/{director_id}/movies for the rest
+    """
+
+    # 27 movies, the most of any director
+    PROLIFIC_URL = '{}/4799'.format(BASE_DIRECTORS_URL)
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        self.backend, cache.backend = cache.backend, None
+
+    def tearDown(self):
+        cache.backend = self.backend
+
+    def movie_ids(self, director_id):
+        with connex_app.app.app_context():
+            return [row[0] for row in db.session.execute(text(
+                'SELECT id FROM movies WHERE director_id = :id ORDER BY id DESC'), {'id': director_id})]
+
+    def test_first_page_and_count(self):
+        page_size = config.app.config['FILMOGRAPHY_PAGE_SIZE']
+        data = json.loads(self.connex_app.get(self.PROLIFIC_URL).get_data())
+        ids = self.movie_ids(4799)
+        self.assertEqual(data['movies_count'], len(ids))
+        self.assertEqual([movie['id'] for movie in data['movies']], ids[:page_size])
+        self.assertTrue(data['movies_next'].startswith('{}/movies?cursor='.format(self.PROLIFIC_URL)))
+
+        data = json.loads(self.connex_app.get(GET_DIRECTORS_ONE).get_data())
+        self.assertEqual(data['movies_count'], len(data['movies']))
+        self.assertIsNone(data['movies_next'])
+
+    def test_next_link_reads_the_rest(self):
+        data = json.loads(self.connex_app.get(self.PROLIFIC_URL).get_data())
+        ids = [movie['id'] for movie in data['movies']]
+        url = data['movies_next']
+        while url is not None:
+            response = self.connex_app.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [movie['id'] for movie in json.loads(response.get_data())]
+            cursor = response.headers.get('X-Next-Cursor')
+            url = None if cursor is None else '{}/movies?cursor={}'.format(self.PROLIFIC_URL, cursor)
+        self.assertEqual(ids, self.movie_ids(4799))
+
+        response = self.connex_app.get('{}/movies?limit=5&fields=title'.format(self.PROLIFIC_URL))
+        self.assertEqual(len(json.loads(response.get_data())), 5)
+        self.assertEqual(self.connex_app.get('{}/0/movies'.format(BASE_DIRECTORS_URL)).status_code, 404)
+
+    def test_movies_are_never_all_loaded(self):
+        with QueryRecorder() as recorder:
+            self.connex_app.get(self.PROLIFIC_URL)
+            self.connex_app.get('{}?fields=name,movies_count&include='.format(BASE_DIRECTORS_URL))
+        selects = [statement for statement, _ in recorder.statements if 'movies.title AS' in statement]
+        self.assertEqual(len(selects), 1)
+        self.assertIn('LIMIT', selects[0])
+
+
+class TestSimilar(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        self.backend, cache.backend = cache.backend, None
+
+    def tearDown(self):
+        cache.backend = self.backend
+
+    def similar(self, id, query=''):
+        response = self.connex_app.get('{}/{}/similar{}'.format(BASE_ALL_MOVIES_URL, id, query))
+        return response.status_code, json.loads(response.get_data())
+
+    def test_most_similar_first(self):
+        status, data = self.similar(48399)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data), 10)
+        scores = [movie['similarity'] for movie in data]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertNotIn(48399, [movie['id'] for movie in data])
+        self.assertIsInstance(similar.index.vectors, similar.np.memmap)
+
+        status, data = self.similar(48399, '?limit=3&fields=title&include=')
+        self.assertEqual([set(movie) for movie in data], [{'title', 'similarity'}] * 3)
+        self.assertEqual(self.similar(0)[0], 404)
+
+    def test_batched_search(self):
+        ids = [48399, 48000, 45000]
+        for batched, (single,) in zip(similar.index.search(ids, 5), [similar.index.search([id], 5) for id in ids]):
+            self.assertEqual([id for id, _ in batched], [id for id, _ in single])
+            for (_, left), (_, right) in zip(batched, single):
+                self.assertAlmostEqual(left, right, places=5)
+
+    def test_writes_update_the_index(self):
+        self.similar(48399)
+        original = json.loads(self.connex_app.get(GET_MOVIES_ONE).get_data())
+        copy = {name: original[name] for name in (
+            'original_title', 'budget', 'popularity', 'release_date', 'revenue', 'title',
+            'vote_average', 'vote_count', 'overview')}
+        response = self.connex_app.post(BASE_MOVIES_URL, json=dict(copy, tagline='Drew', uid=987654321))
+        created = json.loads(response.get_data())
+
+        status, data = self.similar(48399, '?limit=1')
+        self.assertEqual(data[0]['id'], created['id'])
+        self.assertGreater(data[0]['similarity'], 0.9)
+
+        self.connex_app.patch('{}/{}'.format(BASE_MOVIES_URL, created['id']),
+                              json={'title': 'Nothing alike', 'overview': 'Elsewhere', 'tagline': 'Other'})
+        status, data = self.similar(48399, '?limit=1')
+        self.assertNotEqual(data[0]['id'], created['id'])
+        self.connex_app.delete('{}/{}'.format(BASE_MOVIES_URL, created['id']))
+
+    def create_copy(self, uid, director_url=BASE_MOVIES_URL):
+        original = json.loads(self.connex_app.get(GET_MOVIES_ONE).get_data())
+        copy = {name: original[name] for name in (
+            'original_title', 'budget', 'popularity', 'release_date', 'revenue', 'title',
+            'vote_average', 'vote_count', 'overview')}
+        response = self.connex_app.post(director_url, json=dict(copy, tagline='Drew', uid=uid))
+        return json.loads(response.get_data())['id']
+
+    def test_deletes_leave_the_index(self):
+        self.similar(48399)
+        movie_id = self.create_copy(987654322)
+        self.assertEqual(self.similar(48399, '?limit=1')[1][0]['id'], movie_id)
+        self.connex_app.delete('{}/{}'.format(BASE_MOVIES_URL, movie_id))
+        self.assertEqual(self.similar(movie_id)[0], 404)
+        status, data = self.similar(48399, '?limit=10')
+        self.assertEqual(len(data), 10)
+        self.assertNotIn(movie_id, [movie['id'] for movie in data])
+
+        # the movies the database deletes with their director too
+        director = {'name': 'Similar Director', 'uid': 987654330, 'gender': 0, 'department': 'Directing'}
+        response = self.connex_app.post(BASE_DIRECTORS_URL, json=director)
+        director_url = '{}/{}'.format(BASE_DIRECTORS_URL, json.loads(response.get_data())['id'])
+        movie_id = self.create_copy(987654323, '{}/movies'.format(director_url))
+        self.assertEqual(self.similar(movie_id)[0], 200)
+        self.connex_app.delete(director_url)
+        self.assertEqual(self.similar(movie_id)[0], 404)
+        self.assertNotIn(movie_id, [movie['id'] for movie in self.similar(48399)[1]])
+
+    def test_deletes_of_other_workers_leave_the_limit(self):
+        self.similar(48399)
+        movie_ids = [self.create_copy(987654340 + index) for index in range(7)]
+        # another worker deletes them, this index still ranks them first
+        engine = create_engine('sqlite:///' + TEST_DB)
+        with engine.begin() as connection:
+            table = models.Movies.__table__
+            connection.execute(table.delete().where(table.c.id.in_(movie_ids)))
+        engine.dispose()
+
+        status, data = self.similar(48399, '?limit=3')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data), 3)
+        self.assertFalse(set(movie_ids) & {movie['id'] for movie in data})
+
+    def test_build_switches_both_files(self):
+        with connex_app.app.app_context():
+            index = similar.Index(os.path.join(os.path.dirname(TEST_DB), 'switch.npy'), 64)
+            index.load()
+            with similar.np.load(index.meta_path) as meta:
+                first = str(meta['vectors'])
+            index.build()
+            index.load()
+        with similar.np.load(index.meta_path) as meta:
+            second = str(meta['vectors'])
+        self.assertNotEqual(first, second)
+        # the .npz names the one .npy left
+        self.assertEqual(sorted(name for name in os.listdir(os.path.dirname(TEST_DB))
+                                if name.startswith('switch.') and name.endswith('.npy')), [second])
+        self.assertEqual(index.vectors.shape, (len(index.ids), 64 + 4))
+
+    def test_writes_of_other_workers_show_up(self):
+        self.similar(48399)
+        # another worker writes to the database, this one only sees its state
+        engine = create_engine('sqlite:///' + TEST_DB)
+        with engine.begin() as connection:
+            table = models.Movies.__table__
+            row = connection.execute(table.select().where(table.c.id == 48399)).mappings().one()
+            movie_id = connection.execute(table.insert().values(
+                dict({name: value for name, value in row.items() if name != 'id'}, uid=987654324))).inserted_primary_key[0]
+        engine.dispose()
+
+        interval, similar.index.interval = similar.index.interval, 0
+        try:
+            self.assertEqual(self.similar(48399, '?limit=1')[1][0]['id'], movie_id)
+        finally:
+            similar.index.interval = interval
+            self.connex_app.delete('{}/{}'.format(BASE_MOVIES_URL, movie_id))
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.connex_app = connex_app.app.test_client()
+        self.connex_app.testing = True
+        cache.clear()
+        metrics.registry.reset()
+        settings = {'GROUP_COMMIT': True, 'GROUP_COMMIT_WINDOW': 50}
+        self.previous = {name: config.app.config[name] for name in settings}
+        config.app.config.update(settings)
+
+    def tearDown(self):
+        config.app.config.update(self.previous)
+
+    def test_concurrent_writes_commit_together(self):
+        other = json.loads(self.connex_app.get('{}/4799'.format(BASE_DIRECTORS_URL)).get_data())
+        bodies = [{'name': 'Grouped Writer {}'.format(index), 'uid': 991000 + index, 'gender': 0,
+                   'department': 'Directing'} for index in range(8)]
+        # a duplicate uid fails alone, the other writes of its batch go through
+        bodies.append({'uid': other['uid']})
+        responses = [None] * len(bodies)
+
+        def post(index):
+            client = connex_app.app.test_client()
+            if index < 8:
+                responses[index] = client.post(BASE_DIRECTORS_URL, json=bodies[index])
+            else:
+                responses[index] = client.patch(GET_DIRECTORS_ONE, json=bodies[index])
+
+        threads = [threading.Thread(target=post, args=(index,)) for index in range(len(bodies))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [201] * 8 + [409])
+        self.assertLess(metrics.registry.batches, len(bodies))
+        self.assertEqual(metrics.registry.batch_sizes, len(bodies))
+        body = self.connex_app.get('/metrics').get_data(as_text=True)
+        self.assertIn('api_group_commit_batch_size_sum {}'.format(len(bodies)), body)
+        self.assertIn('api_group_commit_wait_seconds_count {}'.format(len(bodies)), body)
+
+        config.app.config['GROUP_COMMIT'] = False
+        for response in responses[:8]:
+            created = json.loads(response.get_data())
+            url = '{}/{}'.format(BASE_DIRECTORS_URL, created['id'])
+            self.assertEqual(self.connex_app.get(url).status_code, 200)
+            self.connex_app.delete(url)
+
+    def test_writes_invalidate_the_cache(self):
+        self.connex_app.get(GET_DIRECTORS_ONE)
+        original = json.loads(self.connex_app.get(GET_MOVIES_ONE).get_data())['title']
+        response = self.connex_app.patch(GET_MOVIES_ONE, json={'title': 'Grouped Title'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(writer.writer().name, 'group-commit-writer')
+
+        self.assertEqual(json.loads(self.connex_app.get(GET_MOVIES_ONE).get_data())['title'], 'Grouped Title')
+        movie_titles = [movie['title'] for movie in json.loads(self.connex_app.get(GET_DIRECTORS_ONE).get_data())['movies']]
+        self.assertIn('Grouped Title', movie_titles)
+        self.connex_app.patch(GET_MOVIES_ONE, json={'title': original})
+
+    def test_failed_bookkeeping_wakes_the_writes(self):
+        with unittest.mock.patch.object(metrics.registry, 'observe_batch', side_effect=RuntimeError):
+            response = self.connex_app.patch(GET_MOVIES_ONE, json={'popularity': 8})
+        self.assertEqual(response.status_code, 200)
+        # the writer thread is still there for the next batch
+        self.assertEqual(self.connex_app.patch(GET_MOVIES_ONE, json={'popularity': 7}).status_code, 200)
+        self.assertTrue(writer.writer().is_alive())
+
+    def test_waiting_too_long_answers_503(self):
+        calls = []
+        queued = writer.Writer(0.001, 4, 4, timeout=0.05)
+        with connex_app.app.test_request_context():
+            # the thread is not started, the write times out before its batch
+            with self.assertRaises(werkzeug.exceptions.ServiceUnavailable):
+                queued.submit(calls.append, ('late',), {})
+            queued.start()
+            queued.timeout = 5.0
+            self.assertIsNone(queued.submit(calls.append, ('on time',), {}))
+        # the write given up on never runs
+        self.assertEqual(calls, ['on time'])
+
+    def test_sql_counts_in_the_request(self):
+        response = self.connex_app.patch(GET_MOVIES_ONE, json={'popularity': 7})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(metrics.registry.queries['movies.patch'], 0)
+        self.assertGreater(metrics.registry.phases[('movies.patch', 'sql')], 0)
+
+    def test_index_changes_wait_for_the_commit(self):
+        self.connex_app.get('{}/48399/similar'.format(BASE_ALL_MOVIES_URL))
+        movie = dict(json.loads(self.connex_app.get(GET_MOVIES_ONE).get_data()), director_id=7110)
+        with config.app.app_context():
+            # a write of a batch rolled back alone, then the whole batch
+            session = db.session()
+            savepoint = session.begin_nested()
+            similar.changed([dict(movie, id=999001)])
+            savepoint.rollback()
+            similar.changed([dict(movie, id=999002)])
+            self.assertNotIn(999002, similar.index.changed_ids)
+            session.rollback()
+
+            savepoint = session.begin_nested()
+            similar.changed([dict(movie, id=999003)])
+            savepoint.commit()
+            session.commit()
+            db.session.remove()
+        self.assertNotIn(999001, similar.index.changed_ids)
+        self.assertNotIn(999002, similar.index.changed_ids)
+        self.assertIn(999003, similar.index.changed_ids)
+        similar.index.remove([999003])
+
+
+class TestSpec(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.target = os.path.join(self.directory, 'swagger.json')
+
+    def test_compiled_once_and_reused(self):
+        loaded = spec.load(target=self.target)
+        self.assertIn('/directors/{director_id}/movies', loaded['paths'])
+        self.assertTrue(os.path.exists(self.target))
+
+        # the compiled spec is read as it is, not parsed again
+        modified = os.path.getmtime(self.target)
+        with unittest.mock.patch.object(spec, 'compile_spec', side_effect=AssertionError):
+            self.assertEqual(spec.load(target=self.target), loaded)
+        self.assertEqual(os.path.getmtime(self.target), modified)
+
+        # made from another swagger.yml, it is compiled again
+        source = os.path.join(self.directory, 'swagger.yml')
+        with open(spec.SOURCE) as original, open(source, 'w') as copy:
+            copy.write(original.read().replace('version: "1.0.0"', 'version: "1.0.1"'))
+        self.assertEqual(spec.load(source, self.target)['info']['version'], '1.0.1')
+
+    def test_invalid_spec_is_refused(self):
+        source = os.path.join(self.directory, 'swagger.yml')
+        with open(source, 'w') as invalid:
+            invalid.write('swagger: "2.0"\ninfo: {}\npaths: {}\n')
+        with self.assertRaises(spec.connexion.exceptions.InvalidSpecification):
+            spec.compile_spec(source, self.target)
+        self.assertFalse(os.path.exists(self.target))
+
+    def test_only_the_compiled_spec_skips_validation(self):
+        loaded = spec.load(target=self.target)
+        validated = []
+        original = vars(spec.Swagger2Specification)['_validate_spec']
+
+        def validate(cls, raw):
+            validated.append(raw['info'])
+            original.__func__(cls, raw)
+
+        with unittest.mock.patch.object(spec.Swagger2Specification, '_validate_spec', classmethod(validate)):
+            with spec._validated(loaded):
+                spec.Specification.from_dict(loaded)
+                # another spec loaded meanwhile is still checked
+                with self.assertRaises(spec.connexion.exceptions.InvalidSpecification):
+                    spec.Specification.from_dict({'swagger': '2.0', 'info': {}, 'paths': {}})
+        self.assertEqual(validated, [{}])
+
+    def test_api_served_from_the_compiled_spec(self):
+        self.assertTrue(os.path.exists(config.app.config['SPEC_COMPILED_PATH']))
+        self.assertIn('movies.read_filmography', metrics.OPERATIONS.values())
+        # connexion validates the other specs again
+        self.assertIn('_validate_spec', vars(spec.Swagger2Specification))
+        with self.assertRaises(spec.connexion.exceptions.InvalidSpecification):
+            spec.Specification.from_dict({'swagger': '2.0', 'info': {}, 'paths': {}})
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
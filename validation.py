@@ -0,0 +1,163 @@
+"""
+This is the validation module and supports the validation of the request
+bodies against swagger.yml, with validators compiled once per schema at
+startup, answering 400 with every invalid field at once. The items of
+the bulk writes are checked with the validators of the same definitions.
+"""
+
+import functools
+import json
+import re
+from datetime import date
+
+import fastjsonschema
+from connexion.decorators.validation import RequestBodyValidator as BodyValidator
+from connexion.exceptions import ProblemException
+from connexion.utils import is_null
+import spec
+
+
+# The schemas of swagger 2.0 are JSON schema draft 4
+DRAFT4 = "http://json-schema.org/draft-04/schema#"
+
+_compiled = {}
+
+DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def is_date(value):
+    """
+    Check of the date format, a YYYY-MM-DD day of the calendar, draft 4
+    does not define it
+
+    :param value:   string
+    :return:        bool
+    """
+    if DATE.match(value) is None:
+        return False
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+
+# Formats of swagger.yml the compiled validators check
+FORMATS = {"date": is_date}
+
+
+def compile(schema):
+    """
+    Validator function of a schema, compiled to python once per schema
+
+    :param schema:  JSON schema dict
+    :return:        function raising fastjsonschema.JsonSchemaException
+                    on the first error
+    """
+    key = json.dumps(schema, sort_keys=True)
+    if key not in _compiled:
+        _compiled[key] = fastjsonschema.compile(dict(schema, **{"$schema": DRAFT4}), formats=FORMATS)
+    return _compiled[key]
+
+
+def errors(validator, data):
+    """
+    Every error of data, one per field
+
+    :param validator:   jsonschema validator of the schema
+    :param data:        decoded request body
+    :return:            list of dicts with field and message, sorted by field
+    """
+    found = {}
+    for error in validator.iter_errors(data):
+        path = [str(part) for part in error.path]
+
+        if error.validator == "required":
+            for name in error.validator_value:
+                if name not in error.instance:
+                    field = ".".join(path + [name])
+                    found.setdefault(field, f"Field {field} must be required!")
+        elif error.validator == "additionalProperties":
+            for name in set(error.instance) - set(error.schema.get("properties", {})):
+                field = ".".join(path + [name])
+                found.setdefault(field, f"Field {field} is unknown!")
+        else:
+            field = ".".join(path)
+            found.setdefault(field, f"Field {field}: {error.message}!" if field else f"{error.message}!")
+
+    return [{"field": field, "message": found[field]} for field in sorted(found)]
+
+
+def _error(error):
+    # fastjsonschema names the value data.field, data for the whole body
+    field = error.name[len("data."):] if error.name.startswith("data.") else ""
+    message = error.message[len(error.name):].strip()
+    return {"field": field, "message": f"Field {field} {message}!" if field else f"{message}!"}
+
+
+@functools.lru_cache(maxsize=None)
+def _definitions():
+    return spec.load()["definitions"]
+
+
+def definition(name, **fields):
+    """
+    Validator of a definition of swagger.yml, for the items of a bulk
+    write
+
+    :param name:    name of the definition, Director or Movie
+    :param fields:  fields the items carry on top of it, all required,
+                    and their type, e.g. id="integer"
+    :return:        function raising fastjsonschema.JsonSchemaException
+                    on the first error
+    """
+    schema = _definitions()[name]
+    if fields:
+        schema = dict(
+            schema,
+            properties=dict(schema["properties"], **{field: {"type": kind} for field, kind in fields.items()}),
+            required=list(schema["required"]) + list(fields))
+    return compile(schema)
+
+
+def error(validator, data):
+    """
+    First error of data
+
+    :param validator:   compiled validator of the schema
+    :param data:        decoded item
+    :return:            message, None when data is valid
+    """
+    try:
+        validator(data)
+    except fastjsonschema.JsonSchemaException as exception:
+        return _error(exception)["message"]
+    return None
+
+
+class RequestBodyValidator(BodyValidator):
+    """
+    Body validator of connexion checking the body with the compiled
+    validator of its schema; jsonschema only runs on an invalid body, to
+    list all of its errors
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compiled = compile(self.schema)
+
+    def validate_schema(self, data, url):
+        if self.is_null_value_valid and is_null(data):
+            return None
+
+        try:
+            self.compiled(data)
+        except fastjsonschema.JsonSchemaException as error:
+            # jsonschema does not know the formats draft 4 leaves out
+            found = errors(self.validator, data) or [_error(error)]
+            raise ProblemException(
+                status=400, title="Bad Request",
+                detail=" ".join(error["message"] for error in found),
+                ext={"errors": found})
+
+        return None
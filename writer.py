@@ -0,0 +1,221 @@
+"""
+This is the writer module and supports the group commit of the write
+endpoints. With GROUP_COMMIT set, the writes of a worker are queued to one
+writer thread that runs the writes arriving within GROUP_COMMIT_WINDOW
+milliseconds in a single transaction, each in its own savepoint, and
+commits them at once: one write lock and one fsync for the batch instead
+of one per request. Every request gets its response once its batch is
+committed, a write that fails only rolls back its savepoint.
+
+The write handlers end with writer.commit() and writer.rollback() rather
+than the ones of db.session, they only close the savepoint in a batch.
+"""
+
+import functools
+import os
+import queue
+import threading
+import time
+
+from flask import _request_ctx_stack, abort, g, has_request_context
+from config import app, db
+import metrics
+
+
+class _Job:
+    def __init__(self, function, args, kwargs, context, metrics):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.context = context
+        self.metrics = metrics
+        self.queued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # a caller that stopped waiting cancels the write not started yet
+        self.lock = threading.Lock()
+        self.started = False
+        self.cancelled = False
+
+
+class Writer(threading.Thread):
+    """
+    Thread running the queued writes in batches, one transaction each
+    """
+
+    def __init__(self, window, max_batch, queue_size, timeout=30.0):
+        """
+        :param window:      seconds a batch waits for more writes after the
+                            first one
+        :param max_batch:   writes in a batch at most
+        :param queue_size:  writes waiting at most, more get a 503
+        :param timeout:     seconds a request waits for its batch at most,
+                            then it gets a 503
+        """
+        super().__init__(name="group-commit-writer", daemon=True)
+        self.pid = os.getpid()
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.queue = queue.Queue(queue_size)
+
+    def submit(self, function, args, kwargs):
+        """
+        Queue a write and wait for the commit of its batch
+
+        :param function:    write handler
+        :param args:        positional arguments of the handler
+        :param kwargs:      keyword arguments of the handler
+        :return:            what the handler returned, its exception raised
+        """
+        # the handler reads the request, the body of a bulk write, and
+        # its SQL counts in the metrics of the request
+        job = _Job(function, args, kwargs, _request_ctx_stack.top.copy(), g.get("metrics"))
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            abort(503, "Too many writes waiting, try again later!")
+        if not job.done.wait(self.timeout):
+            with job.lock:
+                job.cancelled = not job.started
+            abort(503, "The write did not commit in time, try again later!")
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def run(self):
+        with app.app_context():
+            while True:
+                batch = [self.queue.get()]
+                deadline = time.perf_counter() + self.window
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self.queue.get(timeout=max(0.0, deadline - time.perf_counter())))
+                    except queue.Empty:
+                        break
+                try:
+                    self.commit_batch(batch)
+                except Exception:
+                    # the callers were woken up, the thread goes on
+                    app.logger.exception("Group commit of %d writes failed", len(batch))
+
+    def commit_batch(self, batch):
+        """
+        Run the writes of batch in one transaction and wake their callers
+
+        :param batch:       list of queued writes
+        """
+        session = db.session()
+        try:
+            connection = session.connection()
+            if connection.dialect.name == "sqlite":
+                # the driver would only begin at the first statement, the
+                # savepoints have to be inside the transaction
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+            for job in batch:
+                with job.lock:
+                    if job.cancelled:
+                        continue
+                    job.started = True
+                savepoint = session.begin_nested()
+                session.info["savepoint"] = savepoint
+                try:
+                    with job.context:
+                        g.metrics = job.metrics
+                        try:
+                            job.result = job.function(*job.args, **job.kwargs)
+                        finally:
+                            g.pop("metrics", None)
+                    if session.get_nested_transaction() is savepoint:
+                        savepoint.commit()
+                except Exception as error:
+                    job.error = error
+                    # a failed flush leaves the savepoint open but inactive
+                    if session.get_nested_transaction() is savepoint:
+                        savepoint.rollback()
+                finally:
+                    session.info.pop("savepoint", None)
+
+            session.commit()
+        except Exception as error:
+            for job in batch:
+                if job.error is None:
+                    job.result, job.error = None, error
+            session.rollback()
+        finally:
+            # every caller is woken up, whatever fails here
+            try:
+                db.session.remove()
+                now = time.perf_counter()
+                metrics.registry.observe_batch(len(batch), [now - job.queued for job in batch])
+            finally:
+                for job in batch:
+                    job.done.set()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    """
+    Writer thread of the process, started on first use so every worker
+    forked from a preloaded app gets its own, None when GROUP_COMMIT is off
+
+    :return:    Writer
+    """
+    global _writer
+    if not app.config["GROUP_COMMIT"]:
+        return None
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = Writer(app.config["GROUP_COMMIT_WINDOW"] / 1000.0,
+                             app.config["GROUP_COMMIT_MAX_BATCH"], app.config["GROUP_COMMIT_QUEUE"],
+                             app.config["GROUP_COMMIT_TIMEOUT"] / 1000.0)
+            _writer.start()
+    return _writer
+
+
+def grouped(function):
+    """
+    Decorator of the write endpoints, their calls go through the writer
+    thread when GROUP_COMMIT is on
+
+    :param function:    write handler
+    :return:            wrapped handler
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        queued = writer()
+        # a write of the writer thread itself runs in its batch
+        if queued is None or not has_request_context() or threading.current_thread() is queued:
+            return function(*args, **kwargs)
+        return queued.submit(function, args, kwargs)
+
+    return wrapper
+
+
+def commit():
+    """
+    Commit the write of the current request, only release its savepoint
+    when it runs in a batch of the writer thread
+    """
+    if "savepoint" in db.session.info:
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def rollback():
+    """
+    Roll back the write of the current request, only its savepoint when it
+    runs in a batch of the writer thread
+    """
+    savepoint = db.session.info.get("savepoint")
+    if savepoint is not None:
+        if db.session().get_nested_transaction() is savepoint:
+            savepoint.rollback()
+    else:
+        db.session.rollback()